@@ -0,0 +1,9 @@
+"""Offline benchmarks of the engine loop and the TestDriver hooks. Runs
+against a throwaway sqlite db with stand-ins for django_bdd, goh_behave, s3,
+cloudwatch and notifications, so no devices, aws or production db are needed.
+Django has to be installed:
+
+    python -m django_bdd_engine.benchmark --steps 20 --rows 3 --depths 10,100 --output results.json
+
+Results are printed, or written to --output, as json.
+"""
@@ -0,0 +1,6 @@
+import sys
+
+from django_bdd_engine.benchmark.run import main
+
+
+sys.exit(main())
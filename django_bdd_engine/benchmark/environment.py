@@ -0,0 +1,72 @@
+"""Prepares the process for benchmarking: django on a sqlite db in a temp
+folder, and the benchmark's stand-ins installed in place of django_bdd and
+the parts of mobilebdd the engine uses.
+"""
+import os
+import sys
+import types
+
+from django_bdd_engine.benchmark import fakes
+
+
+def _install_module(name, **attributes):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install_fakes(behave, notifications):
+    """Put the stand-ins in sys.modules. goh_behave is always replaced, the
+    rest of mobilebdd only when it isn't installed.
+    """
+    from django_bdd_engine.benchmark import models
+
+    package = _install_module(u'django_bdd', models=models)
+    package.notifications = _install_module(u'django_bdd.notifications', notify=notifications.notify)
+    sys.modules[u'django_bdd.models'] = models
+
+    try:
+        import mobilebdd.listener
+        import mobilebdd.environment
+    except ImportError:
+        mobilebdd = _install_module(u'mobilebdd')
+        mobilebdd.listener = _install_module(u'mobilebdd.listener', Listener=fakes.FakeListener)
+        mobilebdd.environment = _install_module(
+            u'mobilebdd.environment',
+            get_runtime_requirements_from_steps=fakes.get_runtime_requirements_from_steps
+        )
+    sys.modules[u'mobilebdd.runner'] = _install_module(u'mobilebdd.runner', goh_behave=behave)
+
+
+def setup_environment(folder, behave, notifications):
+    """Configure django and create the tables. Must run before anything
+    imports the engine.
+    """
+    import django
+    from django.conf import settings
+    from django.db import connection
+
+    settings.configure(
+        DATABASES={u'default': {
+            u'ENGINE': u'django.db.backends.sqlite3',
+            u'NAME': os.path.join(folder, u'benchmark.sqlite3'),
+        }},
+        INSTALLED_APPS=[u'django_bdd_engine.benchmark'],
+        CACHES={u'default': {u'BACKEND': u'django.core.cache.backends.locmem.LocMemCache'}},
+        USE_TZ=True,
+        DJANGO_BDD_ENGINE_LOCAL_S3_DIR=os.path.join(folder, u's3'),
+        DJANGO_BDD_ENGINE_OUTBOX_DIR=os.path.join(folder, u'outbox'),
+        DJANGO_BDD_ENGINE_METRICS_BACKEND=u'memory',
+    )
+    django.setup()
+    install_fakes(behave, notifications)
+
+    from django_bdd_engine.benchmark.models import Test, TestRun, TestRunStep
+    with connection.schema_editor() as editor:
+        for model in (Test, TestRun, TestRunStep):
+            editor.create_model(model)
+
+    # settings are configured already, the engine mustn't configure them from a stage
+    from django_bdd_engine import toplevel
+    toplevel.STAGE = u'benchmark'
@@ -0,0 +1,227 @@
+"""Stand-ins for goh_behave, notifications and runtime requirements. The fake
+goh_behave replays a synthetic feature through the listener hooks and times
+each hook call.
+"""
+import os
+import time
+import random
+import struct
+
+from django_bdd_engine.testqueue import percentile
+
+
+STEP_KEYWORDS = (u'Given', u'When', u'Then', u'And', u'But')
+SCREENSHOT_HEADER = b'\x89PNG\r\n\x1a\n'
+
+
+class BenchmarkConfig(object):
+    """The shape of the synthetic test runs.
+    """
+
+    def __init__(self, steps=10, rows=0, substeps=0, screenshots=False, failure_rate=0.0, step_seconds=0.0, seed=0):
+        """
+        :param steps: steps per scenario
+        :param rows: example rows, 0 for a plain scenario
+        :param substeps: substeps run inside each step, which have no step result
+        :param screenshots: take a screenshot after every step
+        :param failure_rate: the chance of each step failing
+        :param step_seconds: how long each step takes on the pretend device
+        :param seed: seed for the failures
+        """
+        self.steps = steps
+        self.rows = rows
+        self.substeps = substeps
+        self.screenshots = screenshots
+        self.failure_rate = failure_rate
+        self.step_seconds = step_seconds
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def test_steps(self):
+        placeholder = u' <value>' if self.rows else u''
+        return u'\r\n'.join(
+            u'{} step number {}{}'.format(STEP_KEYWORDS[0] if num == 1 else STEP_KEYWORDS[3], num, placeholder)
+            for num in range(1, self.steps + 1)
+        )
+
+    def example_text(self):
+        if not self.rows:
+            return u''
+        return u'\r\n'.join([u'| value |'] + [u'| {} |'.format(row) for row in range(1, self.rows + 1)]) + u'\r\n'
+
+
+class FakeStep(object):
+
+    def __init__(self, keyword, name):
+        self.keyword = keyword
+        self.name = name
+        self.status = u'untested'
+        self.error_message = None
+        self.screenshot_path = None
+        self.duration = 0
+
+
+class FakeScenario(object):
+
+    def __init__(self, steps):
+        self.background_steps = []
+        self.steps = steps
+        self.status = u'untested'
+
+
+class FakeFeature(object):
+
+    def __init__(self, scenarios):
+        self.scenarios = scenarios
+        self.status = u'untested'
+        self.duration = 0
+
+    def walk_scenarios(self):
+        return list(self.scenarios)
+
+
+def parse_feature(path):
+    """Just enough of a gherkin parser for the features TestDriver writes.
+
+    :return: a FakeFeature with a scenario per example row
+    """
+    with open(path, u'rb') as f:
+        lines = [line.strip() for line in f.read().decode(u'utf8').splitlines()]
+
+    steps = []
+    table = []
+    in_examples = False
+    for line in lines:
+        if line.startswith(u'Examples:'):
+            in_examples = True
+        elif in_examples and line.startswith(u'|'):
+            table.append([cell.strip() for cell in line.strip(u'|').split(u'|')])
+        elif line.split(u' ', 1)[0] in STEP_KEYWORDS:
+            keyword, name = line.split(u' ', 1)
+            steps.append((keyword, name))
+
+    rows = [dict(zip(table[0], row)) for row in table[1:]] if table else [{}]
+    scenarios = []
+    for row in rows:
+        scenario_steps = []
+        for keyword, name in steps:
+            for header, value in row.items():
+                name = name.replace(u'<{}>'.format(header), value)
+            scenario_steps.append(FakeStep(keyword, name))
+        scenarios.append(FakeScenario(scenario_steps))
+    return FakeFeature(scenarios)
+
+
+class FakeBehave(object):
+    """Called like goh_behave. Runs every feature in the feature folders
+    through the listeners' hooks, without a device.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.hook_seconds = {}  # hook name -> seconds each call took
+        self.screenshot_count = 0
+
+    def __call__(self, feature_dirs, step_dirs, test_artifact_dir, listeners, webdriver_url, webdriver_processor=None):
+        for feature_dir in feature_dirs:
+            for name in sorted(os.listdir(feature_dir)):
+                if name.endswith(u'.feature'):
+                    self.run_feature(parse_feature(os.path.join(feature_dir, name)), test_artifact_dir, listeners)
+
+    def call_hook(self, listeners, name, *args):
+        for listener in listeners:
+            start = time.time()
+            getattr(listener, name)(*args)
+            self.hook_seconds.setdefault(name, []).append(time.time() - start)
+
+    def take_screenshot(self, folder):
+        self.screenshot_count += 1
+        path = os.path.join(folder, u'screenshot-{}.png'.format(self.screenshot_count))
+        with open(path, u'wb') as f:
+            # unique content, so deduplication doesn't hide the upload cost
+            f.write(SCREENSHOT_HEADER + struct.pack(u'>Q', self.screenshot_count) * 64)
+        return path
+
+    def run_step(self, step, folder, listeners, failed):
+        self.call_hook(listeners, u'before_step', step)
+        for num in range(self.config.substeps):
+            substep = FakeStep(u'Given', u'substep {} of {}'.format(num + 1, step.name))
+            self.call_hook(listeners, u'before_step', substep)
+            substep.status = u'passed'
+            self.call_hook(listeners, u'after_step', substep)
+
+        if self.config.step_seconds:
+            time.sleep(self.config.step_seconds)
+        if self.random.random() < self.config.failure_rate:
+            step.status = u'failed'
+            step.error_message = u'Assertion Failed: {} did not happen\n'.format(step.name)
+        else:
+            step.status = u'passed'
+        step.duration = self.config.step_seconds
+        if self.config.screenshots:
+            step.screenshot_path = self.take_screenshot(folder)
+        self.call_hook(listeners, u'after_step', step)
+        return step.status == u'failed'
+
+    def run_feature(self, feature, folder, listeners):
+        start = time.time()
+        self.call_hook(listeners, u'before_feature', feature)
+        for scenario in feature.scenarios:
+            self.call_hook(listeners, u'before_scenario', scenario)
+            failed = False
+            for step in scenario.steps:
+                # like behave, steps after a failure are skipped without their hooks being called
+                if failed:
+                    step.status = u'skipped'
+                    continue
+                failed = self.run_step(step, folder, listeners, failed)
+            scenario.status = u'failed' if failed else u'passed'
+            self.call_hook(listeners, u'after_scenario', scenario)
+
+        feature.status = u'failed' if any(scenario.status == u'failed' for scenario in feature.scenarios) else u'passed'
+        feature.duration = time.time() - start
+        self.call_hook(listeners, u'after_feature', feature)
+
+    def hook_stats(self):
+        """
+        :return: dict of hook name to its call count and latency in milliseconds
+        """
+        stats = {}
+        for name, seconds in self.hook_seconds.items():
+            seconds = sorted(seconds)
+            stats[name] = {
+                u'count': len(seconds),
+                u'mean_ms': 1000.0 * sum(seconds) / len(seconds),
+                u'p50_ms': 1000.0 * percentile(seconds, 0.5),
+                u'p90_ms': 1000.0 * percentile(seconds, 0.9),
+                u'max_ms': 1000.0 * seconds[-1],
+            }
+        return stats
+
+
+class FakeNotifications(object):
+    """Records who would have been notified.
+    """
+
+    def __init__(self):
+        self.notified = []
+
+    def notify(self, test_run):
+        self.notified.append(test_run.id)
+
+
+def get_runtime_requirements_from_steps(steps):
+    return {}
+
+
+class FakeListener(object):
+    """mobilebdd's Listener, for when mobilebdd isn't installed.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith(u'before_') or name.startswith(u'after_'):
+            return lambda *args: None
+        raise AttributeError(name)
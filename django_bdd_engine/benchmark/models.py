@@ -0,0 +1,39 @@
+"""Stand-ins for the django_bdd models, with the fields the engine uses. Only
+loaded by the benchmark, which installs this module as django_bdd.models.
+"""
+from django.db import models
+
+
+NEW = u'new'
+RUNNING = u'running'
+ERROR = u'error'
+FAILED = u'failed'
+PASSED = u'passed'
+SKIPPED = u'skipped'
+
+
+class Test(models.Model):
+    name = models.CharField(max_length=255)
+    steps = models.TextField()
+
+
+class TestRun(models.Model):
+    test = models.ForeignKey(Test, on_delete=models.CASCADE)
+    user = models.CharField(max_length=255, default=u'benchmark')
+    status = models.CharField(max_length=32, default=NEW, db_index=True)
+    text = models.TextField(default=u'', blank=True)
+    example_text = models.TextField(default=u'', blank=True)
+    duration = models.FloatField(null=True)
+    queued_at = models.DateTimeField(null=True)
+
+
+class TestRunStep(models.Model):
+    test_run = models.ForeignKey(TestRun, on_delete=models.CASCADE)
+    num = models.IntegerField()
+    example_row_num = models.IntegerField()
+    text = models.TextField()
+    status = models.CharField(max_length=32, default=NEW)
+    timestamp_start = models.DateTimeField(null=True)
+    timestamp_end = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)
+    screenshot_s3_key = models.CharField(max_length=255, null=True)
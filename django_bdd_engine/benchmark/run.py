@@ -0,0 +1,200 @@
+"""Runs the benchmarks and reports the results as json.
+"""
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+
+from django_bdd_engine.benchmark import fakes
+from django_bdd_engine.benchmark.environment import setup_environment
+
+
+log = logging.getLogger(u'django-bdd')
+
+DEFAULT_DEPTHS = u'10,50,100'
+
+
+class QueueDrained(Exception):
+    pass
+
+
+def create_test_runs(config, count):
+    """Queue count identical test runs of one synthetic test.
+    """
+    from django_bdd_engine.benchmark.models import Test, TestRun
+
+    test = Test.objects.create(name=u'benchmark', steps=config.test_steps())
+    TestRun.objects.bulk_create([TestRun(test=test, example_text=config.example_text()) for _ in range(count)])
+    return list(TestRun.objects.filter(test=test).values_list(u'pk', flat=True))
+
+
+def engine_loop_overhead(backend):
+    """
+    :return: mean and max of the EngineExecutionTimeSansTest metric sent since the last call (seconds)
+    """
+    from django_bdd_engine.utility.cloudwatch import metrics, METRIC_ENGINE_EXECUTION_TIME_SANS_TEST
+
+    metrics.flush()
+    minimum, maximum, total, count = None, 0, 0, 0
+    for kind, name, dimensions, value in backend.sent:
+        if name == METRIC_ENGINE_EXECUTION_TIME_SANS_TEST:
+            minimum = value[0] if minimum is None else min(minimum, value[0])
+            maximum = max(maximum, value[1])
+            total += value[2]
+            count += value[3]
+    del backend.sent[:]
+    return {u'loops': count, u'mean': total / count if count else None, u'max': maximum if count else None}
+
+
+def benchmark_test_driver(config, runs, behave):
+    """Run test runs one at a time through TestDriver, counting queries.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from django_bdd_engine.outbox import Outbox
+    from django_bdd_engine.testdriver import TestDriver
+    from django_bdd_engine.utility.logs import logging_stats
+
+    class Engine(object):
+        lease_seconds = None
+        outbox = Outbox()
+
+    behave.hook_seconds = {}
+    step_results = config.steps * max(1, config.rows)
+    queries = []
+    seconds = []
+    logging_records, logging_seconds = logging_stats[u'records'], logging_stats[u'seconds']
+    for test_run_id in create_test_runs(config, runs):
+        start = time.time()
+        with CaptureQueriesContext(connection) as context:
+            TestDriver(engine=Engine(), test_run_id=test_run_id, endpoint=u'http://benchmark').start()
+        seconds.append(time.time() - start)
+        queries.append(len(context))
+
+    return {
+        u'runs': runs,
+        u'step_results_per_run': step_results,
+        u'queries_per_run': float(sum(queries)) / runs,
+        u'queries_per_step': float(sum(queries)) / runs / step_results,
+        u'run_seconds_mean': sum(seconds) / runs,
+        u'run_seconds_max': max(seconds),
+        u'log_records_per_step': float(logging_stats[u'records'] - logging_records) / runs / step_results,
+        u'logging_ms_per_step': 1000.0 * (logging_stats[u'seconds'] - logging_seconds) / runs / step_results,
+        u'hooks': behave.hook_stats(),
+    }
+
+
+def benchmark_queue_drain(config, depth, backend):
+    """Queue depth test runs and time an inline engine running them all.
+    """
+    from django_bdd_engine.engine import DjangoBDDEngine
+    from django_bdd_engine.wakeup import WakeupSource
+
+    class DrainedWakeup(WakeupSource):
+        # the engine only naps when it found nothing to claim
+        def wait(self, timeout):
+            if not engine.queue.count():
+                raise QueueDrained()
+            return False
+
+    create_test_runs(config, depth)
+    engine = DjangoBDDEngine(endpoint=u'http://benchmark', wakeup=DrainedWakeup())
+    engine_loop_overhead(backend)  # start counting from here
+
+    start = time.time()
+    try:
+        engine.run()
+    except QueueDrained:
+        pass
+    finally:
+        engine.tasks.stop()
+    seconds = time.time() - start
+
+    return {
+        u'depth': depth,
+        u'seconds': seconds,
+        u'runs_per_second': depth / seconds,
+        u'engine_loop_overhead': engine_loop_overhead(backend),
+    }
+
+
+def versions():
+    import django
+    try:
+        import pkg_resources
+        engine_version = pkg_resources.get_distribution(u'Django-bdd-engine').version
+    except Exception:
+        engine_version = None
+    return {u'engine': engine_version, u'django': django.get_version(), u'python': platform.python_version()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u'benchmark the engine loop and TestDriver hooks offline')
+    parser.add_argument(u'--steps', type=int, default=10, help=u'steps per scenario')
+    parser.add_argument(u'--rows', type=int, default=0, help=u'example rows, 0 for a plain scenario')
+    parser.add_argument(u'--substeps', type=int, default=0, help=u'substeps in each step')
+    parser.add_argument(u'--screenshots', action=u'store_true', help=u'take a screenshot after every step')
+    parser.add_argument(u'--failure-rate', type=float, default=0.0, help=u'chance of each step failing')
+    parser.add_argument(u'--step-seconds', type=float, default=0.0, help=u'time each step spends on the device')
+    parser.add_argument(u'--seed', type=int, default=0)
+    parser.add_argument(u'--runs', type=int, default=10, help=u'test runs for the TestDriver benchmark')
+    parser.add_argument(u'--depths', default=DEFAULT_DEPTHS, help=u'comma separated queue depths to drain')
+    parser.add_argument(u'--output', help=u'write the results to this file instead of printing them')
+    parser.add_argument(u'--verbose', action=u'store_true', help=u'show the engine\'s logging')
+    parser.add_argument(u'--run-logs', action=u'store_true', help=u'log asynchronously and capture each run\'s log')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    config = fakes.BenchmarkConfig(
+        steps=args.steps,
+        rows=args.rows,
+        substeps=args.substeps,
+        screenshots=args.screenshots,
+        failure_rate=args.failure_rate,
+        step_seconds=args.step_seconds,
+        seed=args.seed
+    )
+    behave = fakes.FakeBehave(config)
+    notifications = fakes.FakeNotifications()
+
+    folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-benchmark-')
+    try:
+        setup_environment(folder, behave, notifications)
+        if args.run_logs:
+            from django.conf import settings
+            from django_bdd_engine.utility.logs import start_async_logging
+            settings.DJANGO_BDD_ENGINE_RUN_LOGS = True
+            start_async_logging()
+
+        from django_bdd_engine.utility.cloudwatch import set_metrics_backend
+        from django_bdd_engine.utility.metrics import MemoryBackend
+        backend = MemoryBackend()
+        set_metrics_backend(backend)
+
+        results = {
+            u'versions': versions(),
+            u'config': config.as_dict(),
+            u'test_driver': benchmark_test_driver(config, args.runs, behave),
+            u'queue_drain': [
+                benchmark_queue_drain(config, int(depth), backend) for depth in args.depths.split(u',') if depth
+            ],
+        }
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, u'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
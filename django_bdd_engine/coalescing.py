@@ -0,0 +1,83 @@
+import logging
+
+from django.db import transaction
+
+from django_bdd_engine.features import fingerprint
+from django_bdd_engine.testqueue import claim_test_run
+from django_bdd_engine.utility.db import with_retry
+
+
+log = logging.getLogger(u'django-bdd')
+
+COALESCE_LIMIT = 50  # most queued duplicates that are run together with one test run
+STEP_COPY_BATCH_SIZE = 500  # number of test run steps copied per query
+
+
+def test_run_fingerprint(steps, example_text, requirements):
+    """Identifies test runs that would do exactly the same thing.
+    """
+    return fingerprint(steps, example_text or u'', repr(sorted(requirements.items())))
+
+
+def claim_duplicates(test_run, requirements, lease_seconds=None, limit=COALESCE_LIMIT):
+    """Claim the queued test runs that are duplicates of a claimed one, so
+    that they can get its results instead of running themselves.
+
+    :param requirements: the test run's runtime requirements
+    :param lease_seconds: if set, take out a lease on the claimed runs
+    :return: the ids of the claimed duplicates, oldest first
+    :rtype: list
+    """
+    from django_bdd.models import TestRun, NEW
+
+    steps = test_run.test.steps
+    example_text = test_run.example_text
+    run_fingerprint = test_run_fingerprint(steps, example_text, requirements)
+
+    candidates = TestRun.objects.filter(
+        status=NEW,
+        test__steps=steps,
+        example_text=example_text
+    ).exclude(pk=test_run.pk).order_by(u'pk').values_list(u'pk', u'test__steps', u'example_text')[:limit]
+
+    duplicate_ids = []
+    for test_run_id, candidate_steps, candidate_example_text in candidates:
+        # the db may compare text loosely, eg. mysql ignores case and trailing spaces
+        if test_run_fingerprint(candidate_steps, candidate_example_text, requirements) != run_fingerprint:
+            continue
+
+        if claim_test_run(test_run_id, lease_seconds):
+            duplicate_ids.append(test_run_id)
+
+    if duplicate_ids:
+        log.debug(u'coalesced test runs %s into test run %s', duplicate_ids, test_run.id)
+    return duplicate_ids
+
+
+def fan_out_results(test_run_id, duplicate_ids, outbox):
+    """Copy a finished test run's status, duration, text and step results,
+    screenshots included, to its duplicates, and queue a notification for each
+    of their users.
+
+    :param outbox: the django_bdd_engine.outbox.Outbox to queue notifications in
+    """
+    from django_bdd.models import TestRun, TestRunStep
+
+    test_run = with_retry(TestRun.objects.get, pk=test_run_id)
+    test_steps = with_retry(list, test_run.testrunstep_set.all())
+
+    def copy_results(duplicate):
+        for test_step in test_steps:
+            test_step.pk = None
+            test_step.test_run = duplicate
+        with transaction.atomic():
+            TestRunStep.objects.bulk_create(test_steps, batch_size=STEP_COPY_BATCH_SIZE)
+            duplicate.save()
+
+    for duplicate in with_retry(list, TestRun.objects.filter(pk__in=duplicate_ids)):
+        log.debug(u'copying the results of test run %s to test run %s', test_run_id, duplicate.id)
+        duplicate.status = test_run.status
+        duplicate.duration = test_run.duration
+        duplicate.text += test_run.text
+        with_retry(copy_results, duplicate)
+        outbox.put(duplicate.id)
@@ -0,0 +1,148 @@
+import logging
+import threading
+import urllib2
+
+from django_bdd_engine.tasks.task import Task
+from django_bdd_engine.utility.forking import register_lock_owner
+
+
+log = logging.getLogger(u'django-bdd')
+
+HEALTH_CHECK_INTERVAL = 30  # how often endpoints are checked (seconds)
+HEALTH_CHECK_TIMEOUT = 5  # how long an endpoint has to answer a health check (seconds)
+
+
+class Endpoint(object):
+    """A webdriver/appium server the engine can run tests against.
+    """
+
+    def __init__(self, url, capabilities=None, max_sessions=1):
+        """
+        :param url: eg. http://localhost:4723
+        :param capabilities: runtime requirement values the endpoint provides,
+            eg. {u'os_type': u'android', u'device_type': u'tablet'}. a test can
+            use the endpoint if its requirements don't contradict any of them.
+        :param max_sessions: how many tests can run against it at once
+        """
+        self.url = url
+        self.capabilities = capabilities or {}
+        self.max_sessions = max_sessions
+        self.active = 0
+        self.healthy = True
+
+    def __repr__(self):
+        return u'Endpoint({}, active={}/{}, healthy={})'.format(self.url, self.active, self.max_sessions, self.healthy)
+
+    @property
+    def load(self):
+        return float(self.active) / self.max_sessions
+
+    def matches(self, requirements):
+        for key, value in self.capabilities.items():
+            if key in requirements and requirements[key] != value:
+                return False
+        return True
+
+    def available(self, requirements):
+        return self.healthy and self.active < self.max_sessions and self.matches(requirements)
+
+    def check_health(self):
+        """Ask the server for its status, webdriver and appium servers answer
+        GET /status with a 200 when they're up.
+        """
+        try:
+            response = urllib2.urlopen(self.url.rstrip(u'/') + u'/status', timeout=HEALTH_CHECK_TIMEOUT)
+            healthy = response.getcode() == 200
+        except Exception as e:
+            log.debug(u'health check of endpoint %s failed: %s', self.url, e)
+            healthy = False
+
+        if healthy != self.healthy:
+            log.info(u'endpoint {} is now {}'.format(self.url, u'healthy' if healthy else u'unhealthy'))
+        self.healthy = healthy
+
+
+class EndpointLease(object):
+    """One test run's hold on an endpoint, released once the run is done.
+    Releasing more than once is harmless.
+    """
+
+    def __init__(self, pool, endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.url = endpoint.url
+
+    def release(self):
+        if self.pool:
+            self.pool.release(self.endpoint)
+            self.pool = None
+
+    def __getstate__(self):
+        # a copy handed to a worker process can't release the engine's endpoint, the engine releases it when the
+        # worker reports back
+        return {u'pool': None, u'endpoint': None, u'url': self.url}
+
+
+class EndpointLeaseGroup(object):
+    """Several leases held by one test run, eg. one per shard of a sharded
+    run. Releasing the group releases all of them.
+    """
+
+    def __init__(self, leases):
+        self.leases = list(leases)
+        self.urls = [lease.url for lease in self.leases]
+        self.url = self.urls[0]
+
+    def release(self):
+        for lease in self.leases:
+            lease.release()
+
+
+class EndpointPool(object):
+    """The endpoints an engine runs TestDriver tests against. Each run leases
+    the least loaded healthy endpoint that matches its requirements.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = list(endpoints)
+        self.lock = threading.Lock()
+        register_lock_owner(self)
+
+    def has_capacity(self, requirements):
+        return any(endpoint.available(requirements) for endpoint in self.endpoints)
+
+    def lease(self, requirements):
+        """
+        :return: an EndpointLease, or None if no matching endpoint is free
+        """
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.available(requirements)]
+            if not candidates:
+                return None
+
+            endpoint = min(candidates, key=lambda candidate: candidate.load)
+            endpoint.active += 1
+            log.debug(u'leased %s', endpoint)
+            return EndpointLease(self, endpoint)
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.active = max(0, endpoint.active - 1)
+            log.debug(u'released %s', endpoint)
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            endpoint.check_health()
+
+
+class EndpointHealthCheckTask(Task):
+    """Engine task that checks the pool's endpoints every HEALTH_CHECK_INTERVAL.
+    """
+
+    def __init__(self, pool, interval=HEALTH_CHECK_INTERVAL):
+        # every endpoint may take HEALTH_CHECK_TIMEOUT to answer
+        super(EndpointHealthCheckTask, self).__init__(interval=interval, timeout=HEALTH_CHECK_TIMEOUT * (len(pool.endpoints) + 1))
+        self.pool = pool
+
+    def update(self):
+        self.pool.check_health()
@@ -1,30 +1,72 @@
-import logging
+import os
 import time
+import logging
 import datetime
 import pytz  # timezone support: datetime.datetime.now(pytz.utc)
 
-from django_bdd_engine.toplevel import *  # initialize stage and django backend
+from django.conf import settings
+
+from django_bdd_engine.toplevel import setup_stage  # initializes stage and django backend
 
 from django_bdd_engine.testdriver import TestDriver
+from django_bdd_engine.sharding import ShardedTestDriver, count_example_rows
+from django_bdd_engine.coalescing import claim_duplicates, fan_out_results
+from django_bdd_engine.preflight import Preflight
+from django_bdd_engine.workers import WorkerPool
+from django_bdd_engine.wakeup import Backoff, WakeupSource
+from django_bdd_engine.tasks.scheduler import TaskScheduler
+from django_bdd_engine.outbox import Outbox, OutboxSenderTask
+from django_bdd_engine.runners.registry import RunnerRegistry, RunnersSaturated
+from django_bdd_engine.endpoints import EndpointPool, EndpointLeaseGroup, EndpointHealthCheckTask
+from django_bdd_engine.utility.db import connection_stats, reset_connection, with_retry
+from django_bdd_engine.utility.runtext import RunText
+from django_bdd_engine.utility.logs import start_async_logging
+from django_bdd_engine.utility.tracing import (
+    span,
+    start_trace,
+    finish_trace,
+    current_trace,
+    trace_dir,
+    profiled,
+    profile_requested,
+    ENGINE_TRACE_INTERVAL
+)
 
-# import db models
-from django.db import connection
-from django_bdd.models import TestRun, NEW, ERROR
+# django_bdd models are imported where they're used, they can only be loaded once the stage is set up
+from django_bdd_engine.testqueue import (
+    TestRunQueue,
+    LeaseRenewalTask,
+    held_leases,
+    holds_lease,
+    release_lease,
+    reclaim_expired_test_runs,
+    unclaim_test_run
+)
 
 # metrics keys
 from django_bdd_engine.utility.cloudwatch import (
     put_metric_data,
+    increment_metric,
+    set_metric_gauge,
     METRIC_ENGINE_HEARTBEAT,
     METRIC_ENGINE_NEW_TEST_QUERY_DURATION,
     METRIC_ENGINE_TEST_QUEUE,
     METRIC_ENGINE_EXECUTION_TIME_SANS_TEST,
-    METRIC_ENGINE_TEST_RUN_ERROR
+    METRIC_ENGINE_TEST_RUN_ERROR,
+    METRIC_ENGINE_QUEUE_OLDEST_WAIT,
+    METRIC_ENGINE_QUEUE_WAIT_P50,
+    METRIC_ENGINE_QUEUE_WAIT_P90,
+    METRIC_ENGINE_QUEUE_DEPTH,
+    METRIC_ENGINE_DB_RECONNECTS,
+    METRIC_ENGINE_DB_RETRIES,
+    METRIC_ENGINE_TEST_RUNS_COALESCED,
+    METRIC_ENGINE_TEST_RUN_PREFLIGHT_FAILED
 )
 
-from mobilebdd.environment import get_runtime_requirements_from_steps
-
 
-NAPPY_TIME = 15  # length of time to sleep (seconds)
+NAPPY_TIME = 15  # longest length of time to sleep (seconds)
+MIN_NAPPY_TIME = 1  # length of time to sleep right after the queue empties (seconds)
+QUEUE_STATS_INTERVAL = 60  # how often to report detailed queue statistics (seconds)
 
 log = logging.getLogger(u'django-bdd')
 email_log = logging.getLogger(u'email_log')
@@ -32,124 +74,516 @@ email_log = logging.getLogger(u'email_log')
 
 class DjangoBDDEngine(object):
 
-    def __init__(self, endpoint=None, runners=None):
+    def __init__(self, endpoint=None, runners=None, lease_seconds=None, workers=0, max_runs_per_worker=None,
+                 max_worker_memory_mb=None, wakeup=None, endpoints=None, max_shards=None,
+                 coalesce=False, scheduler=None, preflight=False, session_pool=None):
         """
-        :param runners: A list of potential runner classes for tests.
+        :param endpoint: The endpoint to run TestDriver tests against, when there's no endpoints list.
+        :param runners: A list of potential runner classes for tests, in order of preference.
         :type runners: list
+        :param lease_seconds: If set, claimed test runs are leased for this long and renewed while they run. Runs
+            whose lease expires (ie. their engine crashed) are put back in the queue. The engine renews the leases
+            of the runs it's running a few times per lease period, and a run whose lease was lost stops writing its
+            results. Requires a django cache that is shared between engine hosts, and every engine sharing a db to
+            use leases.
+        :type lease_seconds: int
+        :param workers: The number of worker processes to run tests in. With 0, tests run one at a time in the engine
+            process itself and block the engine loop.
+        :type workers: int
+        :param max_runs_per_worker: Replace a worker process after it has completed this many test runs.
+        :type max_runs_per_worker: int
+        :param max_worker_memory_mb: Replace a worker process once its peak memory use passes this many megabytes.
+        :type max_worker_memory_mb: int
+        :param wakeup: What to wait on while the queue is empty, eg. a PostgresWakeup so new test runs start right
+            away. Defaults to plain sleeping.
+        :type wakeup: django_bdd_engine.wakeup.WakeupSource
+        :param endpoints: Endpoints to spread TestDriver tests across. Each run leases the least loaded healthy endpoint
+            matching its runtime requirements, and waits in the queue while none is free.
+        :type endpoints: list of django_bdd_engine.endpoints.Endpoint
+        :param max_shards: Split the example_text rows of a Scenario Outline across up to this many endpoints from
+            the endpoints list, running them at once. It uses whichever endpoints are free when the run starts.
+        :type max_shards: int
+        :param coalesce: When a TestDriver run is claimed, also claim the queued runs with the same steps, example text
+            and runtime requirements. The test runs once, and every run in the group gets its results and its own
+            notification.
+        :type coalesce: bool
+        :param scheduler: Decides the order queued test runs are claimed in, eg. shortest expected job first or fair
+            share between users. Oldest first by default.
+        :type scheduler: django_bdd_engine.scheduling.Scheduler
+        :param preflight: Check TestDriver runs before they're given an endpoint: that the feature parses, the examples
+            table is well formed and every step has a step definition. Runs that fail are marked FAILED with the
+            problems found, without running.
+        :type preflight: bool
+        :param session_pool: Keeps webdriver sessions open between TestDriver runs and hands them to the next run that
+            asks for the same capabilities, instead of creating a session and launching the app for every run.
+        :type session_pool: django_bdd_engine.sessions.SessionPool
         """
+        setup_stage()
+
         # if there are not runners, there must be an endpoint to run against
         if not runners:
-            assert endpoint, u'DjangoBDDEngine was not given an endpoint to run tests against'
+            assert endpoint or endpoints, u'DjangoBDDEngine was not given an endpoint to run tests against'
         self.endpoint = endpoint
         self.runners = runners
-        self.tasks = []  # list of tasks to execute
+        self.registry = RunnerRegistry(runners)
+        self.lease_seconds = lease_seconds
+        self.tasks = TaskScheduler()  # tasks to execute, they run on their own threads once the engine is running
+        self.queue = TestRunQueue(scheduler=scheduler, parallelism=max(1, workers))
+        self.queue_stats_reported_at = None
+        self.reported_connection_stats = dict(connection_stats)
+        self.wakeup = wakeup or WakeupSource()
+        self.backoff = Backoff(minimum=MIN_NAPPY_TIME, maximum=NAPPY_TIME)
+
+        # test runs queue their notifications here, and this process sends them
+        self.outbox = Outbox()
+        self.add_task(OutboxSenderTask(self.outbox))
+
+        self.max_shards = max_shards
+        self.coalesce = coalesce
+        self.preflight = Preflight() if preflight else None
+        self.running = {}  # ids of the test runs running in this process, to the ids of their duplicates
+        self.session_pool = session_pool
+        self.endpoint_pool = None
+        if endpoints:
+            self.endpoint_pool = EndpointPool(endpoints)
+            self.add_task(EndpointHealthCheckTask(self.endpoint_pool))
+
+        self.pool = None
+        if workers:
+            self.pool = WorkerPool(self, workers, max_runs=max_runs_per_worker, max_memory_mb=max_worker_memory_mb)
+
+        if lease_seconds:
+            self.add_task(LeaseRenewalTask(self))
 
     def add_task(self, task):
         """
-        Adds a task to the list.
+        Adds a task to the scheduler, it's first run right away.
+        """
+        self.tasks.add(task)
+
+    def running_test_run_ids(self):
+        """
+        The ids of the test runs this engine is running, inline or in its workers, and of their duplicates.
+        """
+        test_run_ids = []
+        for test_run_id, duplicate_ids in self.running.items():
+            test_run_ids += [test_run_id] + duplicate_ids
+        for worker in (self.pool.workers if self.pool else []):
+            test_run_id = worker.test_run_id
+            if test_run_id is not None:
+                test_run_ids += [test_run_id] + worker.duplicate_ids
+        return test_run_ids
+
+    def get_runner_class(self, steps):
+        """
+        Finds the first runner class compatible with the runtime requirements in a test's steps that has capacity.
+        None means the default TestDriver.
+        """
+        return self.registry.select(steps)
+
+    def can_run(self, test_run):
+        """
+        Whether a queued test run can be dispatched now, ie. its runner isn't saturated.
+        """
+        try:
+            runner_class = self.get_runner_class(test_run.test.steps)
+            if runner_class is None and self.endpoint_pool:
+                if not self.endpoint_pool.has_capacity(self.registry.get_requirements(test_run.test.steps)):
+                    log.debug(u'no endpoint is free for test run %s, leaving it in the queue', test_run.id)
+                    return False
+        except RunnersSaturated:
+            log.debug(u'runners for test run %s are saturated, leaving it in the queue', test_run.id)
+            return False
+        except Exception:
+            pass  # let dispatch report the error
+        return True
+
+    def create_test_runner(self, runner_class, test_run_id, endpoint_lease=None):
+        if runner_class:
+            log.debug(u'creating %s runner for test run %s', runner_class, test_run_id)
+            return runner_class(engine=self, test_run_id=test_run_id)
+
+        if isinstance(endpoint_lease, EndpointLeaseGroup):
+            log.debug(u'creating ShardedTestDriver for test run %s', test_run_id)
+            return ShardedTestDriver(engine=self, test_run_id=test_run_id, endpoint_lease=endpoint_lease)
+
+        log.debug(u'creating TestDriver for test run %s', test_run_id)
+        if endpoint_lease:
+            return TestDriver(engine=self, test_run_id=test_run_id, endpoint=endpoint_lease.url, endpoint_lease=endpoint_lease)
+        return TestDriver(engine=self, test_run_id=test_run_id, endpoint=self.endpoint)
+
+    def mark_test_run_error(self, test_run_id, text):
+        """
+        Puts a test run that could not be run into the ERROR state.
+        """
+        from django_bdd.models import TestRun, ERROR
+        try:
+            test_run = with_retry(TestRun.objects.get, pk=test_run_id)
+            run_text = RunText(test_run, spill=False)
+            run_text.append(text)
+            run_text.checkpoint()
+            test_run.status = ERROR
+            with_retry(test_run.save, update_fields=[u'text', u'status'])
+        except Exception as e:
+            log.error(u'error marking test run {} as {}: {}'.format(test_run_id, ERROR, unicode(e)))
+
+    def put_back(self, test_run_id):
+        """
+        Puts a claimed test run that can't start right now back in the queue, for this or another engine to run later.
+        """
+        unclaim_test_run(test_run_id)
+        if self.lease_seconds:
+            release_lease(test_run_id)
+
+    def dispatch(self, test_run, runner_class):
+        """
+        Runs a claimed test run, in a worker if there is a worker pool. TestDriver runs lease an endpoint first, if no
+        endpoint is free the test run is put back in the queue.
+
+        :return: whether the test run was started
+        """
+        if runner_class is None and self.preflight:
+            with span(u'preflight', test_run_id=test_run.id):
+                problems = self.check_test_run(test_run)
+            if problems:
+                self.fail_preflight(test_run, problems)
+                return True
+
+        endpoint_lease = None
+        if runner_class is None and self.endpoint_pool:
+            requirements = self.registry.get_requirements(test_run.test.steps)
+            with span(u'lease endpoint', test_run_id=test_run.id):
+                endpoint_lease = self.endpoint_pool.lease(requirements)
+            if not endpoint_lease:
+                log.debug(u'no endpoint is free for test run %s, putting it back in the queue', test_run.id)
+                self.put_back(test_run.id)
+                return False
+
+            if self.max_shards:
+                endpoint_lease = self.lease_shard_endpoints(test_run, requirements, endpoint_lease)
+
+        duplicate_ids = []
+        if runner_class is None and self.coalesce:
+            try:
+                with span(u'claim duplicates', test_run_id=test_run.id):
+                    duplicate_ids = claim_duplicates(
+                        test_run,
+                        self.registry.get_requirements(test_run.test.steps),
+                        lease_seconds=self.lease_seconds
+                    )
+            except Exception as e:
+                # the duplicates claimed so far are left RUNNING, with leases they're reclaimed once those expire
+                log.error(u'error coalescing duplicates of test run {}: {}'.format(test_run.id, unicode(e)))
+            if duplicate_ids:
+                increment_metric(METRIC_ENGINE_TEST_RUNS_COALESCED, value=len(duplicate_ids))
+
+        if self.pool:
+            self.pool.dispatch(runner_class, test_run.id, endpoint_lease, duplicate_ids)
+        else:
+            self.run_test(runner_class, test_run.id, endpoint_lease, duplicate_ids)
+        return True
+
+    def check_test_run(self, test_run):
+        """
+        Runs the pre-flight checks on a test run. A check that breaks doesn't stop the run.
+
+        :return: the problems that would stop the test run from running, if any
+        """
+        try:
+            return self.preflight.check(test_run)
+        except Exception as e:
+            log.error(u'error running the pre-flight checks on test run {}: {}'.format(test_run.id, unicode(e)))
+            return []
+
+    def fail_preflight(self, test_run, problems):
+        """
+        Marks a test run that failed its pre-flight checks as FAILED, with the problems as its text.
+        """
+        from django_bdd.models import FAILED
+        log.debug(u'test run %s failed its pre-flight checks: %s', test_run.id, problems)
+        increment_metric(METRIC_ENGINE_TEST_RUN_PREFLIGHT_FAILED)
+        try:
+            run_text = RunText(test_run, spill=False)
+            run_text.append(u'The test was not run, it failed the pre-flight checks:\n' + u'\n'.join(problems) + u'\n')
+            run_text.checkpoint()
+            test_run.status = FAILED
+            test_run.duration = 0
+            with_retry(test_run.save, update_fields=[u'text', u'status', u'duration'])
+            self.outbox.put(test_run.id)
+        except Exception as e:
+            log.error(u'error marking test run {} as {}: {}'.format(test_run.id, FAILED, unicode(e)))
+        finally:
+            if self.lease_seconds:
+                release_lease(test_run.id)
+
+    def lease_shard_endpoints(self, test_run, requirements, endpoint_lease):
+        """
+        Leases more endpoints for a Scenario Outline, one per shard of its example rows, up to max_shards.
+
+        :return: an EndpointLeaseGroup if there's more than one shard, otherwise endpoint_lease
+        """
+        shards = min(self.max_shards, count_example_rows(test_run.example_text))
+        leases = [endpoint_lease]
+        while len(leases) < shards:
+            lease = self.endpoint_pool.lease(requirements)
+            if not lease:
+                break
+            leases.append(lease)
+
+        if len(leases) == 1:
+            return endpoint_lease
+        log.debug(u'sharding test run %s across %s endpoints', test_run.id, len(leases))
+        return EndpointLeaseGroup(leases)
+
+    def run_test(self, runner_class, test_run_id, endpoint_lease=None, duplicate_ids=None):
+        """
+        Creates the runner and runs the test to completion. Called from the engine loop, or from a worker process.
+        The results are then copied to the duplicates coalesced into the test run, if any.
+        """
+        self.running[test_run_id] = duplicate_ids or []
+
+        start_trace(u'test run {}'.format(test_run_id), test_run_id=test_run_id, duplicate_ids=duplicate_ids or [])
+
+        # wrap these calls, we really don't want the engine to go down
+        try:
+            with span(u'create runner', test_run_id=test_run_id):
+                test_runner = self.create_test_runner(runner_class, test_run_id, endpoint_lease)
+
+            # runs can be picked for profiling at runtime, see utility.tracing
+            test_run = getattr(test_runner, u'test_run', None)
+            profile = profile_requested(test_run_id, test_run.test_id if test_run else None)
+
+            log.debug(u'running test run %s', test_run_id)
+            try:
+                with span(u'run', test_run_id=test_run_id, runner=type(test_runner).__name__):
+                    with profiled(test_run_id, profile):
+                        test_runner.start()
+            except Exception as e:
+                self.mark_test_run_error(test_run_id, unicode(e))
+        except Exception as e:
+            log.error(u'error running test run {}, reporting metric, exception: {}'.format(test_run_id, unicode(e)))
+            increment_metric(METRIC_ENGINE_TEST_RUN_ERROR)
+            self.mark_test_run_error(test_run_id, unicode(e))
+        finally:
+            if endpoint_lease:
+                endpoint_lease.release()
+
+            # a run whose lease was lost is another engine's now, its lapsed lease is left for that engine to reclaim
+            lease_lost = self.lease_seconds and not holds_lease(test_run_id)
+            if lease_lost:
+                log.warn(u'lost the lease on test run {} while running it'.format(test_run_id))
+            if duplicate_ids:
+                with span(u'finish duplicates', test_run_id=test_run_id):
+                    self.finish_duplicates(test_run_id, duplicate_ids, lease_lost)
+            self.running.pop(test_run_id, None)
+            if self.lease_seconds and not lease_lost:
+                release_lease(test_run_id)
+            finish_trace(u'run-{}.json'.format(test_run_id))
+
+    def finish_duplicates(self, test_run_id, duplicate_ids, lease_lost=False):
+        """
+        Fans a finished test run's results out to the duplicates coalesced into it. Duplicates whose lease was lost are
+        left to the engine that took them.
+
+        :param lease_lost: whether the lease on the test run itself was lost, its results then aren't this engine's to
+            copy and the duplicates are put back in the queue instead
+        """
+        if self.lease_seconds:
+            duplicate_ids = held_leases(duplicate_ids)
+            if lease_lost:
+                for duplicate_id in duplicate_ids:
+                    self.put_back(duplicate_id)
+                return
+
+        try:
+            fan_out_results(test_run_id, duplicate_ids, self.outbox)
+        except Exception as e:
+            log.error(u'error copying the results of test run {} to its duplicates: {}'.format(test_run_id, unicode(e)))
+            for duplicate_id in duplicate_ids:
+                self.mark_test_run_error(duplicate_id, u'error copying the results of test run {}: {}'.format(test_run_id, unicode(e)))
+        finally:
+            if self.lease_seconds:
+                for duplicate_id in duplicate_ids:
+                    release_lease(duplicate_id)
+
+    def report_queue_stats(self):
+        """
+        Reports oldest wait, wait time percentiles and depth per runner type for the queue, every QUEUE_STATS_INTERVAL.
         """
-        self.tasks.append(task)
+        now = datetime.datetime.now(pytz.utc)
+        if self.queue_stats_reported_at and (now - self.queue_stats_reported_at).total_seconds() < QUEUE_STATS_INTERVAL:
+            return
+        self.queue_stats_reported_at = now
+
+        try:
+            stats = self.queue.stats(classify=lambda steps: (self.registry.compatible(steps) or [TestDriver])[0].__name__)
+        except Exception as e:
+            log.error(u'error gathering queue stats: {}'.format(unicode(e)))
+            return
+
+        log.debug(u'queue stats: %s', stats)
+        if u'oldest_wait' in stats:
+            set_metric_gauge(METRIC_ENGINE_QUEUE_OLDEST_WAIT, value=stats[u'oldest_wait'])
+            set_metric_gauge(METRIC_ENGINE_QUEUE_WAIT_P50, value=stats[u'wait_p50'])
+            set_metric_gauge(METRIC_ENGINE_QUEUE_WAIT_P90, value=stats[u'wait_p90'])
+        for runner_name, depth in stats[u'depth_by_runner'].items():
+            set_metric_gauge(METRIC_ENGINE_QUEUE_DEPTH, value=depth, dimensions={u'Runner': runner_name})
+
+    def report_connection_stats(self):
+        """
+        Reports how many times the engine had to reconnect to the db, and retry an operation, since the last loop.
+        """
+        for key, metric in ((u'reconnects', METRIC_ENGINE_DB_RECONNECTS), (u'retries', METRIC_ENGINE_DB_RETRIES)):
+            count = connection_stats[key] - self.reported_connection_stats[key]
+            if count:
+                log.debug(u'%s db %s since the last loop, reporting metric', count, key)
+                increment_metric(metric, value=count)
+                self.reported_connection_stats[key] = connection_stats[key]
+
+    def rotate_trace(self):
+        """
+        Writes out the engine loop's trace and starts a new one every ENGINE_TRACE_INTERVAL, if tracing is on.
+        """
+        if not trace_dir():
+            return
+
+        trace = current_trace()
+        if trace is not None:
+            if time.time() - trace.started_at < ENGINE_TRACE_INTERVAL:
+                return
+            finish_trace(u'engine-{}-{}.json'.format(os.getpid(), int(trace.started_at)))
+        start_trace(u'engine', pid=os.getpid())
+
+    def nap(self):
+        """
+        Wait for a new test run to be announced, for at most the current backoff time.
+        """
+        nap_time = self.backoff.next()
+        log.debug(u'sleeping for up to %s seconds before pinging db again', nap_time)
+        with span(u'nap', seconds=nap_time):
+            woken = self.wakeup.wait(nap_time)
+        if woken:
+            log.debug(u'woken up by a new test run announcement')
+            self.backoff.reset()
 
     def run(self):
         """
         Run an infinite loop pinging the database for new tests.
         """
+        from django_bdd.models import NEW
         log.debug(u'engine is now running')
 
-        while True:
-            engine_loop_start = datetime.datetime.now(pytz.utc)
+        # logging handlers can run on a thread of their own rather than the engine's, workers inherit it
+        if getattr(settings, u'DJANGO_BDD_ENGINE_ASYNC_LOGGING', False):
+            start_async_logging()
 
-            # run all tasks that need to be performed
-            log.debug(u'{} tasks need to be run'.format(len(self.tasks)))
-            tasks_to_remove = []
-            for task in self.tasks:
-                log.debug(u'running task: {}'.format(task))
+        if self.pool:
+            self.pool.start()
 
-                try:
-                    task.update()
-                    if task.done:
-                        tasks_to_remove.append(task)
-                except Exception as e:
-                    tasks_to_remove.append(task)
-                    error_message = u'exception when running task.update: {}'.format(unicode(e))
-                    log.error(error_message)
-                    email_log.error(error_message)
+        # tasks run alongside the loop, so long test runs and slow tasks don't hold each other up
+        self.tasks.start()
+
+        while True:
+            engine_loop_start = datetime.datetime.now(pytz.utc)
+            self.rotate_trace()
 
-            # and then remove any tasks that are done
-            for task in tasks_to_remove:
-                self.tasks.remove(task)
+            # collect test runs the workers have finished
+            if self.pool:
+                with span(u'collect workers'):
+                    self.pool.wait()
 
             # ping db to see if there are any new tests
             log.debug(u'pinging database for new tests')
 
             # report the engine heartbeat metric
-            put_metric_data(METRIC_ENGINE_HEARTBEAT, value=1)
+            increment_metric(METRIC_ENGINE_HEARTBEAT)
 
             # query db, order by least -> most recent requested test runs for justice
             try:
+                if self.lease_seconds:
+                    with span(u'reclaim expired'):
+                        reclaim_expired_test_runs()
+
                 start_time = datetime.datetime.now(pytz.utc)
-                new_test_runs = TestRun.objects.filter(status=NEW).order_by(u'pk')
+                with span(u'count queue'):
+                    queue_count = with_retry(self.queue.count)
                 end_time = datetime.datetime.now(pytz.utc)
                 total_seconds = (end_time - start_time).total_seconds()
 
                 # report the query time metric
-                log.debug(u'queried test runs in {} seconds, reporting metric'.format(total_seconds))
+                log.debug(u'queried test runs in %s seconds, reporting metric', total_seconds)
                 put_metric_data(METRIC_ENGINE_NEW_TEST_QUERY_DURATION, value=total_seconds)
             except:
                 log.error(u'new test run query failed')
-                log.debug(u'HACK closing connection to make django re-open it again')
+                log.debug(u'resetting the connection to make django re-open it again')
                 log.error(u'engine runtime metric is being dropped')  # TODO: make this continue play nice with metrics
-                connection.close()
+                reset_connection()
                 continue
 
             # report the test queue length metric
-            queue_length = len(new_test_runs) - 1
+            queue_length = queue_count - 1
             queue_length = queue_length if queue_length >= 0 else 0
-            log.debug(u'found {} {} test runs, queue_length is {}, reporting metric'.format(len(new_test_runs), NEW, queue_length))
-            put_metric_data(METRIC_ENGINE_TEST_QUEUE, value=queue_length)
+            log.debug(u'found %s %s test runs, queue_length is %s, reporting metric', queue_count, NEW, queue_length)
+            set_metric_gauge(METRIC_ENGINE_TEST_QUEUE, value=queue_length)
+            with span(u'queue stats'):
+                self.report_queue_stats()
 
-            # if there are any runs, grab the first and run it
+            # if there are any runs, claim the first one no other engine has taken and run it
             test_runner_start = datetime.datetime.now(pytz.utc)
-            if new_test_runs:
-                # run the first test
-                test_run = new_test_runs[0]
+            test_run = None
+            if queue_count and (not self.pool or self.pool.has_idle_worker()):
+                try:
+                    with span(u'claim'):
+                        test_run = self.queue.claim_next(lease_seconds=self.lease_seconds, can_run=self.can_run)
+                except Exception as e:
+                    # claiming isn't idempotent so it isn't retried, the run is picked up on the next loop
+                    log.error(u'claiming a test run failed: {}'.format(unicode(e)))
+                    reset_connection()
+
+            if test_run:
                 test_run_id = test_run.id
+                self.backoff.reset()
 
-                # wrap these calls, we really don't want the engine to go down
                 try:
-                    test_runtime_requirements = get_runtime_requirements_from_steps(test_run.test.steps)
-
-                    test_runner = None
-                    for runner in self.runners:
-                        if runner.is_compatible(test_runtime_requirements):
-                            log.debug(u'creating {} runner for test run {}'.format(runner, test_run_id))
-                            test_runner = runner(engine=self, test_run_id=test_run_id)
-                    if not test_runner:
-                        log.debug(u'creating TestDriver for test run {}'.format(test_run_id))
-                        test_runner = TestDriver(engine=self, test_run_id=test_run_id, endpoint=self.endpoint)
-
-                    log.debug(u'running test run {}'.format(test_run_id))
-                    try:
-                        test_runner.start()
-                    except Exception as e:
-                        connection.close()  # HACK: make sure the db connection works
-                        test_run = TestRun.objects.get(pk=test_run_id)
-                        test_run.text += unicode(e)
-                        test_run.status = ERROR
-                        test_run.save()
+                    with span(u'select runner', test_run_id=test_run_id):
+                        runner_class = self.get_runner_class(test_run.test.steps)
+                except RunnersSaturated:
+                    # its runners filled up since it was claimed, it waits its turn like the runs can_run skipped
+                    log.debug(u'runners for test run %s are saturated, putting it back in the queue', test_run_id)
+                    self.put_back(test_run_id)
+                    test_run = None
                 except Exception as e:
-                    log.error(u'error running test run {}, reporting metric, exception: {}'.format(test_run_id, unicode(e)))
-                    put_metric_data(METRIC_ENGINE_TEST_RUN_ERROR, value=1)
+                    log.error(u'error finding a runner for test run {}, reporting metric, exception: {}'.format(test_run_id, unicode(e)))
+                    increment_metric(METRIC_ENGINE_TEST_RUN_ERROR)
+                    self.mark_test_run_error(test_run_id, unicode(e))
+                    if self.lease_seconds:
+                        release_lease(test_run_id)
+                else:
+                    with span(u'dispatch', test_run_id=test_run_id, runner=getattr(runner_class, u'__name__', None)):
+                        dispatched = self.dispatch(test_run, runner_class)
+                    if not dispatched:
+                        test_run = None  # nothing ran, so nap as if the queue were empty
             test_runner_end = datetime.datetime.now(pytz.utc)
             engine_loop_end = datetime.datetime.now(pytz.utc)
             engine_execution_time_sans_test = (engine_loop_end - engine_loop_start).total_seconds() - (test_runner_end - test_runner_start).total_seconds()
-            log.debug(u'engine loop complete in {} seconds, reporting metric'.format(engine_execution_time_sans_test))
+            log.debug(u'engine loop complete in %s seconds, reporting metric', engine_execution_time_sans_test)
             put_metric_data(METRIC_ENGINE_EXECUTION_TIME_SANS_TEST, value=engine_execution_time_sans_test)
+            self.report_connection_stats()
+
+            if self.pool:
+                self.pool.report_utilisation()
+
+                # wait while every worker is busy, a finishing worker ends the wait early
+                if not self.pool.has_idle_worker():
+                    log.debug(u'waiting up to %s seconds for a worker before pinging db again', NAPPY_TIME)
+                    with span(u'wait for a worker'):
+                        self.pool.wait(NAPPY_TIME)
+                elif not test_run:
+                    self.nap()
 
-            # only sleep if there weren't any new test runs
-            if not new_test_runs:
-                log.debug(u'sleeping for {} seconds before pinging db again'.format(NAPPY_TIME))
-                time.sleep(NAPPY_TIME)
+            # only sleep if there weren't any new test runs this engine could claim
+            elif not test_run:
+                self.nap()
 
 
 if __name__ == u'__main__':
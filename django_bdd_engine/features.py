@@ -0,0 +1,131 @@
+import os
+import atexit
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from django_bdd_engine.utility.lru import LRUCache
+
+
+log = logging.getLogger(u'django-bdd')
+
+FEATURE_CACHE_SIZE = 200  # number of compiled features kept on disk per process
+FEATURE_FILE_NAME = u'test.feature'
+
+
+def fingerprint(*parts):
+    """
+    :return: a sha1 of the text parts, which are kept apart so that moving
+        text from one to the next changes it
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode(u'utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def feature_fingerprint(name, steps, example_text):
+    return fingerprint(name, steps, example_text or u'')
+
+
+def build_feature_text(name, steps, example_text):
+    """Turn a test's steps, and a test run's examples, into a feature file.
+    """
+    parts = []
+
+    # if the feature has not been explicitly defined, create a Feature: entry at the top of the file
+    if 'Feature:' not in steps:
+        parts.append(u'Feature: {}\r\n'.format(name))
+
+    # if it's a scenario, there are no examples
+    # if it's a scenario outline, Examples: should be present
+    # http://jenisys.github.io/behave.example/tutorials/tutorial04.html
+
+    # if the user has not explicitly defined a Scenario: or Scenario Outline section, detect which one should be created
+    if 'Scenario:' not in steps and 'Scenario Outline:' not in steps:
+        if 'Examples:' in steps:
+            log.debug('examples detected in steps, writing scenario outline to feature file')
+            scenario_header = u'Scenario Outline: {}\r\n'
+        elif example_text:
+            log.debug('examples detected in test run example_text, writing scenario outline to feature file')
+            scenario_header = u'Scenario Outline: {}\r\n'
+        else:
+            log.debug('writing normal scenario to feature file')
+            scenario_header = u'Scenario: {}\r\n'
+
+        # write the scenario header to the feature file text
+        parts.append(scenario_header.format(name))
+
+    parts.append(steps)
+    parts.append(u'\r\n\r\n')  # add some space at the end of the file
+
+    # if example text exists in the test run, write an 'Examples:' section
+    # with the text that is present in the db
+    if example_text:
+        parts.append(u'Examples:\r\n')
+        parts.append(example_text)
+
+    return u''.join(parts)
+
+
+class FeatureCache(object):
+    """Compiled feature files, kept on disk in a folder per feature so a test
+    that's run again is handed to behave without building and writing it
+    again. Keyed by a hash of the test name, steps and example text, and
+    bounded: the least recently used folders are removed.
+
+    The folders belong to the process that made them, a forked process starts
+    its own cache.
+    """
+
+    def __init__(self, size=FEATURE_CACHE_SIZE):
+        self.size = size
+        self.root = None
+        self.pid = None
+        self.features = None
+
+    def _remove(self, fingerprint, entry):
+        shutil.rmtree(entry[0], ignore_errors=True)
+
+    def get(self, name, steps, example_text):
+        """
+        :return: (feature_dir, feature_text), the folder holds a single feature
+            file and mustn't be changed or removed by the caller
+        """
+        if self.pid != os.getpid():
+            self.root = tempfile.mkdtemp(prefix=u'django-bdd-engine-features-')
+            self.pid = os.getpid()
+            self.features = LRUCache(self.size, on_evict=self._remove)
+
+        fingerprint = feature_fingerprint(name, steps, example_text)
+        entry = self.features.get(fingerprint)
+        if entry is not None:
+            log.debug(u'using cached feature %s', fingerprint)
+            return entry
+
+        feature_text = build_feature_text(name, steps, example_text)
+        feature_dir = os.path.join(self.root, fingerprint)
+        if not os.path.isdir(feature_dir):
+            os.makedirs(feature_dir)
+
+        log.debug(u'writing to feature file:\r\n%s', feature_text)
+        with open(os.path.join(feature_dir, FEATURE_FILE_NAME), u'wb') as f:
+            f.write(feature_text.encode(u'utf8'))
+
+        entry = (feature_dir, feature_text)
+        self.features.set(fingerprint, entry)
+        return entry
+
+    def clear(self):
+        """Remove this process's cached features.
+        """
+        if self.pid == os.getpid():
+            self.features.clear()
+            shutil.rmtree(self.root, ignore_errors=True)
+        self.root = self.pid = self.features = None
+
+
+feature_cache = FeatureCache()
+atexit.register(feature_cache.clear)
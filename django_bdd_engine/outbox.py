@@ -0,0 +1,230 @@
+import os
+import json
+import errno
+import time
+import uuid
+import logging
+
+from django.conf import settings
+
+from django_bdd_engine.tasks.task import Task
+from django_bdd_engine.utility.db import with_retry
+
+
+log = logging.getLogger(u'django-bdd')
+
+OUTBOX_SEND_INTERVAL = 5  # how often the outbox is checked for notifications to send (seconds)
+OUTBOX_BATCH_SIZE = 50  # most notifications sent per check
+OUTBOX_MAX_ATTEMPTS = 8  # notifications that failed this many times are moved to the outbox's failed folder
+OUTBOX_RETRY_DELAY = 30  # wait before the first retry of a notification, doubled for every later one (seconds)
+OUTBOX_DEFAULT_DIR = u'~/.django-bdd-engine/outbox'  # outbox folder without the setting, somewhere reboots don't clear
+OUTBOX_CLAIM_TIMEOUT = 600  # a claimed notification that's still not sent after this long is put back (seconds)
+CLAIM_SEPARATOR = u'.sending.'  # a claimed entry is renamed to its name, this and the pid of the process sending it
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Outbox(object):
+    """A folder of notifications waiting to be sent, one json file each, so
+    they survive the engine restarting. Files are named by when they were
+    queued, so they're sent in that order. Any process on the host can queue
+    a notification, the engine's OutboxSenderTask sends them.
+
+    Several engines on a host share the outbox, so an entry is claimed by
+    renaming it before it's sent, and only one of them gets to. Claims of
+    processes that exited, or that are older than OUTBOX_CLAIM_TIMEOUT, are
+    put back by recover().
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: the outbox folder, the DJANGO_BDD_ENGINE_OUTBOX_DIR setting
+            or OUTBOX_DEFAULT_DIR by default. it has to outlive the engine, so
+            not in the temp dir, which the os may clear when it restarts.
+        """
+        self.path = path or getattr(settings, u'DJANGO_BDD_ENGINE_OUTBOX_DIR', None) or \
+            os.path.expanduser(OUTBOX_DEFAULT_DIR)
+        self.failed_path = os.path.join(self.path, u'failed')
+
+    def _write(self, name, entry):
+        # write then rename, so a crash never leaves half an entry
+        if not os.path.isdir(self.failed_path):
+            try:
+                os.makedirs(self.failed_path)
+            except OSError:
+                pass  # created by another process in the meantime
+        temp_path = os.path.join(self.path, u'.' + name)
+        with open(temp_path, u'w') as f:
+            json.dump(entry, f)
+        os.rename(temp_path, os.path.join(self.path, name))
+
+    def put(self, test_run_id):
+        """Queue the notification for a finished test run.
+        """
+        name = u'{:.6f}-{}-{}.json'.format(time.time(), test_run_id, uuid.uuid4().hex)
+        self._write(name, {u'test_run_id': test_run_id, u'attempts': 0, u'send_after': 0})
+        log.debug(u'queued notification for test run %s in %s', test_run_id, self.path)
+
+    def pending(self, limit=OUTBOX_BATCH_SIZE):
+        """
+        :return: up to limit (name, entry) tuples that are due to be sent, oldest first
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        now = time.time()
+        due = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(u'.json') or name.startswith(u'.'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    entry = json.load(f)
+            except (IOError, ValueError) as e:
+                log.error(u'skipping unreadable outbox entry {}: {}'.format(name, unicode(e)))
+                continue
+
+            if entry[u'send_after'] <= now:
+                due.append((name, entry))
+                if len(due) >= limit:
+                    break
+        return due
+
+    def claim(self, name):
+        """Take an entry for this process to send.
+
+        :return: (claimed name, entry) to pass to sent, retry or release, or
+            None if another process claimed or sent it first, or it isn't due
+            any more
+        """
+        claimed = u'{}{}{}'.format(name, CLAIM_SEPARATOR, os.getpid())
+        try:
+            os.rename(os.path.join(self.path, name), os.path.join(self.path, claimed))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        # another process may have retried it since it was listed
+        with open(os.path.join(self.path, claimed)) as f:
+            entry = json.load(f)
+        if entry[u'send_after'] > time.time():
+            self.release(claimed)
+            return None
+        return claimed, entry
+
+    def release(self, claimed):
+        """Put a claimed entry back as it was.
+        """
+        os.rename(os.path.join(self.path, claimed), os.path.join(self.path, claimed.split(CLAIM_SEPARATOR)[0]))
+
+    def recover(self):
+        """Put back the entries claimed by processes that exited, or that have
+        been claimed for longer than OUTBOX_CLAIM_TIMEOUT.
+        """
+        if not os.path.isdir(self.path):
+            return
+
+        now = time.time()
+        for claimed in os.listdir(self.path):
+            name, separator, pid = claimed.partition(CLAIM_SEPARATOR)
+            if not separator or name.startswith(u'.'):
+                continue
+            try:
+                if _process_exists(int(pid)) and now - os.path.getmtime(os.path.join(self.path, claimed)) < OUTBOX_CLAIM_TIMEOUT:
+                    continue
+                log.warn(u'putting back outbox entry {} claimed by process {}'.format(name, pid))
+                self.release(claimed)
+            except (OSError, ValueError) as e:
+                log.error(u'error recovering outbox entry {}: {}'.format(claimed, unicode(e)))
+
+    def sent(self, claimed):
+        os.remove(os.path.join(self.path, claimed))
+
+    def retry(self, claimed, entry):
+        """Put a notification that couldn't be sent back, to be tried again
+        after an exponential backoff, or give up on it.
+        """
+        name = claimed.split(CLAIM_SEPARATOR)[0]
+        entry[u'attempts'] += 1
+        if entry[u'attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            log.error(u'giving up on notification for test run {} after {} attempts'.format(entry[u'test_run_id'], entry[u'attempts']))
+            os.rename(os.path.join(self.path, claimed), os.path.join(self.failed_path, name))
+            return
+
+        # rewritten while still claimed, then put back in one rename
+        entry[u'send_after'] = time.time() + OUTBOX_RETRY_DELAY * 2 ** (entry[u'attempts'] - 1)
+        self._write(claimed, entry)
+        self.release(claimed)
+
+
+class OutboxSenderTask(Task):
+    """Engine task that sends the notifications in the outbox, in batches.
+    Errors are logged and the batch is tried again next time, the scheduler
+    would drop the task otherwise.
+    """
+
+    def __init__(self, outbox=None, interval=OUTBOX_SEND_INTERVAL):
+        super(OutboxSenderTask, self).__init__(interval=interval)
+        self.outbox = outbox or Outbox()
+
+    def update(self):
+        try:
+            self.send_due()
+        except Exception as e:
+            log.error(u'error sending the notifications in the outbox: {}'.format(unicode(e)))
+
+    def send_due(self):
+        from django_bdd.models import TestRun
+
+        self.outbox.recover()
+        due = self.outbox.pending()
+        if not due:
+            return
+
+        test_runs = with_retry(TestRun.objects.in_bulk, [entry[u'test_run_id'] for name, entry in due])
+        for name, entry in due:
+            claimed = None
+            try:
+                claim = self.outbox.claim(name)
+                if claim is None:
+                    continue
+                claimed, entry = claim
+                self.send(claimed, entry, test_runs.get(entry[u'test_run_id']))
+            except (IOError, OSError, ValueError) as e:
+                # the rest of the batch can still be sent, this one is tried again next time
+                log.error(u'error updating outbox entry {}: {}'.format(name, unicode(e)))
+                if claimed:
+                    self.release(claimed)
+
+    def release(self, claimed):
+        try:
+            self.outbox.release(claimed)
+        except OSError as e:
+            log.error(u'error putting back outbox entry {}, it is put back once it times out: {}'.format(claimed, unicode(e)))
+
+    def send(self, claimed, entry, test_run):
+        """
+        :param claimed: the name of the entry, claimed by this process
+        """
+        from django_bdd.notifications import notify
+
+        if test_run is None:
+            log.warn(u'dropping notification for test run {}, it no longer exists'.format(entry[u'test_run_id']))
+            self.outbox.sent(claimed)
+            return
+
+        try:
+            log.debug(u'sending notification email to test run user: %s', test_run.user)
+            notify(test_run)
+        except Exception as e:
+            log.error(u'error sending notification for test run {}: {}'.format(test_run.id, unicode(e)))
+            self.outbox.retry(claimed, entry)
+        else:
+            self.outbox.sent(claimed)
@@ -0,0 +1,181 @@
+import os
+import re
+import logging
+
+from django.conf import settings
+
+from django_bdd_engine.features import build_feature_text, feature_fingerprint
+from django_bdd_engine.sharding import split_example_tables
+from django_bdd_engine.utility.lru import LRUCache
+
+
+log = logging.getLogger(u'django-bdd')
+
+PREFLIGHT_CACHE_SIZE = 1000  # number of checked features to remember the problems of
+STEP_MATCH_CACHE_SIZE = 10000  # number of step texts to remember whether a step definition matches
+
+PLACEHOLDER = re.compile(u'<([^<>]+)>')
+
+
+def split_table_row(line):
+    return [cell.strip() for cell in line.strip().strip(u'|').split(u'|')]
+
+
+def check_example_text(steps, example_text):
+    """Check a test run's examples tables are well formed, and each has a
+    column for every placeholder in the steps.
+
+    :return: the problems found, if any
+    :rtype: list
+    """
+    if not example_text or not example_text.strip():
+        return []
+
+    tables = split_example_tables(example_text)
+    if tables is None:
+        return [u'the example text is not a table, it needs a header row and at least one row of values']
+
+    problems = []
+    placeholders = set(PLACEHOLDER.findall(steps))
+    for index, (header, rows) in enumerate(tables, start=1):
+        name = u'the examples table' if len(tables) == 1 else u'examples table {}'.format(index)
+        headings = split_table_row(header)
+        if not all(headings):
+            problems.append(u'{} header has an empty column name: {}'.format(name, header))
+        duplicates = sorted(set(heading for heading in headings if headings.count(heading) > 1))
+        if duplicates:
+            problems.append(u'{} header repeats the column {}'.format(name, u', '.join(duplicates)))
+
+        for num, row in enumerate(rows, start=1):
+            cells = split_table_row(row)
+            if len(cells) != len(headings):
+                problems.append(u'{} row {} has {} cells, the header has {}: {}'.format(name, num, len(cells), len(headings), row))
+
+        missing = sorted(placeholders - set(headings))
+        if missing and u'Examples:' not in steps:
+            problems.append(u'the steps use <{}>, which {} has no column for'.format(u'>, <'.join(missing), name))
+    return problems
+
+
+def builtin_step_dirs():
+    """
+    :return: the folders of step definitions goh_behave always loads
+    """
+    try:
+        import mobilebdd
+    except ImportError:
+        return []
+    steps_dir = os.path.join(os.path.dirname(mobilebdd.__file__), u'steps')
+    return [steps_dir] if os.path.isdir(steps_dir) else []
+
+
+class StepIndex(object):
+    """The step definitions behave would run steps with, by step type. The
+    definitions are loaded once, and whether a step text matches one is
+    remembered.
+    """
+
+    def __init__(self, step_dirs, cache_size=STEP_MATCH_CACHE_SIZE):
+        """
+        :param step_dirs: folders of step definition modules
+        """
+        self.step_dirs = step_dirs
+        self.steps = None  # step type -> step definitions
+        self.matches = LRUCache(cache_size)
+
+    def load(self):
+        """Load the step definition modules, without leaving their step
+        definitions in behave's registry: behave runs in this process when
+        the engine has no workers, and loads them itself.
+        """
+        from behave.runner import exec_file
+        from behave.step_registry import registry
+
+        registered = dict((step_type, list(definitions)) for step_type, definitions in registry.steps.items())
+        try:
+            for step_dir in self.step_dirs:
+                for name in sorted(os.listdir(step_dir)):
+                    if name.endswith(u'.py'):
+                        exec_file(os.path.join(step_dir, name), {})
+            self.steps = dict((step_type, list(definitions)) for step_type, definitions in registry.steps.items())
+        finally:
+            for step_type, definitions in registry.steps.items():
+                definitions[:] = registered.get(step_type, [])
+
+        log.debug(u'indexed %s step definitions from %s', sum(len(d) for d in self.steps.values()), self.step_dirs)
+
+    def match(self, step_type, name):
+        """
+        :return: whether a step definition matches the step, like behave's
+            registry, ie. definitions of the step's type or of any type
+        """
+        if self.steps is None:
+            self.load()
+
+        key = (step_type, name)
+        matched = self.matches.get(key)
+        if matched is None:
+            definitions = self.steps.get(step_type, []) + self.steps.get(u'step', [])
+            matched = any(definition.match(name) for definition in definitions)
+            self.matches.set(key, matched)
+        return matched
+
+
+class Preflight(object):
+    """Checks a TestDriver run before it's given a device: that its feature
+    parses, its examples table is well formed, and every step has a step
+    definition. The problems found are remembered per feature.
+    """
+
+    def __init__(self, step_dirs=None, cache_size=PREFLIGHT_CACHE_SIZE):
+        """
+        :param step_dirs: folders of step definitions to match steps against,
+            defaults to goh_behave's own and DJANGO_BDD_ENGINE_STEP_DIRS.
+            steps aren't matched when there are none.
+        """
+        if step_dirs is None:
+            step_dirs = builtin_step_dirs() + list(getattr(settings, u'DJANGO_BDD_ENGINE_STEP_DIRS', []))
+        if not step_dirs:
+            log.warn(u'no step definitions were found, pre-flight checks will not match steps')
+        self.step_index = StepIndex(step_dirs) if step_dirs else None
+        self.problems = LRUCache(cache_size)
+
+    def check(self, test_run):
+        """
+        :return: the problems that would stop the test run from running, if any
+        :rtype: list
+        """
+        name, steps, example_text = test_run.test.name, test_run.test.steps, test_run.example_text
+        fingerprint = feature_fingerprint(name, steps, example_text)
+        problems = self.problems.get(fingerprint)
+        if problems is None:
+            problems = self.check_feature(name, steps, example_text)
+            self.problems.set(fingerprint, problems)
+        return problems
+
+    def check_feature(self, name, steps, example_text):
+        from behave.parser import parse_feature, ParserError
+
+        problems = check_example_text(steps, example_text)
+        if problems:
+            return problems
+
+        try:
+            feature = parse_feature(build_feature_text(name, steps, example_text), filename=u'test.feature')
+        except ParserError as e:
+            return [u'the steps could not be parsed: {}'.format(unicode(e))]
+        if feature is None:
+            return [u'there are no steps']
+
+        if self.step_index is None:
+            return problems
+
+        undefined = []
+        for scenario in feature.walk_scenarios():
+            for step in list(scenario.background_steps) + list(scenario.steps):
+                text = u'{} {}'.format(step.keyword, step.name)
+                if text not in undefined and not self.step_index.match(step.step_type, step.name):
+                    undefined.append(text)
+        for text in undefined:
+            problems.append(u'no step definition matches the step "{}"'.format(text))
+        return problems
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+
+from django_bdd_engine.utility.lru import LRUCache
+
+
+log = logging.getLogger(u'django-bdd')
+
+REQUIREMENTS_CACHE_SIZE = 1000  # number of parsed runtime requirements to remember
+
+
+class RunnersSaturated(Exception):
+    """Raised when there are runners compatible with a test, but none of them
+    have capacity to run it right now.
+    """
+    pass
+
+
+class RunnerRegistry(object):
+    """Picks the runner class for a test. Runtime requirements are parsed once
+    per distinct set of steps, and runners are indexed by the requirement values
+    they declare so only plausible ones are asked whether they're compatible.
+    """
+
+    def __init__(self, runners=None, cache_size=REQUIREMENTS_CACHE_SIZE):
+        """
+        :param runners: runner classes, in order of preference
+        """
+        self.runners = list(runners or [])
+        self.requirements_cache = LRUCache(cache_size)
+
+        # (requirement key, value) -> runners declaring that value
+        self.index = {}
+        for runner in self.runners:
+            for key, values in getattr(runner, u'requirements', {}).items():
+                for value in values:
+                    self.index.setdefault((key, value), []).append(runner)
+
+    def get_requirements(self, steps):
+        """
+        :return: the runtime requirements in a test's steps
+        :rtype: dict
+        """
+        from mobilebdd.environment import get_runtime_requirements_from_steps
+
+        key = hashlib.sha1(steps.encode(u'utf8')).hexdigest()
+        requirements = self.requirements_cache.get(key)
+        if requirements is None:
+            requirements = get_runtime_requirements_from_steps(steps)
+            self.requirements_cache.set(key, requirements)
+        return requirements
+
+    def compatible(self, steps):
+        """
+        :return: the runner classes compatible with a test's steps, in order of preference
+        :rtype: list
+        """
+        requirements = self.get_requirements(steps)
+
+        # count how many of each runner's declared requirements the test matches
+        matches = {}
+        for key, value in requirements.items():
+            try:
+                indexed = self.index.get((key, value), [])
+            except TypeError:
+                continue  # unhashable requirement values can't be indexed
+            for runner in indexed:
+                matches[runner] = matches.get(runner, 0) + 1
+
+        compatible = []
+        for runner in self.runners:
+            declared = getattr(runner, u'requirements', {})
+            if declared and matches.get(runner, 0) < len(declared):
+                continue
+            if runner.is_compatible(requirements):
+                compatible.append(runner)
+        return compatible
+
+    def select(self, steps):
+        """Pick the first compatible runner with capacity.
+
+        :return: a runner class, or None if no runner is compatible and the
+            default TestDriver should run the test
+        :raises RunnersSaturated: if compatible runners exist but are all full
+        """
+        compatible = self.compatible(steps)
+        for runner in compatible:
+            if not hasattr(runner, u'has_capacity') or runner.has_capacity():
+                return runner
+
+        if compatible:
+            raise RunnersSaturated(u'all compatible runners are at capacity: {}'.format(compatible))
+        return None
@@ -2,6 +2,11 @@
 
 class TestRunner(object):
 
+    # runtime requirement values this runner can handle, eg. {u'os_type': [u'android']}. the runner registry only
+    # asks runners whose declared requirements all match a test whether they're compatible with it, so declaring
+    # them keeps dispatch fast with many runners. runners that declare nothing are always asked.
+    requirements = {}
+
     def __init__(self, engine, **kwargs):
         # the engine has a list of miscellaneous tasks to run, and add_task(task) can be used to add one
         self.engine = engine
@@ -27,6 +32,16 @@ class TestRunner(object):
         """
         return False
 
+    @classmethod
+    def has_capacity(cls):
+        """
+        Runners that can only run so many tests at once, eg. on a fixed set of devices, should override this to
+        return False while they're saturated. The engine leaves compatible tests in the queue until then.
+
+        :rtype: bool
+        """
+        return True
+
     def start(self):
         """
         Called by the Engine when the test should start.
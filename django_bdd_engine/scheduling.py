@@ -0,0 +1,235 @@
+import time
+import logging
+import datetime
+import pytz  # timezone support: datetime.datetime.now(pytz.utc)
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Count
+
+from django_bdd_engine.utility.lru import LRUCache
+
+
+log = logging.getLogger(u'django-bdd')
+
+SCHEDULE_REFRESH_INTERVAL = 5  # how long an ordered window of queued test runs is used before it's fetched again (seconds)
+DEFAULT_EXPECTED_DURATION = 120  # expected duration of a test that hasn't finished a run yet (seconds)
+DURATION_HISTORY_MAX_AGE = 600  # how long a test's duration statistics are used before they're queried again (seconds)
+DURATION_HISTORY_SIZE = 5000  # number of tests to keep duration statistics for
+FIRST_SEEN_SIZE = 10000  # number of queued test runs to remember the first sighting of
+DEFAULT_AGING = 1.0  # seconds of expected duration forgiven per second spent waiting
+
+ETA_KEY_TEMPLATE = u'django-bdd-engine-eta-{test_run_id}'
+
+
+def _user_key(test_run):
+    return getattr(test_run, u'user_id', None) or test_run.user
+
+
+def get_eta(test_run_id):
+    """The schedule's estimate for a queued test run, for eg. the ui.
+
+    :return: a dict with expected_start and eta (unix timestamps), or None if
+        the run hasn't been scheduled by an engine with a duration history
+    """
+    return cache.get(ETA_KEY_TEMPLATE.format(test_run_id=test_run_id))
+
+
+class DurationHistory(object):
+    """Expected test durations, the mean duration of each test's finished runs.
+    Statistics are fetched for many tests in one aggregate query and kept for
+    max_age seconds.
+    """
+
+    def __init__(self, size=DURATION_HISTORY_SIZE, max_age=DURATION_HISTORY_MAX_AGE, default=DEFAULT_EXPECTED_DURATION):
+        self.cache = LRUCache(size)  # test id -> (mean duration, fetched at)
+        self.max_age = max_age
+        self.default = default
+
+    def expected_durations(self, test_ids):
+        """
+        :return: dict of test id to expected duration (seconds)
+        :rtype: dict
+        """
+        from django_bdd.models import TestRun, FAILED, PASSED
+
+        now = time.time()
+        durations = {}
+        stale = set()
+        for test_id in test_ids:
+            entry = self.cache.get(test_id)
+            if entry is None or now - entry[1] >= self.max_age:
+                stale.add(test_id)
+            else:
+                durations[test_id] = entry[0]
+
+        if stale:
+            rows = TestRun.objects.filter(
+                test_id__in=stale,
+                status__in=(PASSED, FAILED),
+                duration__isnull=False
+            ).order_by().values(u'test_id').annotate(mean=Avg(u'duration'), runs=Count(u'pk'))
+            for row in rows:
+                durations[row[u'test_id']] = row[u'mean']
+                self.cache.set(row[u'test_id'], (row[u'mean'], now))
+
+            for test_id in stale - set(durations):
+                durations[test_id] = self.default
+                self.cache.set(test_id, (self.default, now))
+        return durations
+
+
+class Scheduler(object):
+    """Decides the order queued test runs are claimed in. Schedulers are
+    handed a window of the oldest queued runs and sort it, this one keeps them
+    oldest first.
+
+    With a duration history, each ordering also publishes an expected start
+    time and ETA for the runs in the window, see get_eta().
+    """
+
+    refresh_interval = SCHEDULE_REFRESH_INTERVAL
+
+    def __init__(self, history=None):
+        self.history = history
+        self.first_seen = LRUCache(FIRST_SEEN_SIZE)  # test run id -> when the scheduler first saw it queued
+        self.expected = {}  # test id -> expected duration, for the window being ordered
+
+    def wait_seconds(self, test_run, now):
+        """How long a test run has been queued. Read from the field named by
+        the DJANGO_BDD_ENGINE_QUEUED_AT_FIELD setting if there is one,
+        otherwise counted from when this scheduler first saw the run.
+        """
+        queued_at_field = getattr(settings, u'DJANGO_BDD_ENGINE_QUEUED_AT_FIELD', None)
+        queued_at = getattr(test_run, queued_at_field) if queued_at_field else None
+        if queued_at:
+            return max(0, (datetime.datetime.now(pytz.utc) - queued_at).total_seconds())
+
+        first_seen = self.first_seen.get(test_run.id)
+        if first_seen is None:
+            first_seen = now
+            self.first_seen.set(test_run.id, first_seen)
+        return now - first_seen
+
+    def expected_duration(self, test_run):
+        return self.expected.get(test_run.test_id, self.history.default if self.history else DEFAULT_EXPECTED_DURATION)
+
+    def prepare(self, test_runs, now):
+        """Gather whatever key() needs about the window in as few queries as possible.
+        """
+        if self.history:
+            self.expected = self.history.expected_durations(set(test_run.test_id for test_run in test_runs))
+
+    def key(self, test_run, now):
+        """
+        :return: the sort key of a queued test run, lowest is claimed first
+        """
+        return test_run.pk
+
+    def order(self, test_runs, parallelism=1):
+        """
+        :param test_runs: a window of queued test runs, oldest first
+        :param parallelism: how many test runs the engine runs at once, for the ETAs
+        :return: the test runs in the order they should be claimed
+        :rtype: list
+        """
+        now = time.time()
+        self.prepare(test_runs, now)
+        ordered = sorted(test_runs, key=lambda test_run: self.key(test_run, now))
+        if self.history:
+            self.publish_etas(ordered, parallelism, now)
+        return ordered
+
+    def publish_etas(self, ordered, parallelism, now):
+        """Store each run's expected start time and ETA in the django cache,
+        assuming the runs ahead of it are spread evenly across the engine's
+        parallelism.
+        """
+        etas = {}
+        ahead = 0.0
+        for test_run in ordered:
+            expected_start = now + ahead / max(1, parallelism)
+            etas[ETA_KEY_TEMPLATE.format(test_run_id=test_run.id)] = {
+                u'expected_start': expected_start,
+                u'eta': expected_start + self.expected_duration(test_run),
+            }
+            ahead += self.expected_duration(test_run)
+
+        try:
+            cache.set_many(etas, self.refresh_interval * 10)
+        except Exception as e:
+            log.error(u'error publishing queued test run etas: {}'.format(unicode(e)))
+
+
+class ShortestJobFirstScheduler(Scheduler):
+    """Claims the runs expected to finish soonest first, so that quick tests
+    don't queue behind long suites. Aging moves runs up the longer they wait,
+    so long runs still get their turn: a run that has waited for its expected
+    duration divided by aging ranks like a run expected to take no time.
+    """
+
+    def __init__(self, history=None, aging=DEFAULT_AGING):
+        super(ShortestJobFirstScheduler, self).__init__(history or DurationHistory())
+        self.aging = aging
+
+    def key(self, test_run, now):
+        return (self.expected_duration(test_run) - self.aging * self.wait_seconds(test_run, now), test_run.pk)
+
+
+class FairShareScheduler(Scheduler):
+    """Takes turns between users, so one user queueing many runs can't
+    monopolise the engine. Users with fewer runs already running go first, and
+    each user's own runs are ordered by the then scheduler.
+    """
+
+    def __init__(self, then=None, history=None):
+        """
+        :param then: the scheduler ordering each user's runs, oldest first by default
+        """
+        self.then = then or Scheduler()
+        super(FairShareScheduler, self).__init__(history or self.then.history)
+        self.turns = {}  # test run id -> how many turns its user has taken before it
+
+    def prepare(self, test_runs, now):
+        from django_bdd.models import TestRun, RUNNING
+
+        super(FairShareScheduler, self).prepare(test_runs, now)
+        self.then.prepare(test_runs, now)
+
+        running = dict(
+            (row[u'user'], row[u'running'])
+            for row in TestRun.objects.filter(status=RUNNING).order_by().values(u'user').annotate(running=Count(u'pk'))
+        )
+
+        self.turns = {}
+        taken = {}
+        for test_run in sorted(test_runs, key=lambda test_run: self.then.key(test_run, now)):
+            user = _user_key(test_run)
+            taken[user] = taken.get(user, running.get(user, 0)) + 1
+            self.turns[test_run.id] = taken[user]
+
+    def key(self, test_run, now):
+        return (self.turns.get(test_run.id, 0), self.then.key(test_run, now))
+
+
+class PriorityScheduler(Scheduler):
+    """Claims runs with a higher priority first. The priority is read from the
+    test run field named by the DJANGO_BDD_ENGINE_PRIORITY_FIELD setting, and
+    runs of the same priority are ordered by the then scheduler.
+    """
+
+    def __init__(self, then=None, field=None, history=None):
+        """
+        :param then: the scheduler ordering runs of the same priority, oldest first by default
+        :param field: the priority field, instead of the setting
+        """
+        self.then = then or Scheduler()
+        super(PriorityScheduler, self).__init__(history or self.then.history)
+        self.field = field or getattr(settings, u'DJANGO_BDD_ENGINE_PRIORITY_FIELD', u'priority')
+
+    def prepare(self, test_runs, now):
+        super(PriorityScheduler, self).prepare(test_runs, now)
+        self.then.prepare(test_runs, now)
+
+    def key(self, test_run, now):
+        return (-(getattr(test_run, self.field, 0) or 0), self.then.key(test_run, now))
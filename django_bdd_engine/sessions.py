@@ -0,0 +1,370 @@
+import os
+import re
+import atexit
+import json
+import time
+import socket
+import logging
+import httplib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from django_bdd_engine.utility.forking import register_lock_owner
+
+
+log = logging.getLogger(u'django-bdd')
+
+SESSION_MAX_REUSE = 20  # test runs a session is handed to before it's replaced
+SESSION_IDLE_TIMEOUT = 300  # longest an unused session is kept (seconds)
+SESSION_KEEPALIVE_INTERVAL = 30  # how often unused sessions are pinged so the server doesn't end them (seconds)
+SESSION_REQUEST_TIMEOUT = 600  # longest wait for the webdriver server to answer, creating a session can be slow (seconds)
+SESSION_RESET_PATH = u'/session/{session_id}/appium/app/reset'  # resets the app between runs, relative to the webdriver url
+
+# headers that only apply to one connection, and aren't passed on
+HOP_BY_HOP_HEADERS = (u'connection', u'keep-alive', u'proxy-connection', u'transfer-encoding', u'te', u'trailer',
+                      u'upgrade', u'host', u'content-length')
+
+
+def capabilities_key(body):
+    """The capabilities a new session request asks for, in a form that's the
+    same for the same capabilities.
+
+    :return: the key, or None if the request can't be read
+    """
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(request, dict):
+        return None
+    capabilities = dict((name, request.get(name)) for name in (u'desiredCapabilities', u'capabilities'))
+    return json.dumps(capabilities, sort_keys=True)
+
+
+def session_id_from_response(body):
+    """
+    :return: the id of the session a new session response describes, w3c or json wire protocol
+    """
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    if response.get(u'sessionId'):
+        return response[u'sessionId']
+    value = response.get(u'value')
+    if isinstance(value, dict):
+        return value.get(u'sessionId')
+    return None
+
+
+class Upstream(object):
+    """A webdriver server, eg. an appium endpoint.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip(u'/')
+        parts = urlparse.urlsplit(self.url)
+        self.secure = parts.scheme == u'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self.prefix = parts.path  # eg. /wd/hub
+
+    def request(self, method, path, body=None, headers=None, timeout=SESSION_REQUEST_TIMEOUT):
+        """
+        :param path: the path after the prefix
+        :return: (status, headers, body)
+        """
+        return self.send(method, self.prefix + path, body, headers, timeout)
+
+    def send(self, method, path, body=None, headers=None, timeout=SESSION_REQUEST_TIMEOUT):
+        connection_class = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        connection = connection_class(self.host, self.port, timeout=timeout)
+        try:
+            connection.request(method, path, body, headers or {u'Content-Type': u'application/json'})
+            response = connection.getresponse()
+            return response.status, response.getheaders(), response.read()
+        finally:
+            connection.close()
+
+
+class PooledSession(object):
+    """A webdriver session the pool created, and the response it was created
+    with, which is replayed to the runs it's handed to.
+    """
+
+    def __init__(self, upstream, session_id, key, response):
+        self.upstream = upstream
+        self.session_id = session_id
+        self.key = key
+        self.response = response  # (status, headers, body)
+        self.uses = 1
+        self.idle_since = None
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.proxy.handle(self)
+
+    do_POST = do_DELETE = do_PUT = do_GET
+
+    def log_message(self, format, *args):
+        log.debug(u'session proxy: ' + format, *args)
+
+
+class SessionProxy(object):
+    """A local webdriver url that forwards everything to an upstream
+    webdriver server, except creating and deleting sessions, which go
+    through the pool.
+    """
+
+    def __init__(self, pool, upstream):
+        self.pool = pool
+        self.upstream = upstream
+        self.session_path = re.compile(u'^{}/session/([^/]+)$'.format(re.escape(upstream.prefix)))
+        self.server = _ThreadingHTTPServer((u'127.0.0.1', 0), _ProxyRequestHandler)
+        self.server.proxy = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return u'http://127.0.0.1:{}{}'.format(self.server.server_address[1], self.upstream.prefix)
+
+    def handle(self, request):
+        length = int(request.headers.get(u'Content-Length') or 0)
+        body = request.rfile.read(length) if length else None
+        path = request.path.split(u'?', 1)[0]
+        deleted = self.session_path.match(path) if request.command == u'DELETE' else None
+
+        try:
+            if request.command == u'POST' and path == self.upstream.prefix + u'/session':
+                status, headers, body = self.pool.new_session(self.upstream, body)
+            elif deleted and self.pool.release(deleted.group(1)):
+                status, headers, body = self.pool.deleted_response(deleted.group(1))
+            else:
+                headers = dict(
+                    (name, value) for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
+                )
+                status, headers, body = self.upstream.send(request.command, request.path, body, headers)
+        except (socket.error, httplib.HTTPException) as e:
+            log.error(u'error forwarding {} {} to {}: {}'.format(request.command, path, self.upstream.url, unicode(e)))
+            status, headers, body = 502, [], json.dumps({u'value': {u'error': u'unknown error', u'message': unicode(e)}})
+
+        request.send_response(status)
+        for name, value in headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                request.send_header(name, value)
+        request.send_header(u'Content-Length', str(len(body or b'')))
+        request.end_headers()
+        if body:
+            request.wfile.write(body)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SessionPool(object):
+    """Keeps webdriver sessions warm between test runs. Runs are pointed at a
+    local proxy of their endpoint: a new session request is answered with an
+    unused session that asked for the same capabilities, if there is one, and
+    quitting a session resets the app and keeps the session for the next run.
+    The capabilities requested already reflect the test's runtime
+    requirements and the webdriver processor.
+
+    Unused sessions are pinged so the server doesn't end them, and are
+    replaced after max_reuse runs or idle_timeout seconds unused.
+
+    Sessions belong to the process that created them, a forked worker starts
+    its own pool. An unused session keeps its device busy, so endpoints
+    shouldn't be shared with other processes, eg. run the engine without
+    workers or with an endpoint per worker.
+    """
+
+    def __init__(self, max_reuse=SESSION_MAX_REUSE, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 keepalive_interval=SESSION_KEEPALIVE_INTERVAL, reset_path=SESSION_RESET_PATH):
+        """
+        :param reset_path: request that resets the app between runs, None to
+            hand sessions over as they were left
+        """
+        self.max_reuse = max_reuse
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.reset_path = reset_path
+        self.lock = threading.Lock()
+        register_lock_owner(self)
+        self.pid = None
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        # whatever was inherited from the parent process belongs to it
+        self.pid = os.getpid()
+        self.proxies = {}  # upstream url -> SessionProxy
+        self.idle = []  # unused sessions, least recently used first
+        self.in_use = {}  # session id -> PooledSession
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self._keepalive_forever)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.close)
+
+    def proxy_url(self, url):
+        """
+        :return: a webdriver url to use instead of url, which pools sessions
+        """
+        with self.lock:
+            self._start()
+            proxy = self.proxies.get(url)
+            if proxy is None:
+                proxy = self.proxies[url] = SessionProxy(self, Upstream(url))
+            return proxy.url
+
+    def new_session(self, upstream, body):
+        """Hand over an unused session with the requested capabilities, or
+        create one.
+
+        :return: (status, headers, body) of the response
+        """
+        key = capabilities_key(body)
+        with self.lock:
+            matching = [s for s in self.idle if s.upstream.url == upstream.url and key is not None and s.key == key]
+            if matching:
+                session = matching[-1]
+                self.idle.remove(session)
+                session.uses += 1
+                self.in_use[session.session_id] = session
+                log.debug(u'reusing webdriver session %s for the %s time', session.session_id, session.uses)
+                return session.response
+
+            # the device can usually only hold one session, so let go of the ones that don't match
+            others = [s for s in self.idle if s.upstream.url == upstream.url]
+            for session in others:
+                self.idle.remove(session)
+        for session in others:
+            self.quit(session)
+
+        response = upstream.request(u'POST', u'/session', body)
+        session_id = session_id_from_response(response[2])
+        if response[0] == 200 and session_id and key is not None:
+            log.debug(u'created webdriver session %s on %s', session_id, upstream.url)
+            with self.lock:
+                self.in_use[session_id] = PooledSession(upstream, session_id, key, response)
+        return response
+
+    def release(self, session_id):
+        """Take back a session a run has quit. It's reset and kept, or quit
+        if it's been used max_reuse times or can't be reset.
+
+        :return: whether the session was one of the pool's
+        """
+        with self.lock:
+            session = self.in_use.pop(session_id, None)
+        if session is None:
+            return False
+
+        if session.uses >= self.max_reuse:
+            log.debug(u'webdriver session %s has been used %s times, replacing it', session_id, session.uses)
+            self.quit(session)
+        elif self.reset(session):
+            session.idle_since = time.time()
+            with self.lock:
+                self.idle.append(session)
+        else:
+            self.quit(session)
+        return True
+
+    def deleted_response(self, session_id):
+        return 200, [(u'Content-Type', u'application/json')], json.dumps({
+            u'sessionId': session_id, u'status': 0, u'value': None
+        })
+
+    def reset(self, session):
+        if not self.reset_path:
+            return True
+        try:
+            status, _, _ = session.upstream.request(u'POST', self.reset_path.format(session_id=session.session_id), b'{}')
+        except (socket.error, httplib.HTTPException) as e:
+            log.debug(u'error resetting webdriver session %s: %s', session.session_id, e)
+            return False
+        return status == 200
+
+    def quit(self, session):
+        log.debug(u'quitting webdriver session %s', session.session_id)
+        try:
+            session.upstream.request(u'DELETE', u'/session/{}'.format(session.session_id))
+        except (socket.error, httplib.HTTPException) as e:
+            log.debug(u'error quitting webdriver session %s: %s', session.session_id, e)
+
+    def finish(self, url):
+        """Quit the sessions on url a run left open, eg. because it crashed,
+        since there's no knowing what state they're in.
+        """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            left_open = [s for s in self.in_use.values() if s.upstream.url == url.rstrip(u'/')]
+            for session in left_open:
+                del self.in_use[session.session_id]
+        for session in left_open:
+            self.quit(session)
+
+    def evict(self):
+        """Quit the unused sessions idle for longer than idle_timeout, and
+        ping the rest.
+        """
+        now = time.time()
+        with self.lock:
+            expired = [s for s in self.idle if now - s.idle_since >= self.idle_timeout]
+            for session in expired:
+                self.idle.remove(session)
+            alive = list(self.idle)
+        for session in expired:
+            log.debug(u'webdriver session %s has been idle too long', session.session_id)
+            self.quit(session)
+
+        for session in alive:
+            try:
+                status, _, _ = session.upstream.request(u'GET', u'/session/{}'.format(session.session_id))
+            except (socket.error, httplib.HTTPException):
+                status = None
+            if status != 200:
+                log.debug(u'webdriver session %s did not answer a ping, dropping it', session.session_id)
+                with self.lock:
+                    if session in self.idle:
+                        self.idle.remove(session)
+                self.quit(session)
+
+    def _keepalive_forever(self):
+        stopped = self.stopped
+        while not stopped.wait(self.keepalive_interval):
+            try:
+                self.evict()
+            except Exception as e:
+                log.error(u'error keeping webdriver sessions alive: {}'.format(unicode(e)))
+
+    def close(self):
+        """Quit every session, and stop the proxies.
+        """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            sessions = self.idle + self.in_use.values()
+            self.idle, self.in_use = [], {}
+            proxies, self.proxies = self.proxies.values(), {}
+            self.stopped.set()
+            self.pid = None
+        for session in sessions:
+            self.quit(session)
+        for proxy in proxies:
+            proxy.close()
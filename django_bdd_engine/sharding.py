@@ -0,0 +1,204 @@
+import logging
+import multiprocessing
+import time
+import traceback
+import Queue
+
+from django_bdd_engine.testdriver import TestDriver
+from django_bdd_engine.outbox import Outbox
+from django_bdd_engine.testqueue import holds_lease
+from django_bdd_engine.utility.db import with_retry
+from django_bdd_engine.utility.forking import start_process, finish_process
+from django_bdd_engine.utility.runtext import RunText
+from django_bdd_engine.utility.tracing import start_trace, finish_trace
+from django_bdd_engine.utility.cloudwatch import put_metric_data, METRIC_ENGINE_TEST_RUN_DURATION
+
+
+log = logging.getLogger(u'django-bdd')
+
+SHARD_POLL_INTERVAL = 1  # how often to check on shard processes while waiting for their results (seconds)
+
+EXAMPLES_KEYWORDS = (u'Examples', u'Scenarios')  # behave's keywords that start an examples table
+
+
+def split_example_tables(example_text):
+    """Split example text into its examples tables. The text follows an
+    Examples: line, so like in a feature file, any further table starts with
+    an Examples: line of its own, optionally after tags. Blank lines and
+    comments are dropped.
+
+    :return: list of (header, rows) tuples, or None if example_text isn't
+        made of tables with a header and at least one row each
+    """
+    tables = [[]]
+    for line in (example_text or u'').splitlines():
+        line = line.strip()
+        if not line or line.startswith(u'#'):
+            continue
+        if line.startswith(u'|'):
+            tables[-1].append(line)
+        elif line.partition(u':')[1] and line.partition(u':')[0].strip() in EXAMPLES_KEYWORDS:
+            tables.append([])
+        elif not line.startswith(u'@'):
+            return None
+    if not all(len(lines) >= 2 for lines in tables):
+        return None
+    return [(lines[0], lines[1:]) for lines in tables]
+
+
+def split_example_text(example_text):
+    """Split an examples table into its header and rows. Blank lines and
+    comments are dropped.
+
+    :return: (header, rows), or None if example_text isn't a single table
+    """
+    tables = split_example_tables(example_text)
+    if tables is None or len(tables) != 1:
+        return None
+    return tables[0]
+
+
+def count_example_rows(example_text):
+    """
+    :return: the number of rows to shard, none unless example_text is a single table
+    """
+    table = split_example_text(example_text)
+    return len(table[1]) if table else 0
+
+
+def shard_example_text(example_text, shards):
+    """Split an examples table into at most shards contiguous slices of its
+    rows, each with the header.
+
+    :return: list of (example_row_offset, example_text) tuples, where
+        example_row_offset is the number of rows before the slice
+    """
+    header, rows = split_example_text(example_text)
+    shards = max(1, min(shards, len(rows)))
+    size, remainder = divmod(len(rows), shards)
+
+    slices = []
+    offset = 0
+    for index in range(shards):
+        count = size + (1 if index < remainder else 0)
+        slices.append((offset, u'\r\n'.join([header] + rows[offset:offset + count]) + u'\r\n'))
+        offset += count
+    return slices
+
+
+def _run_shard(engine, test_run_id, index, endpoint, example_text, example_row_offset, results):
+    """Entry point of a shard process. Runs one slice of the examples and
+    reports (index, status, text) back.
+    """
+    from django_bdd.models import FAILED
+    log.debug(u'shard %s of test run %s is running rows after %s against %s', index, test_run_id, example_row_offset, endpoint)
+    start_trace(u'test run {} shard {}'.format(test_run_id, index), test_run_id=test_run_id, shard=index)
+    try:
+        test_driver = TestDriver(
+            engine=engine,
+            test_run_id=test_run_id,
+            endpoint=endpoint,
+            example_text=example_text,
+            example_row_offset=example_row_offset,
+            shard=True
+        )
+        test_driver.start()
+        results.put((index, test_driver.test_run.status, test_driver.shard_text))
+    except Exception as e:
+        log.error(u'shard {} of test run {} failed: {}'.format(index, test_run_id, unicode(e)))
+        results.put((index, FAILED, u'Exception:\n' + unicode(e) + u'\n\nTraceback:\n' + unicode(traceback.format_exc())))
+    finally:
+        finish_trace(u'run-{}-shard-{}.json'.format(test_run_id, index))
+        finish_process()
+
+
+class ShardedTestDriver(object):
+    """Runs a Scenario Outline's example rows on several endpoints at once.
+    The rows are split into contiguous slices, each run by a TestDriver in its
+    own process against its own endpoint. The shards commit step results under
+    the test run's example row numbers, and the test run's status, duration and
+    text are combined and committed once they're all done.
+    """
+
+    def __init__(self, engine, test_run_id, endpoint_lease):
+        """
+        :param test_run_id: the test_run id
+        :param endpoint_lease: an EndpointLeaseGroup with one endpoint per
+            shard, released once every shard is done
+        """
+        from django_bdd.models import TestRun
+
+        self.engine = engine
+        self.test_run_id = test_run_id
+        self.endpoint_lease = endpoint_lease
+        self.test_run = with_retry(TestRun.objects.get, pk=test_run_id)
+        self.outbox = getattr(engine, u'outbox', None) or Outbox()
+
+    def start(self):
+        from django_bdd.models import FAILED, PASSED, SKIPPED
+
+        start_time = time.time()
+        try:
+            shards = shard_example_text(self.test_run.example_text, len(self.endpoint_lease.urls))
+            log.debug(u'running test run %s in %s shards', self.test_run.id, len(shards))
+
+            results = multiprocessing.Queue()
+            processes = []
+            for index, ((example_row_offset, example_text), endpoint) in enumerate(zip(shards, self.endpoint_lease.urls)):
+                process = multiprocessing.Process(
+                    target=_run_shard,
+                    args=(self.engine, self.test_run.id, index, endpoint, example_text, example_row_offset, results)
+                )
+                process.daemon = True
+                processes.append(process)
+
+            for process in processes:
+                start_process(process)
+
+            outcomes = self.collect(processes, results)
+        finally:
+            self.endpoint_lease.release()
+
+        statuses = []
+        run_text = RunText(self.test_run, spill=False)
+        for index in range(len(processes)):
+            status, text = outcomes.get(index, (FAILED, u'shard {} exited unexpectedly\n'.format(index)))
+            statuses.append(status)
+            run_text.append(text)
+        run_text.checkpoint()
+
+        # a shard that never finished its feature counts as failed
+        if any(status not in (PASSED, SKIPPED) for status in statuses):
+            self.test_run.status = FAILED
+        elif all(status == SKIPPED for status in statuses):
+            self.test_run.status = SKIPPED
+        else:
+            self.test_run.status = PASSED
+
+        self.test_run.duration = time.time() - start_time
+        if getattr(self.engine, u'lease_seconds', None) and not holds_lease(self.test_run.id):
+            log.warn(u'not saving results for test run {}, its lease was lost'.format(self.test_run.id))
+            return
+        with_retry(self.test_run.save, update_fields=[u'status', u'duration', u'text'])
+        self.outbox.put(self.test_run.id)
+
+        log.debug(u'completed running test run %s in %s seconds, reporting metric', self.test_run.id, self.test_run.duration)
+        put_metric_data(METRIC_ENGINE_TEST_RUN_DURATION, value=self.test_run.duration)
+
+    def collect(self, processes, results):
+        """Wait for every shard to report back, or exit.
+
+        :return: dict of shard index to (status, text)
+        """
+        outcomes = {}
+        while len(outcomes) < len(processes):
+            try:
+                index, status, text = results.get(timeout=SHARD_POLL_INTERVAL)
+                outcomes[index] = (status, text)
+            except Queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+
+        for process in processes:
+            process.join()
+        return outcomes
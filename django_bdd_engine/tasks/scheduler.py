@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import Queue
+
+from django_bdd_engine.utility.cloudwatch import (
+    put_metric_data,
+    increment_metric,
+    METRIC_ENGINE_TASK_DURATION,
+    METRIC_ENGINE_TASK_TIMEOUT
+)
+
+
+log = logging.getLogger(u'django-bdd')
+email_log = logging.getLogger(u'email_log')
+
+DEFAULT_TASK_INTERVAL = 1  # how often tasks that don't set an interval are run (seconds)
+TASK_THREADS = 4  # number of tasks that can run at once
+TIMEOUT_CHECK_INTERVAL = 1  # how often running tasks are checked against their timeout (seconds)
+
+
+class TaskScheduler(object):
+    """Runs the engine's tasks on a pool of threads, each one every
+    task.interval seconds, independently of the engine loop and the tests it
+    runs. Tasks are kept in a heap ordered by when they're next due.
+
+    A task is dropped once it's done, past its deadline, or has raised. A task
+    still running after task.timeout seconds is reported as hung. Threads can't
+    be interrupted, so a hung task isn't run again until it returns.
+    """
+
+    def __init__(self, threads=TASK_THREADS):
+        self.thread_count = threads
+        self.heap = []  # (due at, sequence, task)
+        self.sequence = itertools.count()  # keeps tasks due at the same time in the order they were added
+        self.lock = threading.Condition()
+        self.due = Queue.Queue()
+        self.running = {}  # task -> when it started, for tasks being run
+        self.timed_out = set()
+        self.threads = []
+        self.stopped = False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap) + len(self.running)
+
+    def add(self, task, delay=0):
+        """Schedule a task, first run after delay seconds.
+        """
+        with self.lock:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.sequence), task))
+            self.lock.notify()
+
+    def start(self):
+        threads = [threading.Thread(target=self._dispatch, name=u'task-scheduler')]
+        threads += [threading.Thread(target=self._work, name=u'task-{}'.format(i)) for i in range(self.thread_count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.threads = threads
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+        for _ in range(self.thread_count):
+            self.due.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _dispatch(self):
+        """Hand tasks to the pool as they come due, and watch for hung ones.
+        """
+        with self.lock:
+            while not self.stopped:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due_at, _, task = heapq.heappop(self.heap)
+                    self.running[task] = now
+                    self.due.put(task)
+
+                self._check_timeouts(now)
+
+                wait = TIMEOUT_CHECK_INTERVAL
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+                self.lock.wait(max(0, wait))
+
+    def _check_timeouts(self, now):
+        for task, started_at in self.running.items():
+            timeout = getattr(task, u'timeout', None)
+            if timeout and now - started_at > timeout and task not in self.timed_out:
+                self.timed_out.add(task)
+                error_message = u'task {} has been running for more than {} seconds'.format(task, timeout)
+                log.error(error_message)
+                email_log.error(error_message)
+                increment_metric(METRIC_ENGINE_TASK_TIMEOUT, dimensions={u'Task': type(task).__name__})
+
+    def _work(self):
+        while True:
+            task = self.due.get()
+            if task is None:
+                return
+
+            keep = self._run(task)
+            with self.lock:
+                del self.running[task]
+                self.timed_out.discard(task)
+                if keep and not self.stopped:
+                    interval = getattr(task, u'interval', None) or DEFAULT_TASK_INTERVAL
+                    heapq.heappush(self.heap, (time.time() + interval, next(self.sequence), task))
+                    self.lock.notify()
+
+    def _run(self, task):
+        """Run one update of a task.
+
+        :return: whether the task should be run again
+        """
+        deadline = getattr(task, u'deadline', None)
+        if deadline and time.time() > deadline:
+            log.debug(u'task %s is past its deadline, dropping it', task)
+            return False
+
+        log.debug(u'running task: %s', task)
+        start_time = time.time()
+        try:
+            task.update()
+        except Exception as e:
+            error_message = u'exception when running task.update: {}'.format(unicode(e))
+            log.error(error_message)
+            email_log.error(error_message)
+            return False
+        finally:
+            put_metric_data(METRIC_ENGINE_TASK_DURATION, value=time.time() - start_time, dimensions={u'Task': type(task).__name__})
+        return not task.done
@@ -1,11 +1,19 @@
 
 class Task(object):
     """
-    Generic task with an update function for the engine to call each loop.
+    Generic task with an update function for the engine's task scheduler to call every interval seconds.
     """
 
-    def __init__(self):
+    def __init__(self, interval=None, timeout=None, deadline=None):
+        """
+        :param interval: seconds between the end of one update and the start of the next, about a second by default
+        :param timeout: report the task as hung if an update takes longer than this many seconds
+        :param deadline: a time.time() after which the task is dropped
+        """
         self.done = False
+        self.interval = interval
+        self.timeout = timeout
+        self.deadline = deadline
 
     def update(self):
         """
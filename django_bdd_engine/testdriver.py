@@ -1,5 +1,3 @@
-from django_bdd_engine.toplevel import *  # database preparation
-
 import os
 import tempfile
 import time
@@ -9,15 +7,26 @@ import shutil
 import logging
 import traceback
 
-from django_bdd_engine.utility.cloudwatch import put_metric_data, METRIC_ENGINE_TEST_RUN_DURATION
+from django_bdd_engine.toplevel import setup_stage  # database preparation
+from django_bdd_engine.utility.cloudwatch import (
+    put_metric_data,
+    METRIC_ENGINE_TEST_RUN_DURATION,
+    METRIC_ENGINE_LOGGING_TIME_PER_STEP
+)
+from django_bdd_engine.utility.db import with_retry
+from django_bdd_engine.utility.uploads import LocalS3Util, ScreenshotUploader
+from django_bdd_engine.utility.runtext import RunText
+from django_bdd_engine.utility.tracing import span, traced
+from django_bdd_engine.utility.logs import RunLogCapture, logging_stats, RUN_LOG_KEY_TEMPLATE, RUN_LOG_MAX_LENGTH
+from django_bdd_engine.outbox import Outbox
+from django_bdd_engine.testqueue import LEASE_RENEWALS_PER_LEASE, LeaseLost, holds_lease
+from django_bdd_engine.features import feature_cache
 
 from django.conf import settings
-from django.db import connection
+from django.db import transaction
 
-from s3util.s3util import S3Util
-from django_bdd.models import NEW, RUNNING, FAILED, PASSED, SKIPPED, TestRun, TestRunStep
-from django_bdd.notifications import notify
-from mobilebdd.runner import goh_behave
+# s3util, goh_behave and the django_bdd models are imported where they're used, to keep importing this module cheap
+# and because the models can only be loaded once the stage is set up
 from mobilebdd.listener import Listener  # defines a set of hooks that behave calls
 
 
@@ -27,13 +36,22 @@ log = logging.getLogger(u'django-bdd')
 SCREENSHOT_FOLDER = u'bdd/results/{test_id}/{run_id}/{example_row_num}'
 SCREENSHOT_NAME_TEMPLATE = SCREENSHOT_FOLDER + u'/{filename}'
 
+STEP_BULK_CREATE_BATCH_SIZE = 500  # number of test run steps inserted per query
+STEP_FLUSH_INTERVAL = 5  # longest time step updates are held back before being written to the db (seconds)
+
+
+def _run_span_attributes(test_driver, *args):
+    return {u'test_run_id': test_driver.test_run.id, u'example_row_num': test_driver.example_row_num}
 
-def ensure_connection():
-    """This is a hack to make sure that the django db connection wil be available
-    before any query or save that has had too much time pass before it.
-    """
-    # HACK django db connections sometimes time out
-    connection.close()
+
+def _step_span_attributes(test_driver, step):
+    test_step = test_driver.get_test_step(step)
+    return {
+        u'test_run_id': test_driver.test_run.id,
+        u'test_step_id': test_step.id if test_step else None,
+        u'example_row_num': test_driver.example_row_num,
+        u'step': u'{} {}'.format(step.keyword, step.name),
+    }
 
 
 class TestDriver(Listener):
@@ -41,124 +59,225 @@ class TestDriver(Listener):
     Behave to call in order to save the results to the db.
     """
 
-    def __init__(self, engine, test_run_id, endpoint, webdriver_processor=None):
+    def __init__(self, engine, test_run_id, endpoint, webdriver_processor=None, endpoint_lease=None,
+                 example_text=None, example_row_offset=0, shard=False):
         """
         :param test_run_id: the test_run id
         :param endpoint: the endpoint to run the test against
         :param webdriver_processor: a class (or None) implementing hooks like a
             cabability filter, allowing outside users to have the final say on
             capabilities
+        :param endpoint_lease: the engine's lease on the endpoint, if it came
+            from an endpoint pool. released as soon as the test is done.
+        :param example_text: run these examples instead of the test run's
+            example_text, eg. a slice of its rows
+        :param example_row_offset: the number of example rows before the
+            first one in example_text, so step results are recorded under the
+            test run's row numbers
+        :param shard: run as one shard of a ShardedTestDriver, recording step
+            results but leaving the test run's status, duration, text and
+            notification to the ShardedTestDriver
         """
         super(Listener, self).__init__()
-        log.debug(u'running against endpoint "{}"'.format(endpoint))
+        setup_stage()
+        from django_bdd.models import TestRun
+
+        log.debug(u'running against endpoint "%s"', endpoint)
+
+        # screenshots can be kept in a local folder instead of s3, eg. for local testing
+        local_s3_dir = getattr(settings, u'DJANGO_BDD_ENGINE_LOCAL_S3_DIR', None)
+        if local_s3_dir:
+            self.s3_util = LocalS3Util(local_s3_dir)
+        else:
+            from s3util.s3util import S3Util
+            self.s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, s3_bucket=settings.AWS_BUCKET)
+        self.screenshot_uploader = None
 
-        self.s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, s3_bucket=settings.AWS_BUCKET)
+        # notifications are sent from the engine process by its OutboxSenderTask
+        self.outbox = getattr(engine, u'outbox', None) or Outbox()
 
-        log.debug(u'getting test run {}'.format(test_run_id))
-        ensure_connection()
-        self.test_run = TestRun.objects.get(pk=test_run_id)
+        # the engine renews the lease on the run, the run checks it's still held before writing its results
+        self.lease_seconds = getattr(engine, u'lease_seconds', None)
+        self.lease_checked_at = 0  # checked as soon as the run starts
+        self.lease_lost = False
+
+        log.debug(u'getting test run %s', test_run_id)
+        with span(u'load test run', test_run_id=test_run_id):
+            self.test_run = with_retry(TestRun.objects.get, pk=test_run_id)
         self.endpoint = endpoint
+        self.endpoint_lease = endpoint_lease
         self.webdriver_processor = webdriver_processor
-        self.example_row_num = 1  # keep track of which permutation row number of the scenario we're on
+        self.example_row_offset = example_row_offset
+        self.example_row_num = 1 + example_row_offset  # keep track of which permutation row number of the scenario we're on
+        self.shard = shard
+        self.text = RunText(self.test_run)  # output is buffered and written to the test run's text at checkpoints
         self.test_step_num = 1  # keep track of which test step number we're on within a permutation
 
-        # create a feature file and the necessary folders
-        log.debug(u'creating temp folders and files')
-        self.feature_dir = tempfile.mkdtemp()
-        self.result_dir = tempfile.mkdtemp()
-        self.feature_file_text = u''
-        self.feature_file = tempfile.NamedTemporaryFile(suffix=u'.feature', dir=self.feature_dir)
-
-        # pull the steps out of the test run's test object
-        steps = self.test_run.test.steps
-
-        # if the feature has not been explicitly defined, create a Feature: entry at the top of the file
-        if 'Feature:' not in steps:
-            self.feature_file_text += u'Feature: {}\r\n'.format(self.test_run.test.name)
-
-        # if it's a scenario, there are no examples
-        # if it's a scenario outline, Examples: should be present
-        # http://jenisys.github.io/behave.example/tutorials/tutorial04.html
-
-        # if the user has not explicitly defined a Scenario: or Scenario Outline section, detect which one should be created
-        if 'Scenario:' not in steps and 'Scenario Outline:' not in steps:
-            if 'Examples:' in steps:
-                log.debug('examples detected in steps, writing scenario outline to feature file')
-                scenario_header = u'Scenario Outline: {}\r\n'
-            elif self.test_run.example_text:
-                log.debug('examples detected in test run example_text, writing scenario outline to feature file')
-                scenario_header = u'Scenario Outline: {}\r\n'
-            else:
-                log.debug('writing normal scenario to feature file')
-                scenario_header = u'Scenario: {}\r\n'
-
-            # write the scenario header to the feature file text
-            self.feature_file_text += scenario_header.format(self.test_run.test.name)
+        # the test run steps created in before_feature, keyed by (num, example_row_num, text)
+        self.test_steps = {}
+        # steps with changes that haven't been written to the db yet, and the fields that changed
+        self.dirty_test_steps = {}
+        self.test_steps_flushed_at = time.time()
 
-        self.feature_file_text += steps
-        self.feature_file_text += u'\r\n\r\n'  # add some space at the end of the file
+        # webdriver sessions can be kept open for the next run, shards run in short lived processes so they don't
+        self.session_pool = None if shard else getattr(engine, u'session_pool', None)
 
-        # if example text exists in the test run, write an 'Examples:' section
-        # with the text that is present in the db
-        if self.test_run.example_text:
-            self.feature_file_text += u'Examples:\r\n'
-            self.feature_file_text += self.test_run.example_text
+        # the feature file comes from the feature cache, it's only built and written when it isn't there yet
+        example_text = self.test_run.example_text if example_text is None else example_text
+        with span(u'build feature', test_run_id=test_run_id):
+            self.feature_dir, self.feature_file_text = feature_cache.get(self.test_run.test.name, self.test_run.test.steps, example_text)
 
-        log.debug(u'writing to feature file:\r\n{}'.format(self.feature_file_text))
-        self.feature_file.write(self.feature_file_text.encode(u'utf8'))
+        log.debug(u'creating temp folder for results')
+        self.result_dir = tempfile.mkdtemp()
 
-        log.debug(u'flushing feature file')
-        self.feature_file.file.flush()
+    @property
+    def shard_text(self):
+        """The text this test driver added to the test run.
+        """
+        return self.text.output()
 
     def start(self):
+        from django_bdd.models import FAILED
+        from mobilebdd.runner import goh_behave
+
         # measure elapsed time in case the test run throws an exception
         start_time = time.time()
 
-        step_dirs = []
+        # the engine's log records are kept while the test runs, and saved alongside its results
+        logging_seconds = logging_stats[u'seconds']
+        run_log = None
+        if getattr(settings, u'DJANGO_BDD_ENGINE_RUN_LOGS', False):
+            run_log = RunLogCapture(
+                getattr(settings, u'DJANGO_BDD_ENGINE_RUN_LOG_MAX_LENGTH', RUN_LOG_MAX_LENGTH),
+                level=getattr(settings, u'DJANGO_BDD_ENGINE_RUN_LOG_LEVEL', logging.DEBUG)
+            )
+            run_log.start()
+
+        # extra step definitions, also matched against by the engine's pre-flight checks
+        step_dirs = list(getattr(settings, u'DJANGO_BDD_ENGINE_STEP_DIRS', []))
+        self.screenshot_uploader = ScreenshotUploader(
+            self.s3_util,
+            dedupe=getattr(settings, u'DJANGO_BDD_ENGINE_SCREENSHOT_DEDUPE', False),
+            shrink=getattr(settings, u'DJANGO_BDD_ENGINE_SCREENSHOT_SHRINK', False),
+            max_width=getattr(settings, u'DJANGO_BDD_ENGINE_SCREENSHOT_MAX_WIDTH', None)
+        )
         try:
+            webdriver_url = self.endpoint
+            if self.session_pool:
+                webdriver_url = self.session_pool.proxy_url(self.endpoint)
+
             log.debug(u'calling goh_behave')
-            goh_behave(
-                feature_dirs=[self.feature_dir],
-                step_dirs=step_dirs,
-                test_artifact_dir=self.result_dir,
-                listeners=[self],
-                webdriver_url=self.endpoint,
-                webdriver_processor=self.webdriver_processor
-            )
+            with span(u'behave', test_run_id=self.test_run.id):
+                goh_behave(
+                    feature_dirs=[self.feature_dir],
+                    step_dirs=step_dirs,
+                    test_artifact_dir=self.result_dir,
+                    listeners=[self],
+                    webdriver_url=webdriver_url,
+                    webdriver_processor=self.webdriver_processor
+                )
 
-            # report the test run duration metric
-            log.debug(u'completed running test run {} in {} seconds, reporting metric'.format(self.test_run.id, self.test_run.duration))
-            put_metric_data(METRIC_ENGINE_TEST_RUN_DURATION, value=self.test_run.duration)
+            # report the test run duration metric, a sharded run reports it once all of its shards are done
+            if not self.shard:
+                log.debug(u'completed running test run %s in %s seconds, reporting metric', self.test_run.id, self.test_run.duration)
+                put_metric_data(METRIC_ENGINE_TEST_RUN_DURATION, value=self.test_run.duration)
+        except LeaseLost as e:
+            log.warn(unicode(e))
         except Exception as e:
             # there's a chance that an exception might be thrown. if so, then
             # there's also a chance that the callbacks didnt get reached, so we
             # catch here and report failure
-            log.debug(u'goh_behave threw an exception: {}'.format(unicode(e)))
+            log.debug(u'goh_behave threw an exception: %s', unicode(e))
             self.test_run.status = FAILED
 
             # add the exception text as well as the traceback
-            self.test_run.text += u'Exception:\n' + unicode(e) + u'\n\nTraceback:\n' + unicode(traceback.format_exc())
+            self.text.append(u'Exception:\n' + unicode(e) + u'\n\nTraceback:\n' + unicode(traceback.format_exc()))
 
             self.test_run.duration = time.time() - start_time
-            ensure_connection()
-            self.test_run.save()
         finally:
-            # always cleanup
+            # sessions the run didn't quit can't be reused
+            if self.session_pool:
+                self.session_pool.finish(self.endpoint)
+
+            # the test is done with the device, let the next run have it
+            if self.endpoint_lease:
+                self.endpoint_lease.release()
+
+            # let the screenshots finish uploading before their folder is removed
+            log.debug(u'waiting for screenshot uploads to finish')
+            with span(u'drain uploads', test_run_id=self.test_run.id):
+                self.screenshot_uploader.drain()
+                self.screenshot_uploader.close()
+            self.record_uploaded_screenshots()
+            with span(u'upload text spill', test_run_id=self.test_run.id):
+                self.text.upload_spill(self.s3_util)
+            if run_log:
+                self.save_run_log(run_log)
+
+            # the time logging calls spent in the engine's handlers during the run, for each step
+            put_metric_data(
+                METRIC_ENGINE_LOGGING_TIME_PER_STEP,
+                value=(logging_stats[u'seconds'] - logging_seconds) / max(1, len(self.test_steps))
+            )
+
+            # whatever happened, don't lose the results. unless the run is another engine's now, then they aren't ours
+            if self.lease_lost:
+                log.warn(u'not saving results for test run {}, its lease was lost'.format(self.test_run.id))
+            else:
+                try:
+                    self.finalize()
+                except Exception as e:
+                    log.error(u'error saving results for test run {}: {}'.format(self.test_run.id, unicode(e)))
+
+            # always cleanup, the feature folder is left to the feature cache
+            self.text.close()
             log.debug(u'cleaning temp directories')
-            shutil.rmtree(self.feature_dir)
             shutil.rmtree(self.result_dir)
 
+    def save_run_log(self, run_log):
+        """Stop capturing the run's log and save it gzipped to s3, noting
+        where in the test run's text.
+        """
+        run_log.stop()
+        key = RUN_LOG_KEY_TEMPLATE.format(
+            test_id=self.test_run.test_id,
+            run_id=self.test_run.id,
+            name=u'engine-rows-after-{}'.format(self.example_row_offset) if self.shard else u'engine'
+        )
+        with span(u'upload run log', test_run_id=self.test_run.id):
+            if run_log.upload(self.s3_util, key):
+                self.text.append(u'\nThe engine log for this run is in s3 at "{}"\n'.format(key))
+
+    def check_lease(self):
+        """Make sure the engine still holds the lease on the test run, at most
+        LEASE_RENEWALS_PER_LEASE times per lease period. Once it's lost no
+        more results are written.
+
+        :raises LeaseLost: if the lease was lost
+        """
+        if not self.lease_lost:
+            if not self.lease_seconds or time.time() - self.lease_checked_at < self.lease_seconds / float(LEASE_RENEWALS_PER_LEASE):
+                return
+            self.lease_checked_at = time.time()
+            self.lease_lost = not holds_lease(self.test_run.id)
+            if not self.lease_lost:
+                return
+        raise LeaseLost(u'the lease on test run {} was lost, stopping'.format(self.test_run.id))
+
     """Behave Hooks"""
+    @traced(u'before_feature', _run_span_attributes)
     def before_feature(self, feature):
         """Inspect the feature. Here, we create pre-create every step that is
         going to be necessary in the db so that we can start recording results.
         """
+        from django_bdd.models import NEW, RUNNING, TestRunStep
         log.debug(u'before_feature')
+        self.check_lease()
 
         # set the test to running immediately
-        self.test_run.status = RUNNING
-        ensure_connection()
-        self.test_run.save()
+        if not self.shard:
+            self.test_run.status = RUNNING
+            with_retry(self.test_run.save)
 
         # the Behave 'Example' row number - the way this works is Behave generates a Scenario for
         # each row in the example tables, regardless of how many tables there are. all of the
@@ -166,67 +285,146 @@ class TestDriver(Listener):
         # per now in these tables. to think of it another way, per scenario generated by walk_scenarios()
         # as we call below. walk_scenarios() will only return 1 result if it's a regular Scenario as
         # opposed to a ScenarioOutline object, which is fine
-        example_row_num = 1
+        test_steps = []
+        example_row_num = 1 + self.example_row_offset
         for scenario in feature.walk_scenarios():
-            log.debug(u'creating step result entries in db for "Example" row number {}'.format(example_row_num))
+            log.debug(u'creating step result entries for "Example" row number %s', example_row_num)
 
-            # run through all background steps and create them in the db
-            start = 1
-            for num, step in enumerate(scenario.background_steps, start=start):
-                self.test_run.testrunstep_set.create(
+            # background steps come first, followed by the normal steps
+            steps = list(scenario.background_steps) + list(scenario.steps)
+            for num, step in enumerate(steps, start=1):
+                test_steps.append(TestRunStep(
+                    test_run=self.test_run,
                     num=num,
                     example_row_num=example_row_num,
                     text=u'{} {}'.format(step.keyword, step.name),
                     status=NEW
-                )
-                start += 1
-
-            # run through all normal steps and create them in the db
-            for num, step in enumerate(scenario.steps, start=start):
-                self.test_run.testrunstep_set.create(
-                    num=num,
-                    example_row_num=example_row_num,
-                    text=u'{} {}'.format(step.keyword, step.name),
-                    status=NEW
-                )
+                ))
             example_row_num += 1
 
+        # write them all in a few big inserts rather than one query per step
+        log.debug(u'saving %s step result entries to the db', len(test_steps))
+        with span(u'create steps', test_run_id=self.test_run.id, count=len(test_steps)):
+            with transaction.atomic():
+                TestRunStep.objects.bulk_create(test_steps, batch_size=STEP_BULK_CREATE_BATCH_SIZE)
+
+        # read them back once so that they have ids, and keep them around so
+        # the step hooks don't have to query for them. other shards' rows are left out.
+        test_steps = self.test_run.testrunstep_set.filter(
+            example_row_num__gt=self.example_row_offset,
+            example_row_num__lt=example_row_num
+        )
+        self.test_steps = dict(
+            ((test_step.num, test_step.example_row_num, test_step.text), test_step)
+            for test_step in test_steps
+        )
+
+    def get_test_step(self, step):
+        """Find the test run step for a behave step. Use both num and text,
+        because any of these steps could 'expand' via substeps, which still
+        trigger the step hooks but weren't created in before_feature.
+
+        :return: the test run step, or None if it's a substep
+        """
+        return self.test_steps.get((self.test_step_num, self.example_row_num, u'{} {}'.format(step.keyword, step.name)))
+
+    def update_test_step(self, test_step, **fields):
+        """Change fields on a test run step. The changes are buffered and
+        written by flush_test_steps.
+        """
+        for name, value in fields.items():
+            setattr(test_step, name, value)
+        self.dirty_test_steps.setdefault(test_step.id, (test_step, set()))[1].update(fields)
+
+    def flush_test_steps(self):
+        """Write all buffered step changes in one transaction, saving only the
+        fields that changed.
+        """
+        self.test_steps_flushed_at = time.time()
+        if not self.dirty_test_steps:
+            return
+        self.check_lease()
+
+        log.debug(u'saving %s changed test run steps', len(self.dirty_test_steps))
+        with span(u'flush steps', test_run_id=self.test_run.id, count=len(self.dirty_test_steps)):
+            with_retry(self._save_dirty_test_steps)
+        self.dirty_test_steps = {}
+
+    def save_text(self):
+        """Write the test run's text if output was added since it was last
+        written, and only the text.
+        """
+        if not self.shard and self.text.checkpoint():
+            self.check_lease()
+            with span(u'save text', test_run_id=self.test_run.id):
+                with_retry(self.test_run.save, update_fields=[u'text'])
+
+    def _save_dirty_test_steps(self):
+        with transaction.atomic():
+            for test_step, fields in self.dirty_test_steps.values():
+                test_step.save(update_fields=list(fields))
+
+    @traced(u'finalize', _run_span_attributes)
+    def finalize(self):
+        """Commit the results in one transaction: the buffered step changes
+        and, unless this is a shard, the test run's status, duration and text.
+        Then queue the notification, which is sent in the background.
+        """
+        log.debug(u'committing the results of test run %s', self.test_run.id)
+        self.text.checkpoint()
+        self.test_steps_flushed_at = time.time()
+        with_retry(self._commit_results)
+        self.dirty_test_steps = {}
+
+        if not self.shard:
+            with span(u'queue notification', test_run_id=self.test_run.id):
+                self.outbox.put(self.test_run.id)
+
+    def _commit_results(self):
+        with transaction.atomic():
+            self._save_dirty_test_steps()
+            if not self.shard:
+                self.test_run.save(update_fields=[u'status', u'duration', u'text'])
+
+    @traced(u'before_scenario', _run_span_attributes)
     def before_scenario(self, scenario):
         self.test_step_num = 1  # reset the test step number we're on
 
-    def before_step(self, step):
-        log.debug(u'before_step: test_step_num = {}'.format(self.test_step_num))
-        # mark the step was running in the db
-        try:
-            ensure_connection()
-            test_step = self.test_run.testrunstep_set.get(
-                num=self.test_step_num,
-                example_row_num=self.example_row_num,
-                text=u'{} {}'.format(step.keyword, step.name)
-            )
-        except TestRunStep.DoesNotExist:
-            # don't care, if not found, then likely this is a substep that
-            # doesnt need to be reported in the ui
-            pass
-        else:
-            log.debug(u'setting step {} to running'.format(test_step.id))
-            test_step.status = RUNNING
-            test_step.timestamp_start = datetime.datetime.now(pytz.utc)
-            test_step.save()
+    def record_uploaded_screenshots(self):
+        """Point steps at their screenshots once the upload has finished.
+        """
+        for screenshot_key, test_step in self.screenshot_uploader.completed():
+            # substeps aren't in the db, their screenshots are uploaded but not recorded
+            if test_step:
+                self.update_test_step(test_step, screenshot_s3_key=screenshot_key)
 
+    @traced(u'before_step', _step_span_attributes)
+    def before_step(self, step):
+        log.debug(u'before_step: test_step_num = %s', self.test_step_num)
+        from django_bdd.models import RUNNING
+        self.check_lease()
+        # mark the step as running, if not found then likely this is a
+        # substep that doesnt need to be reported in the ui
+        test_step = self.get_test_step(step)
+        if test_step:
+            log.debug(u'setting step %s to running', test_step.id)
+            self.update_test_step(test_step, status=RUNNING, timestamp_start=datetime.datetime.now(pytz.utc))
+
+    @traced(u'after_step', _step_span_attributes)
     def after_step(self, step):
         log.debug(u'after_step')
 
         if step.error_message:
-            log.debug(u'adding step error message to test run text: {}'.format(step.error_message))
-            self.test_run.text += step.error_message
-            ensure_connection()
-            self.test_run.save()
+            log.debug(u'adding step error message to test run text: %s', step.error_message)
+            self.text.append(step.error_message)
+
+        # update our db stuff
+        # try to get the appropriate step
+        test_step = self.get_test_step(step)
 
-        screenshot_key = None
         # save a screenshot if the test result step got one
         if step.screenshot_path:
-            # put in s3
+            # put in s3, the step is pointed at it once the upload finishes
             filename = os.path.basename(step.screenshot_path)
             screenshot_key = SCREENSHOT_NAME_TEMPLATE.format(
                 test_id=self.test_run.test.id,
@@ -234,56 +432,48 @@ class TestDriver(Listener):
                 example_row_num=self.example_row_num,
                 filename=filename
             )
-            log.debug(u'saving screenshot at "{}" to s3 with key "{}"'.format(filename, screenshot_key))
-            with open(step.screenshot_path) as f:
-                self.s3_util.save_screenshot(screenshot_key, f)
-            log.debug(u'done saving screenshot to s3')
+            log.debug(u'queueing screenshot at "%s" to save to s3 with key "%s"', filename, screenshot_key)
+            self.screenshot_uploader.upload(screenshot_key, step.screenshot_path, context=test_step)
 
-        # update our db stuff
-        # try to get the appropriate step
-        # we query instead of caching locally because bdd steps might have
-        # substeps, which will still trigger this callback and throw off our
-        # counting/step mapping.
-        step_text = u'{} {}'.format(step.keyword, step.name)
-        try:
-            # use both num and text, because any of these steps could 'expand' via substeps
-            log.debug(u'getting test_step with {}'.format(
-                    {u'num': self.test_step_num, u'example_row_num': self.example_row_num, u'text': step_text}
-                )
-            )
-            ensure_connection()
-            test_step = self.test_run.testrunstep_set.get(
-                num=self.test_step_num,
-                example_row_num=self.example_row_num,
-                text=step_text
-            )
-        except TestRunStep.DoesNotExist:
+        if not test_step:
             # do nothing, because it's a step that wasn't in the original test
             # ie. a substep.
-            log.warn(u'after_step: test run step "{}" does not exist, could be a real error or a "substep"'.format(step_text))
+            log.warn(u'after_step: test run step "%s %s" does not exist, could be a real error or a "substep"', step.keyword, step.name)
         else:
-            test_step.status = step.status
-            test_step.timestamp_end = datetime.datetime.now(pytz.utc)
-            test_step.duration = step.duration
-            test_step.screenshot_s3_key = screenshot_key
-            ensure_connection()
-            test_step.save()
+            self.update_test_step(
+                test_step,
+                status=step.status,
+                timestamp_end=datetime.datetime.now(pytz.utc),
+                duration=step.duration
+            )
 
             # incr test step cuz we found the 'real' step
             self.test_step_num += 1
 
-        log.debug(u'after_step: test_step_num is now {}'.format(self.test_step_num))
+        self.record_uploaded_screenshots()
 
+        # write the buffered step changes and output every so often so the ui stays current
+        if time.time() - self.test_steps_flushed_at >= STEP_FLUSH_INTERVAL:
+            self.flush_test_steps()
+            self.save_text()
+
+        log.debug(u'after_step: test_step_num is now %s', self.test_step_num)
+
+    @traced(u'after_scenario', _run_span_attributes)
     def after_scenario(self, scenario):
         log.debug(u'after_scenario')
+        self.flush_test_steps()
+        self.save_text()
 
         # increment the 'Example' row number we're on
         self.example_row_num += 1
 
-        log.debug(u'after_scenario: example_row_num is now {}'.format(self.example_row_num))
+        log.debug(u'after_scenario: example_row_num is now %s', self.example_row_num)
 
+    @traced(u'after_feature', _run_span_attributes)
     def after_feature(self, feature):
-        log.debug(u'after_feature - feature status: {}'.format(feature.status))
+        log.debug(u'after_feature - feature status: %s', feature.status)
+        from django_bdd.models import FAILED, PASSED, SKIPPED
 
         # update the test run status based on the feature's final status
         if feature.status == u'skipped':
@@ -293,11 +483,5 @@ class TestDriver(Listener):
         elif feature.status == u'failed':
             self.test_run.status = FAILED
 
+        # committed with the step results by finalize() once the run is over
         self.test_run.duration = feature.duration
-        ensure_connection()
-        self.test_run.save()
-
-        # try sending an email about the test run
-        log.debug(u'sending notification email to test run user: {}'.format(self.test_run.user))
-        notify(self.test_run)
-        log.debug(u'done sending email')
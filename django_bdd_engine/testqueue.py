@@ -0,0 +1,400 @@
+import os
+import time
+import socket
+import logging
+import datetime
+import pytz  # timezone support: datetime.datetime.now(pytz.utc)
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min
+
+from django_bdd_engine.tasks.task import Task
+
+
+log = logging.getLogger(u'django-bdd')
+
+# identifies this engine process when it holds a lease on a test run
+ENGINE_ID = u'{}:{}'.format(socket.gethostname(), os.getpid())
+
+LEASE_KEY_TEMPLATE = u'django-bdd-engine-lease-{test_run_id}'
+
+QUEUE_BATCH_SIZE = 10  # how many NEW test runs to fetch from the db at a time
+QUEUE_SCAN_LIMIT = 100  # how many NEW test runs to look at when looking for one that can run
+QUEUE_STATS_SAMPLE_SIZE = 1000  # how many NEW test runs wait time percentiles are taken over
+LEASE_RENEWALS_PER_LEASE = 3  # how many times a lease is renewed in each lease period
+LEASE_RECORD_SECONDS = 7 * 24 * 60 * 60  # how long a lease record is kept in the cache after it was last renewed (seconds)
+LEASE_RECLAIM_GRACE = 10  # how long past its expiry a lease is left before its run is reclaimed, covering renewals in flight and clock skew between hosts (seconds)
+
+
+def claim_test_run(test_run_id, lease_seconds=None):
+    """Atomically move a test run from NEW to RUNNING. This is a compare and
+    set on the status column, so when several engines race for the same run
+    exactly one of them gets an update count of 1.
+
+    :param lease_seconds: if set, take out a lease on the run first, so it's
+        never RUNNING without one for reclaim_expired_test_runs to find. a
+        run another engine holds the lease on isn't claimed.
+    :return: whether or not this engine now owns the test run
+    :rtype: bool
+    """
+    from django_bdd.models import TestRun, NEW, RUNNING
+    if lease_seconds and not take_lease(test_run_id, lease_seconds):
+        return False
+
+    claimed = False
+    try:
+        claimed = TestRun.objects.filter(pk=test_run_id, status=NEW).update(status=RUNNING) == 1
+    finally:
+        if lease_seconds and not claimed:
+            release_lease(test_run_id)
+    return claimed
+
+
+def unclaim_test_run(test_run_id):
+    """Put a claimed test run that couldn't be started back in the queue.
+    """
+    from django_bdd.models import TestRun, NEW, RUNNING
+    return TestRun.objects.filter(pk=test_run_id, status=RUNNING).update(status=NEW) == 1
+
+
+class LeaseLost(Exception):
+    """Raised in a test run this engine no longer holds the lease on, eg.
+    because it went unrenewed long enough for another engine to reclaim it.
+    """
+
+
+def lease_record(lease_seconds):
+    """The value kept under a test run's lease key: the engine holding it and
+    when it lapses. The record outlives the lease by LEASE_RECORD_SECONDS, so
+    a lapsed lease can be told apart from a run that never had one.
+    """
+    return ENGINE_ID, time.time() + lease_seconds
+
+
+def lease_lapsed(record, grace=0):
+    """
+    :param grace: how long past its expiry the lease still counts as held
+    """
+    return record[1] + grace < time.time()
+
+
+def holds_record(record):
+    """
+    :return: whether the lease record is this engine's, and hasn't lapsed
+    """
+    return record is not None and record[0] == ENGINE_ID and not lease_lapsed(record)
+
+
+def take_lease(test_run_id, lease_seconds):
+    """
+    :return: whether the lease was free and this engine now holds it
+    """
+    try:
+        return cache.add(LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id), lease_record(lease_seconds), LEASE_RECORD_SECONDS)
+    except Exception as e:
+        log.error(u'error taking lease on test run {}: {}'.format(test_run_id, unicode(e)))
+        return False
+
+
+def renew_lease(test_run_id, lease_seconds):
+    """Record that this engine is still working on the test run. The lease
+    lives in the django cache, which has to be shared between engine hosts
+    (memcached, redis, database cache) for leases to mean anything.
+
+    :return: whether this engine still holds the lease
+    """
+    return test_run_id not in renew_leases([test_run_id], lease_seconds)
+
+
+def renew_leases(test_run_ids, lease_seconds):
+    """Renew the leases this engine still holds on the test runs. A lease that
+    lapsed, or that another engine has taken since, is left alone.
+
+    :return: the ids of the test runs whose lease this engine has lost
+    :rtype: list
+    """
+    keys = dict((LEASE_KEY_TEMPLATE.format(test_run_id=i), i) for i in test_run_ids)
+    try:
+        records = cache.get_many(keys.keys())
+        renewed = dict((key, lease_record(lease_seconds)) for key in keys if holds_record(records.get(key)))
+        if renewed:
+            cache.set_many(renewed, LEASE_RECORD_SECONDS)
+    except Exception as e:
+        # the leases are still held as far as anyone knows, they're renewed next time
+        log.error(u'error renewing lease on test runs {}: {}'.format(test_run_ids, unicode(e)))
+        return []
+
+    lost = sorted(test_run_id for key, test_run_id in keys.items() if key not in renewed)
+    if lost:
+        log.warn(u'lost the lease on test runs {}'.format(lost))
+    return lost
+
+
+def held_leases(test_run_ids):
+    """
+    :return: the ids of the test runs this engine holds the lease on. if the
+        cache can't be read they're all assumed to be, the runs carry on
+        until it can.
+    :rtype: list
+    """
+    keys = dict((LEASE_KEY_TEMPLATE.format(test_run_id=i), i) for i in test_run_ids)
+    try:
+        records = cache.get_many(keys.keys())
+    except Exception as e:
+        log.error(u'error checking the lease on test runs {}: {}'.format(test_run_ids, unicode(e)))
+        return list(test_run_ids)
+    return [test_run_id for test_run_id in test_run_ids if holds_record(records.get(LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id)))]
+
+
+def holds_lease(test_run_id):
+    return bool(held_leases([test_run_id]))
+
+
+def release_lease(test_run_id):
+    """Give up the lease on a test run, unless another engine has taken it
+    since.
+    """
+    key = LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id)
+    try:
+        record = cache.get(key)
+        if record is not None and record[0] == ENGINE_ID:
+            cache.delete(key)
+    except Exception as e:
+        log.error(u'error releasing lease on test run {}: {}'.format(test_run_id, unicode(e)))
+
+
+def reclaim_expired_test_runs():
+    """Put RUNNING test runs whose lease has lapsed back in the queue, so that
+    runs held by a crashed engine get picked up by another one. The steps and
+    text the crashed engine left are deleted, the next run records its own.
+
+    Runs without a lease record are left alone, eg. those of engines that
+    don't use leases.
+
+    :return: the ids of the test runs that were put back
+    :rtype: list
+    """
+    from django_bdd.models import TestRun, TestRunStep, NEW, RUNNING
+    keys = dict(
+        (LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id), test_run_id)
+        for test_run_id in TestRun.objects.filter(status=RUNNING).values_list(u'pk', flat=True)
+    )
+    if not keys:
+        return []
+
+    reclaimed = []
+    for key, record in cache.get_many(keys.keys()).items():
+        if not lease_lapsed(record, grace=LEASE_RECLAIM_GRACE):
+            continue
+
+        # compare and set again so a run that just finished isn't put back
+        test_run_id = keys[key]
+        with transaction.atomic():
+            if TestRun.objects.filter(pk=test_run_id, status=RUNNING).update(status=NEW, text=u'') != 1:
+                continue
+            TestRunStep.objects.filter(test_run_id=test_run_id).delete()
+
+        # until the record is gone no engine can take a new lease, so the run can't be claimed half reset
+        cache.delete(key)
+        log.warn(u'lease of {} on test run {} lapsed, putting it back in the queue'.format(record[0], test_run_id))
+        reclaimed.append(test_run_id)
+    return sorted(reclaimed)
+
+
+class LeaseRenewalTask(Task):
+    """Engine task that renews the leases on every test run the engine is
+    running, LEASE_RENEWALS_PER_LEASE times per lease period. It runs in the
+    engine process whatever the runs are doing, eg. waiting for a webdriver
+    session, and whichever runner they use.
+    """
+
+    def __init__(self, engine):
+        super(LeaseRenewalTask, self).__init__(interval=engine.lease_seconds / float(LEASE_RENEWALS_PER_LEASE))
+        self.engine = engine
+
+    def update(self):
+        # runs whose lease was lost notice themselves, see TestDriver.check_lease
+        test_run_ids = self.engine.running_test_run_ids()
+        if test_run_ids:
+            renew_leases(test_run_ids, self.engine.lease_seconds)
+
+
+def percentile(values, fraction):
+    """
+    :param values: sorted values
+    :param fraction: eg. 0.9 for the 90th percentile
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TestRunQueue(object):
+    """The engine's view of the NEW test runs. The queue is never loaded in
+    full: its length is a COUNT, and test runs are fetched oldest first in small
+    batches that are claimed one at a time.
+
+    Runs that can't run yet are passed over, not kept. Once a run behind them
+    is claimed the next scan starts from the oldest run again, so they're
+    looked at first once they can run, and so are runs put back in the queue
+    meanwhile. A scan that gives up after QUEUE_SCAN_LIMIT runs is carried on
+    by the next one, so runs further back aren't starved by a long line of
+    runs that can't run.
+
+    With a scheduler, windows of QUEUE_SCAN_LIMIT runs are fetched instead, and
+    claimed in the order the scheduler puts them in. The scan starts from the
+    oldest run again every scheduler.refresh_interval so new runs get a look in.
+    """
+
+    stats_sample_size = QUEUE_STATS_SAMPLE_SIZE
+
+    def __init__(self, batch_size=QUEUE_BATCH_SIZE, scheduler=None, parallelism=1):
+        """
+        :param scheduler: a django_bdd_engine.scheduling.Scheduler
+        :param parallelism: how many test runs the engine runs at once, for the scheduler's ETAs
+        """
+        self.batch_size = batch_size
+        self.scheduler = scheduler
+        self.parallelism = parallelism
+        self.prefetched = deque()
+        self.fetched_to = None  # the pk of the last test run fetched, None to start from the oldest
+        self.fetched_at = None  # when the scan last started from the oldest run
+
+    @staticmethod
+    def queryset():
+        from django_bdd.models import TestRun, NEW
+        return TestRun.objects.filter(status=NEW)
+
+    def count(self):
+        return self.queryset().count()
+
+    def fetch_batch(self, after_pk=None, limit=None):
+        """Fetch the next batch of test runs with their tests, leaving out the
+        big text fields which the engine doesn't need to dispatch a run.
+        """
+        queryset = self.queryset()
+        if after_pk is not None:
+            queryset = queryset.filter(pk__gt=after_pk)
+        return list(
+            queryset.select_related(u'test').defer(u'text', u'example_text').order_by(u'pk')[:limit or self.batch_size]
+        )
+
+    def refill(self):
+        """The next test runs to try claiming, after the last ones fetched, in
+        the order to try them.
+        """
+        if self.fetched_to is None:
+            self.fetched_at = time.time()
+
+        if self.scheduler:
+            batch = self.fetch_batch(after_pk=self.fetched_to, limit=QUEUE_SCAN_LIMIT)
+        else:
+            batch = self.fetch_batch(after_pk=self.fetched_to)
+        if not batch:
+            return []
+
+        self.fetched_to = batch[-1].pk
+        if self.scheduler:
+            batch = self.scheduler.order(batch, parallelism=self.parallelism)
+        return batch
+
+    def restart(self):
+        """Start the next scan from the oldest test run.
+        """
+        self.prefetched.clear()
+        self.fetched_to = None
+
+    def claim_next(self, lease_seconds=None, can_run=None):
+        """Claim the oldest test run that no other engine has taken yet,
+        refilling the prefetched batch from the db as it runs out.
+
+        :param lease_seconds: if set, take out a lease on the claimed run
+        :param can_run: if set, a function taking a test run and returning
+            whether it can run right now. runs that can't are left in the queue
+            and looked at again by a later scan.
+        :return: the claimed test run, or None if there's nothing to run
+        """
+        from django_bdd.models import RUNNING
+
+        # start from the oldest run now and then, so that runs queued since the window was fetched are scheduled too
+        if self.scheduler and self.fetched_at and time.time() - self.fetched_at >= self.scheduler.refresh_interval:
+            self.restart()
+
+        looked_at = set()
+        skipped = False
+        for _ in range(QUEUE_SCAN_LIMIT):
+            if not self.prefetched:
+                self.prefetched.extend(self.refill())
+                if not self.prefetched and self.fetched_to is not None:
+                    # the scan reached the newest run, go round again from the oldest
+                    self.fetched_to = None
+                    self.prefetched.extend(self.refill())
+                if not self.prefetched:
+                    return None
+
+            test_run = self.prefetched.popleft()
+            if test_run.pk in looked_at:
+                # went all the way round, the next scan picks up from here
+                self.prefetched.appendleft(test_run)
+                return None
+            looked_at.add(test_run.pk)
+
+            if can_run and not can_run(test_run):
+                skipped = True
+                continue
+
+            if claim_test_run(test_run.id, lease_seconds):
+                log.debug(u'claimed test run %s', test_run.id)
+                test_run.status = RUNNING
+                # what's left of the batch is still the oldest runs, unless some were passed over
+                if skipped or not self.prefetched:
+                    self.restart()
+                return test_run
+            log.debug(u'test run %s was claimed by another engine', test_run.id)
+
+        # gave up for now, the next scan carries on from here
+        return None
+
+    def stats(self, classify=None):
+        """Gather statistics about the queue with aggregate queries.
+
+        Wait times need to know when a test run was queued, which is read from
+        the test run field named by the DJANGO_BDD_ENGINE_QUEUED_AT_FIELD
+        setting. Without it, wait times are left out. The percentiles are taken
+        over a random sample of stats_sample_size runs when the queue is deeper.
+
+        :param classify: a function taking a test's steps and returning the
+            name of the runner type that would run it
+        :return: a dict with depth, oldest_wait, wait_p50, wait_p90 (seconds)
+            and depth_by_runner
+        :rtype: dict
+        """
+        queryset = self.queryset()
+        stats = {u'depth': queryset.count()}
+
+        queued_at_field = getattr(settings, u'DJANGO_BDD_ENGINE_QUEUED_AT_FIELD', None)
+        if queued_at_field:
+            now = datetime.datetime.now(pytz.utc)
+            oldest = queryset.aggregate(oldest=Min(queued_at_field))[u'oldest']
+            stats[u'oldest_wait'] = (now - oldest).total_seconds() if oldest else 0
+
+            # a deep queue isn't loaded to take its percentiles, a random sample of it is
+            sample = queryset.exclude(**{queued_at_field: None})
+            if stats[u'depth'] > self.stats_sample_size:
+                sample = sample.order_by(u'?')
+            queued_ats = sample.values_list(queued_at_field, flat=True)[:self.stats_sample_size]
+            waits = sorted((now - queued_at).total_seconds() for queued_at in queued_ats)
+            stats[u'wait_p50'] = percentile(waits, 0.5) or 0
+            stats[u'wait_p90'] = percentile(waits, 0.9) or 0
+
+        if classify:
+            depth_by_runner = {}
+            for row in queryset.order_by().values(u'test__steps').annotate(depth=Count(u'pk')):
+                runner_name = classify(row[u'test__steps'])
+                depth_by_runner[runner_name] = depth_by_runner.get(runner_name, 0) + row[u'depth']
+            stats[u'depth_by_runner'] = depth_by_runner
+
+        return stats
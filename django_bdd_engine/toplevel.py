@@ -2,32 +2,11 @@ import logging
 import logging.handlers
 import argparse
 
-# django backend
-from django.conf import settings as django_settings
-from django_root import settings as settings_file
-
 
 log = logging.getLogger(u'django-bdd')
 
 DEBUG = True
-
-try:
-    from amazon_django_bdd_engine.utility.toplevel import DEBUG as AMAZON_DEBUG
-    DEBUG = DEBUG or AMAZON_DEBUG
-except:
-    pass  # do nothing
-
-
-# also check if there's a stage command line arg (used by ARMED)
-parser = argparse.ArgumentParser(description=u'process command line args')
-parser.add_argument(u'--stage', dest=u'stage', action=u'store', default=u'beta',
-    help=u'set the django-bdd stage to run against - defaults to beta', required=False)
-args, unknown = parser.parse_known_args()
-
-# if we're set to debug, then let the stage arg triumph over the check for the apollo data
-if DEBUG:
-    if args.stage == u'prod':
-        DEBUG = False
+STAGE = None  # set by setup_stage()
 
 
 class Stage:
@@ -35,6 +14,10 @@ class Stage:
     BETA = u'beta'
 
     def __init__(self, stage):
+        # django backend
+        from django.conf import settings as django_settings
+        from django_root import settings as settings_file
+
         self.stage = stage
 
         if stage == Stage.BETA:
@@ -46,10 +29,41 @@ class Stage:
             settings_file.set_databases(DEBUG)
             django_settings.configure(settings_file)
 
-# stage setup
-if DEBUG:
-    log.info(u'running in beta')
-    STAGE = Stage(Stage.BETA)
-else:
-    log.info(u'running in prod')
-    STAGE = Stage(Stage.PROD)
+
+def setup_stage():
+    """Initialize the stage and the django backend. Nothing is configured on
+    import, the engine and test driver call this when they're created, and
+    anything that uses the django_bdd models before then must call it first.
+    It's safe to call more than once.
+
+    :return: the Stage
+    """
+    global DEBUG, STAGE
+    if STAGE is not None:
+        return STAGE
+
+    try:
+        from amazon_django_bdd_engine.utility.toplevel import DEBUG as AMAZON_DEBUG
+        DEBUG = DEBUG or AMAZON_DEBUG
+    except:
+        pass  # do nothing
+
+    # also check if there's a stage command line arg (used by ARMED)
+    parser = argparse.ArgumentParser(description=u'process command line args')
+    parser.add_argument(u'--stage', dest=u'stage', action=u'store', default=u'beta',
+        help=u'set the django-bdd stage to run against - defaults to beta', required=False)
+    args, unknown = parser.parse_known_args()
+
+    # if we're set to debug, then let the stage arg triumph over the check for the apollo data
+    if DEBUG:
+        if args.stage == u'prod':
+            DEBUG = False
+
+    # stage setup
+    if DEBUG:
+        log.info(u'running in beta')
+        STAGE = Stage(Stage.BETA)
+    else:
+        log.info(u'running in prod')
+        STAGE = Stage(Stage.PROD)
+    return STAGE
@@ -0,0 +1,56 @@
+import os
+import hashlib
+import logging
+from io import BytesIO
+
+from django_bdd_engine.utility.lru import LRUSet
+
+
+log = logging.getLogger(u'django-bdd')
+
+# screenshots stored by content are shared between every step, run and test that produced the same image
+SCREENSHOT_CONTENT_KEY_TEMPLATE = u'bdd/screenshots/{digest}{extension}'
+
+KNOWN_SCREENSHOTS_SIZE = 10000  # number of uploaded screenshot hashes to remember
+
+# keys this process has already uploaded, shared by every test run it runs
+known_screenshots = LRUSet(KNOWN_SCREENSHOTS_SIZE)
+
+
+def screenshot_content_key(data, path):
+    """
+    :param data: the screenshot's bytes, as captured
+    :param path: the screenshot's path, for its extension
+    :return: the s3 key for screenshots with exactly this content
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return SCREENSHOT_CONTENT_KEY_TEMPLATE.format(digest=hashlib.sha1(data).hexdigest(), extension=extension)
+
+
+def shrink_png(data, max_width=None):
+    """Scale a png down to max_width and recompress it at the highest zlib
+    level. Returns the data untouched if it isn't a png, PIL isn't installed or
+    the result wouldn't be smaller.
+    """
+    try:
+        from PIL import Image  # optional, only needed to shrink screenshots
+    except ImportError:
+        return data
+
+    try:
+        image = Image.open(BytesIO(data))
+        if image.format != u'PNG':
+            return data
+
+        if max_width and image.size[0] > max_width:
+            height = int(image.size[1] * float(max_width) / image.size[0])
+            image = image.resize((max_width, height), Image.LANCZOS)
+
+        out = BytesIO()
+        image.save(out, format=u'PNG', optimize=True, compress_level=9)
+        shrunk = out.getvalue()
+    except Exception as e:
+        log.warn(u'could not shrink screenshot: {}'.format(unicode(e)))
+        return data
+
+    return shrunk if len(shrunk) < len(data) else data
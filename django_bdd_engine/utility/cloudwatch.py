@@ -1,14 +1,17 @@
+import os
+import atexit
 import logging
 import datetime
+import threading
 import pytz  # timezone support: datetime.datetime.now(pytz.utc)
 
-# create boto cloudwatch connection for metrics
-from django.conf import settings
-import boto
-from boto.ec2.cloudwatch import CloudWatchConnection
+# metrics are sent through a backend from utility.metrics, cloudwatch unless settings say otherwise
+from django_bdd_engine.utility.metrics import STATISTICS, COUNTER, GAUGE, create_metrics_backend
 
-# region to record metrics in
-CLOUDWATCH_REGION = u'us-west-2'  # p-town baby
+
+FLUSH_INTERVAL = 60  # how often aggregated metrics are sent to the backend (seconds)
+MAX_SERIES = 1000  # distinct metrics (name and dimensions) held per interval, more than that are dropped
+BATCH_SIZE = 20  # metrics per PutMetricData call, the most cloudwatch accepts
 
 # metrics names
 METRIC_ENGINE_HEARTBEAT = u'EngineHeartbeat'
@@ -17,31 +20,147 @@ METRIC_ENGINE_TEST_QUEUE = u'EngineTestQueue'
 METRIC_ENGINE_TEST_RUN_DURATION = u'EngineTestRunDuration'
 METRIC_ENGINE_EXECUTION_TIME_SANS_TEST = u'EngineExecutionTimeSansTest'
 METRIC_ENGINE_TEST_RUN_ERROR = u'EngineTestRunError'
-
-# a region object must be passed to the connection, this is how to get it
-for r in boto.ec2.cloudwatch.regions():
-    if (r.name == CLOUDWATCH_REGION):
-        region = r
+METRIC_ENGINE_WORKER_UTILISATION = u'EngineWorkerUtilisation'
+METRIC_ENGINE_QUEUE_OLDEST_WAIT = u'EngineQueueOldestWait'
+METRIC_ENGINE_QUEUE_WAIT_P50 = u'EngineQueueWaitP50'
+METRIC_ENGINE_QUEUE_WAIT_P90 = u'EngineQueueWaitP90'
+METRIC_ENGINE_QUEUE_DEPTH = u'EngineQueueDepth'
+METRIC_ENGINE_DB_RECONNECTS = u'EngineDbReconnects'
+METRIC_ENGINE_DB_RETRIES = u'EngineDbRetries'
+METRIC_ENGINE_METRICS_DROPPED = u'EngineMetricsDropped'
+METRIC_ENGINE_TEST_RUNS_COALESCED = u'EngineTestRunsCoalesced'
+METRIC_ENGINE_TASK_DURATION = u'EngineTaskDuration'
+METRIC_ENGINE_TASK_TIMEOUT = u'EngineTaskTimeout'
+METRIC_ENGINE_TEST_RUN_PREFLIGHT_FAILED = u'EngineTestRunPreflightFailed'
+METRIC_ENGINE_LOGGING_TIME_PER_STEP = u'EngineLoggingTimePerStep'
 
 log = logging.getLogger(u'django-bdd')
 
-# initialize a connection to cloudwatch for reporting metrics
-cloudwatch = CloudWatchConnection(
-    aws_access_key_id=settings.AWS_ACCESS_KEY,
-    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-    region=region
-)
 
+class MetricsAggregator(object):
+    """Collects metrics in memory and sends them to a backend from a
+    background thread every flush_interval seconds, in as few calls as
+    possible. Reporting a metric never waits on the network.
+    """
+
+    def __init__(self, backend=None, flush_interval=FLUSH_INTERVAL, max_series=MAX_SERIES):
+        """
+        :param backend: a MetricsBackend, if None one is created from settings when metrics are first sent
+        """
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_series = max_series
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.series = {}
+        self.dropped = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def record(self, kind, name, value, dimensions=None):
+        # a forked process starts with its own empty metrics and flush thread, the parent sends what it had
+        if os.getpid() != self.pid:
+            self._reset()
+
+        key = (kind, name, tuple(sorted(dimensions.items())) if dimensions else ())
+        with self.lock:
+            current = self.series.get(key)
+            if current is None:
+                if len(self.series) >= self.max_series:
+                    self.dropped += 1
+                    return
+                current = [value, value, 0, 0] if kind == STATISTICS else 0
+
+            if kind == STATISTICS:
+                current = [min(current[0], value), max(current[1], value), current[2] + value, current[3] + 1]
+            elif kind == COUNTER:
+                current += value
+            else:
+                current = value
+            self.series[key] = current
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_forever)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def flush(self):
+        """Send everything collected so far.
+        """
+        with self.lock:
+            series, self.series = self.series, {}
+            dropped, self.dropped = self.dropped, 0
+
+        batch = [
+            (kind, name, dict(dimensions) if dimensions else None, value)
+            for (kind, name, dimensions), value in series.items()
+        ]
+        if dropped:
+            log.error(u'{} metrics were dropped'.format(dropped))
+            batch.append((COUNTER, METRIC_ENGINE_METRICS_DROPPED, None, dropped))
+
+        if not batch:
+            return
+
+        timestamp = datetime.datetime.now(pytz.utc)
+        for start in range(0, len(batch), BATCH_SIZE):
+            try:
+                if self.backend is None:
+                    self.backend = create_metrics_backend()
+                self.backend.send(batch[start:start + BATCH_SIZE], timestamp)
+            except Exception as e:
+                log.error(u'error reporting metrics: {}'.format(unicode(e)))
+                with self.lock:
+                    self.dropped += len(batch[start:start + BATCH_SIZE])
+
+    def _flush_forever(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def shutdown(self):
+        """Stop the flush thread and send whatever is left.
+        """
+        if os.getpid() != self.pid:
+            return
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
 
-def put_metric_data(name, value, timestamp=datetime.datetime.now(pytz.utc)):
-    """Utility function for adding a metric to cloudwatch.
+
+metrics = MetricsAggregator()
+atexit.register(metrics.shutdown)
+
+
+def put_metric_data(name, value, timestamp=None, dimensions=None):
+    """Utility function for adding a metric to cloudwatch. Values are
+    aggregated into statistics (min, max, sum, count) and sent in the
+    background once per FLUSH_INTERVAL, stamped with the time they're sent.
+    timestamp is accepted for compatibility and ignored.
+    """
+    metrics.record(STATISTICS, name, value, dimensions=dimensions)
+
+
+def increment_metric(name, value=1, dimensions=None):
+    """Add to a counter, which is sent as the total for the interval.
+    """
+    metrics.record(COUNTER, name, value, dimensions=dimensions)
+
+
+def set_metric_gauge(name, value, dimensions=None):
+    """Set a gauge, which is sent as the last value set in the interval.
     """
-    try:
-        cloudwatch.put_metric_data(
-            settings.CLOUDWATCH_NAMESPACE,
-            name,
-            value=value,
-            timestamp=timestamp
-        )
-    except Exception as e:
-        log.error(u'error reporting metric: {}'.format(unicode(e)))
+    metrics.record(GAUGE, name, value, dimensions=dimensions)
+
+
+def set_metrics_backend(backend):
+    """Send metrics to backend instead of the one named in settings.
+    """
+    metrics.backend = backend
+
+
+def shutdown_metrics():
+    metrics.shutdown()
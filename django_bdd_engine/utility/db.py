@@ -0,0 +1,86 @@
+import logging
+import time
+import threading
+
+from django.db import connection, InterfaceError, OperationalError
+
+
+log = logging.getLogger(u'django-bdd')
+
+IDLE_PING_THRESHOLD = 60  # how long a connection can sit unused before it's checked (seconds)
+
+# fragments of the errors databases give when the connection has been dropped under us
+DISCONNECT_MESSAGES = (
+    u'gone away',
+    u'lost connection',
+    u'broken pipe',
+    u'server closed the connection',
+    u'terminating connection',
+    u'connection already closed',
+    u'connection not open',
+)
+
+# how many times this process had to reconnect, and how many operations it retried
+connection_stats = {
+    u'reconnects': 0,
+    u'retries': 0,
+}
+
+# django's connections are per thread, so is when they were last used
+_local = threading.local()
+
+
+def reset_connection():
+    """Drop the current connection, django opens a new one on the next query.
+    """
+    connection_stats[u'reconnects'] += 1
+    connection.close()
+
+
+def is_disconnect(error):
+    """
+    :return: whether the error means the db connection is gone
+    :rtype: bool
+    """
+    if isinstance(error, InterfaceError):
+        return True
+    if isinstance(error, OperationalError):
+        message = unicode(error).lower()
+        return any(fragment in message for fragment in DISCONNECT_MESSAGES)
+    return False
+
+
+def ensure_connection():
+    """Make sure the django db connection is usable before a query or save.
+    A connection that has been used recently is trusted, one that has been idle
+    for longer than IDLE_PING_THRESHOLD is pinged and replaced if it has timed
+    out.
+    """
+    now = time.time()
+    idle = now - getattr(_local, u'last_used', now)
+    _local.last_used = now
+
+    if connection.connection is None or idle < IDLE_PING_THRESHOLD:
+        return
+
+    if not connection.is_usable():
+        log.debug(u'db connection was idle for %s seconds and is no longer usable, reconnecting', idle)
+        reset_connection()
+
+
+def with_retry(func, *args, **kwargs):
+    """Call func, and if the db connection turns out to be gone, reconnect and
+    call it once more. Only for idempotent operations, and never inside a
+    transaction, which a new connection can't continue.
+    """
+    ensure_connection()
+    try:
+        return func(*args, **kwargs)
+    except (InterfaceError, OperationalError) as e:
+        if not is_disconnect(e) or connection.in_atomic_block:
+            raise
+
+        log.debug(u'db connection was lost (%s), reconnecting and retrying', e)
+        reset_connection()
+        connection_stats[u'retries'] += 1
+        return func(*args, **kwargs)
@@ -0,0 +1,97 @@
+import logging
+import threading
+import weakref
+from multiprocessing.util import register_after_fork
+
+from django.core.cache import caches
+from django.db import connection
+
+from django_bdd_engine.features import feature_cache
+from django_bdd_engine.utility.logs import stop_async_logging
+from django_bdd_engine.utility.cloudwatch import shutdown_metrics
+
+
+# objects with a lock their forked children use too, to the function that makes a new one
+_lock_owners = weakref.WeakKeyDictionary()
+
+
+class _LoggingLocks(object):
+    """Stands in for the logging module's locks in multiprocessing's after
+    fork registry, which only takes objects it can weakly reference.
+    """
+
+
+_logging_locks = _LoggingLocks()
+
+
+def _logging_handlers():
+    return [handler for handler in (ref() for ref in logging._handlerList) if handler is not None and handler.lock]
+
+
+def _new_logging_locks(_):
+    logging._lock = threading.RLock()
+    for handler in _logging_handlers():
+        handler.createLock()
+
+
+def _new_lock(owner):
+    owner.lock = _lock_owners[owner]()
+
+
+register_after_fork(_logging_locks, _new_logging_locks)
+
+
+def register_lock_owner(owner, factory=threading.Lock):
+    """Have start_process hold owner.lock while it forks, and give the child a
+    new one. For objects used from several threads whose forked children use
+    them too.
+
+    :param factory: makes the lock owner.lock is
+    """
+    _lock_owners[owner] = factory
+    register_after_fork(owner, _new_lock)
+
+
+def start_process(process):
+    """Start a forked multiprocessing.Process while the engine's other threads
+    (async logging, metrics, tasks, session proxies) may be running.
+
+    A forked child gets a copy of every lock as it was, and a lock another
+    thread held at that moment is never released in the child, which then
+    deadlocks on it, eg. on its first log record. The locks children use, the
+    logging module's and its handlers' included, are held while the process
+    forks so that what they guard is consistent, and are replaced in the
+    child. The db connection and cache clients are closed first so that
+    parent and child don't share their sockets.
+    """
+    connection.close()
+    for cache in caches.all():
+        cache.close()
+
+    # logging is called with an owner's lock held, never the reverse, so the owners' locks are taken first
+    owner_locks = [owner.lock for owner in list(_lock_owners.keys())]
+    for lock in owner_locks:
+        lock.acquire()
+    logging._acquireLock()
+    handler_locks = [handler.lock for handler in _logging_handlers()]
+    for lock in handler_locks:
+        lock.acquire()
+    try:
+        process.start()
+    finally:
+        for lock in reversed(handler_locks):
+            lock.release()
+        logging._releaseLock()
+        for lock in reversed(owner_locks):
+            lock.release()
+
+
+def finish_process():
+    """Clean up before a process started with start_process exits. Forked
+    processes skip atexit handlers, so the metrics they've collected are sent
+    and their feature files removed here, and the records left in the async
+    logging queue are handled.
+    """
+    shutdown_metrics()
+    feature_cache.clear()
+    stop_async_logging()
@@ -0,0 +1,54 @@
+"""Checks that importing the engine stays cheap and free of side effects. Each
+module is imported in a fresh interpreter, so nothing is already loaded:
+
+    python -m django_bdd_engine.utility.importtime
+"""
+import sys
+import json
+import subprocess
+
+
+IMPORT_TIME_BUDGET = 0.5  # longest an import may take (seconds)
+
+MODULES = (
+    u'django_bdd_engine.engine',
+    u'django_bdd_engine.testdriver',
+)
+
+MEASURE_SCRIPT = u'''
+import json, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+from django.conf import settings
+print(json.dumps({{"seconds": elapsed, "configured": settings.configured}}))
+'''
+
+
+def measure_import(module):
+    """
+    :return: how long the import took in seconds, and whether it configured django
+    :rtype: dict
+    """
+    output = subprocess.check_output([sys.executable, u'-c', MEASURE_SCRIPT.format(module=module)])
+    return json.loads(output.decode(u'utf8').strip().splitlines()[-1])
+
+
+def main():
+    ok = True
+    for module in MODULES:
+        result = measure_import(module)
+        over_budget = result[u'seconds'] > IMPORT_TIME_BUDGET
+        print(u'{}: {:.3f}s (budget {}s){}{}'.format(
+            module,
+            result[u'seconds'],
+            IMPORT_TIME_BUDGET,
+            u' OVER BUDGET' if over_budget else u'',
+            u' CONFIGURED DJANGO ON IMPORT' if result[u'configured'] else u''
+        ))
+        ok = ok and not over_budget and not result[u'configured']
+    return 0 if ok else 1
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""Logging that stays off the engine's threads, and a capture of each test
+run's log records.
+
+start_async_logging() puts the engine logger's handlers behind a queue, so
+they run on a thread of their own.
+
+While a RunLogCapture runs, the logger's level is lowered to the capture's,
+so it can keep eg. debug records for the run, and the handlers are filtered
+so they don't see more than they did before. The rest of the time the
+logger's level is left alone, and records below it cost next to nothing.
+"""
+import os
+import copy
+import gzip
+import time
+import Queue
+import logging
+import datetime
+import threading
+import collections
+from io import BytesIO
+
+
+LOGGER_NAME = u'django-bdd'
+LOG_QUEUE_SIZE = 10000  # records waiting for the handlers before new ones are dropped
+LOG_FLUSH_TIMEOUT = 5  # longest wait for queued records to be handled when logging stops (seconds)
+RUN_LOG_MAX_LENGTH = 1024 * 1024  # most characters of log messages kept per test run, the oldest are dropped
+RUN_LOG_KEY_TEMPLATE = u'bdd/results/{test_id}/{run_id}/{name}.log.gz'
+
+log = logging.getLogger(LOGGER_NAME)
+
+# how many records went through the handlers below, how many the queue dropped, and the time they took on the
+# threads that logged them
+logging_stats = {u'records': 0, u'dropped': 0, u'seconds': 0.0}
+
+_captures_lock = threading.Lock()
+_captures = []  # the RunLogCaptures running
+_lowered = []  # (level the logger had, filter, handlers filtered) while captures have the level lowered
+
+
+def _reached_handlers(logger):
+    """
+    :return: the handlers logging calls with the logger's records, its own and
+        its ancestors', see Logger.callHandlers
+    """
+    handlers = []
+    current = logger
+    while current:
+        handlers.extend(current.handlers)
+        current = current.parent if current.propagate else None
+    return handlers
+
+
+class _EngineLevelFilter(logging.Filter):
+    """Keeps the engine logger's records below level from a handler, and lets
+    every other logger's through.
+    """
+
+    def __init__(self, level):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or record.name != LOGGER_NAME
+
+
+def _update_capture_level():
+    """Lower the engine logger's level to the lowest level a running capture
+    wants, or put it back once none do. Called with _captures_lock held.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if _lowered:
+        level, level_filter, handlers = _lowered.pop()
+        logger.setLevel(level)
+        for handler in handlers:
+            handler.removeFilter(level_filter)
+
+    if not _captures:
+        return
+    capture_level = min(capture.level for capture in _captures)
+    if logger.getEffectiveLevel() <= capture_level:
+        return
+
+    level_filter = _EngineLevelFilter(logger.getEffectiveLevel())
+    handlers = [handler for handler in _reached_handlers(logger) if handler not in _captures]
+    for handler in handlers:
+        handler.addFilter(level_filter)
+    _lowered.append((logger.level, level_filter, handlers))
+    logger.setLevel(capture_level)
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to other handlers on a thread of its own, which formats
+    and writes them. Records are dropped rather than waited on when the queue
+    is full.
+
+    The thread belongs to the process that started it, a forked process
+    starts its own on its first record.
+    """
+
+    def __init__(self, handlers, queue_size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.pid = None
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(maxsize=self.queue_size)
+        self.thread = threading.Thread(target=self._handle_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        # the arguments may change once the record is queued, and tracebacks can't wait. other handlers get the
+        # record after this one, so it's copied
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        start = time.time()
+        try:
+            if self.pid != os.getpid():
+                self._start()
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            logging_stats[u'dropped'] += 1
+        except Exception:
+            self.handleError(record)
+        logging_stats[u'records'] += 1
+        logging_stats[u'seconds'] += time.time() - start
+
+    def _handle_forever(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        handler.handleError(record)
+
+    def close(self):
+        """Handle the queued records and stop the thread.
+        """
+        if self.pid == os.getpid():
+            self.pid = None
+            try:
+                self.queue.put(None, timeout=LOG_FLUSH_TIMEOUT)
+                self.thread.join(LOG_FLUSH_TIMEOUT)
+            except Queue.Full:
+                pass
+            for handler in self.handlers:
+                handler.flush()
+        logging.Handler.close(self)
+
+
+def start_async_logging():
+    """Move the handlers the engine logger's records reach, its own and its
+    ancestors', behind a QueueHandler. The logger stops propagating, its
+    level stays as it was.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return
+
+    queue_handler = QueueHandler(_reached_handlers(logger))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+
+def stop_async_logging():
+    """Handle the records still queued. For processes that exit without
+    running atexit handlers, others stop with logging.shutdown.
+    """
+    for handler in logging.getLogger(LOGGER_NAME).handlers:
+        if isinstance(handler, QueueHandler):
+            handler.close()
+
+
+class RunLogCapture(logging.Handler):
+    """Keeps the engine's log records from level up while a test run runs,
+    from every thread, up to max_length characters of messages. Once there
+    are more, the oldest are dropped.
+    """
+
+    def __init__(self, max_length=RUN_LOG_MAX_LENGTH, level=logging.DEBUG):
+        logging.Handler.__init__(self, level)
+        self.max_length = max_length
+        self.records = collections.deque()  # (created, level name, thread name, message)
+        self.length = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        start = time.time()
+        try:
+            message = record.getMessage()
+            if record.exc_info:
+                message += u'\n' + logging.Formatter().formatException(record.exc_info)
+            self.records.append((record.created, record.levelname, record.threadName, message))
+            self.length += len(message)
+            while self.length > self.max_length and len(self.records) > 1:
+                self.length -= len(self.records.popleft()[3])
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+        logging_stats[u'records'] += 1
+        logging_stats[u'seconds'] += time.time() - start
+
+    def start(self):
+        with _captures_lock:
+            logging.getLogger(LOGGER_NAME).addHandler(self)
+            _captures.append(self)
+            _update_capture_level()
+
+    def stop(self):
+        with _captures_lock:
+            logging.getLogger(LOGGER_NAME).removeHandler(self)
+            if self in _captures:
+                _captures.remove(self)
+            _update_capture_level()
+
+    def text(self):
+        lines = []
+        if self.dropped:
+            lines.append(u'... {} earlier records dropped ...'.format(self.dropped))
+        for created, level_name, thread_name, message in list(self.records):
+            if isinstance(message, bytes):
+                message = message.decode(u'utf8', u'replace')
+            timestamp = datetime.datetime.utcfromtimestamp(created).isoformat()
+            lines.append(u'{} {} {} {}'.format(timestamp, level_name, thread_name, message))
+        return u'\n'.join(lines) + u'\n'
+
+    def upload(self, s3_util, key):
+        """Save the captured log to s3 gzipped.
+
+        :return: whether it was saved
+        """
+        data = BytesIO()
+        with gzip.GzipFile(fileobj=data, mode=u'wb') as f:
+            f.write(self.text().encode(u'utf8'))
+        data.seek(0)
+        try:
+            s3_util.save_screenshot(key, data)  # stores any file under the key
+        except Exception as e:
+            log.error(u'error saving a test run log to s3 with key "{}": {}'.format(key, unicode(e)))
+            return False
+        return True
@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread safe dict that forgets the least recently used entries once it
+    holds more than size of them.
+    """
+
+    def __init__(self, size, on_evict=None):
+        """
+        :param on_evict: called with the key and value of each forgotten entry
+        """
+        self.size = size
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            # move it to the most recently used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                if self.on_evict:
+                    self.on_evict(evicted_key, evicted_value)
+
+    def clear(self):
+        with self.lock:
+            if self.on_evict:
+                for key, value in self.entries.items():
+                    self.on_evict(key, value)
+            self.entries.clear()
+
+
+class LRUSet(LRUCache):
+    """An LRUCache used as a set.
+    """
+
+    def add(self, entry):
+        self.set(entry, True)
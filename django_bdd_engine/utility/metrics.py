@@ -0,0 +1,154 @@
+import logging
+import socket
+
+from django.conf import settings
+
+
+log = logging.getLogger(u'django-bdd')
+
+# region to record metrics in
+CLOUDWATCH_REGION = u'us-west-2'  # p-town baby
+
+# kinds of metrics
+STATISTICS = u'statistics'  # min, max, sum and count of every value reported in the interval
+COUNTER = u'counter'  # sum of the values reported in the interval
+GAUGE = u'gauge'  # the last value reported in the interval
+
+
+class MetricsBackend(object):
+    """Where aggregated metrics are sent. Backends connect to whatever they
+    send to when they first send, not when they're created.
+    """
+
+    def send(self, series, timestamp):
+        """Send one batch of aggregated metrics.
+
+        :param series: (kind, name, dimensions, value) tuples, value is a
+            [minimum, maximum, sum, count] list for statistics
+        :param timestamp: when the batch was collected
+        """
+        raise NotImplementedError()
+
+
+class NullBackend(MetricsBackend):
+    """Throws metrics away.
+    """
+
+    def send(self, series, timestamp):
+        pass
+
+
+class MemoryBackend(MetricsBackend):
+    """Keeps every metric sent to it, for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, series, timestamp):
+        self.sent.extend(series)
+
+
+class StatsdBackend(MetricsBackend):
+    """Sends metrics to a statsd agent over udp. Counters and gauges map
+    directly, statistics are sent as .min/.max/.sum/.count gauges.
+    """
+
+    def __init__(self, host=u'127.0.0.1', port=8125, prefix=u'django_bdd_engine'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = None
+
+    def _lines(self, kind, name, dimensions, value):
+        name = u'.'.join([self.prefix, name] + [u'{}_{}'.format(key, dimensions[key]) for key in sorted(dimensions or {})])
+        if kind == COUNTER:
+            return [u'{}:{}|c'.format(name, value)]
+        if kind == GAUGE:
+            return [u'{}:{}|g'.format(name, value)]
+        return [u'{}.{}:{}|g'.format(name, statistic, value[i]) for i, statistic in enumerate((u'min', u'max', u'sum', u'count'))]
+
+    def send(self, series, timestamp):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        lines = []
+        for kind, name, dimensions, value in series:
+            lines.extend(self._lines(kind, name, dimensions, value))
+        self.sock.sendto(u'\n'.join(lines).encode(u'utf8'), self.address)
+
+
+class CloudWatchBackend(MetricsBackend):
+    """Sends metrics to cloudwatch. boto can't mix values and statistic sets
+    in one PutMetricData call, so a batch takes a call for each.
+    """
+
+    def __init__(self, region=CLOUDWATCH_REGION):
+        self.region = region
+        self.connection = None
+
+    def _connect(self):
+        # boto is only imported, and the region list only fetched, once there's something to send
+        import boto.ec2.cloudwatch
+        from boto.ec2.cloudwatch import CloudWatchConnection
+
+        # a region object must be passed to the connection, this is how to get it
+        region = None
+        for r in boto.ec2.cloudwatch.regions():
+            if r.name == self.region:
+                region = r
+
+        return CloudWatchConnection(
+            aws_access_key_id=settings.AWS_ACCESS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region=region
+        )
+
+    def send(self, series, timestamp):
+        if self.connection is None:
+            self.connection = self._connect()
+
+        values, statistics = [], []
+        for kind, name, dimensions, value in series:
+            # boto iterates every metric's dimensions once any has them, and only sends string values
+            dimensions = dict((key, unicode(item)) for key, item in (dimensions or {}).items())
+            if kind == STATISTICS:
+                statistic_set = {u'minimum': value[0], u'maximum': value[1], u'sum': value[2], u'samplecount': value[3]}
+                statistics.append((name, dimensions, statistic_set))
+            else:
+                values.append((name, dimensions, value))
+
+        if values:
+            names, dimensions, values = zip(*values)
+            self.connection.put_metric_data(
+                settings.CLOUDWATCH_NAMESPACE,
+                list(names),
+                value=list(values),
+                timestamp=timestamp,
+                dimensions=list(dimensions)
+            )
+        if statistics:
+            names, dimensions, statistics = zip(*statistics)
+            self.connection.put_metric_data(
+                settings.CLOUDWATCH_NAMESPACE,
+                list(names),
+                timestamp=timestamp,
+                dimensions=list(dimensions),
+                statistics=list(statistics)
+            )
+
+
+METRICS_BACKENDS = {
+    u'cloudwatch': CloudWatchBackend,
+    u'statsd': StatsdBackend,
+    u'memory': MemoryBackend,
+    u'null': NullBackend,
+}
+
+
+def create_metrics_backend():
+    """Create the backend named by the DJANGO_BDD_ENGINE_METRICS_BACKEND
+    setting, cloudwatch by default.
+    """
+    name = getattr(settings, u'DJANGO_BDD_ENGINE_METRICS_BACKEND', u'cloudwatch')
+    log.debug(u'sending metrics to %s', name)
+    return METRICS_BACKENDS[name]()
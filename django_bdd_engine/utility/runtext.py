@@ -0,0 +1,117 @@
+import logging
+import tempfile
+
+from django.conf import settings
+
+
+log = logging.getLogger(u'django-bdd')
+
+TEXT_MAX_LENGTH = 64 * 1024  # most characters of output kept in a test run's text
+TEXT_TRUNCATION_MARKER = u'\n\n... {count} characters truncated ...\n\n'
+TEXT_SPILLED_MARKER = u'\n\n... {count} characters truncated, the full output is in s3 at "{key}" ...\n\n'
+TEXT_SPILL_KEY_TEMPLATE = u'bdd/results/{test_id}/{run_id}/output.txt'
+
+
+class RunText(object):
+    """The output a test run adds to its text, kept in memory and bounded.
+
+    Once the output passes max_length, only its beginning and end are kept,
+    around a marker saying how much was cut. With spill, the whole output is
+    also appended to a local file as it comes in, and uploaded to s3 by
+    upload_spill() so the marker can point at it.
+
+    Appending never touches the db, the owner writes value() at checkpoints.
+    """
+
+    def __init__(self, test_run, max_length=None, spill=None):
+        """
+        :param max_length: the DJANGO_BDD_ENGINE_TEXT_MAX_LENGTH setting by default
+        :param spill: the DJANGO_BDD_ENGINE_TEXT_SPILL setting by default
+        """
+        self.test_run = test_run
+        self.base = test_run.text  # what the text held before this run added to it
+        self.max_length = max_length or getattr(settings, u'DJANGO_BDD_ENGINE_TEXT_MAX_LENGTH', TEXT_MAX_LENGTH)
+        self.head_length = self.max_length // 2
+        self.tail_length = self.max_length - self.head_length
+
+        self.head = u''
+        self.tail = u''
+        self.length = 0  # characters appended in all
+        self.dirty = False
+
+        if spill is None:
+            spill = getattr(settings, u'DJANGO_BDD_ENGINE_TEXT_SPILL', False)
+        self.spill_file = tempfile.NamedTemporaryFile(suffix=u'.txt') if spill else None
+        self.spill_key = None
+
+    def append(self, text):
+        if not text:
+            return
+        self.length += len(text)
+        self.dirty = True
+        if self.spill_file:
+            self.spill_file.write(text.encode(u'utf8'))
+
+        if len(self.head) < self.head_length:
+            room = self.head_length - len(self.head)
+            self.head += text[:room]
+            text = text[room:]
+        if text:
+            self.tail = (self.tail + text)[-self.tail_length:]
+
+    @property
+    def truncated(self):
+        return self.length > len(self.head) + len(self.tail)
+
+    def output(self):
+        """
+        :return: the bounded text this run added
+        """
+        if not self.truncated:
+            return self.head + self.tail
+
+        count = self.length - len(self.head) - len(self.tail)
+        if self.spill_key:
+            marker = TEXT_SPILLED_MARKER.format(count=count, key=self.spill_key)
+        else:
+            marker = TEXT_TRUNCATION_MARKER.format(count=count)
+        return self.head + marker + self.tail
+
+    def value(self):
+        """
+        :return: the test run's whole text, to save
+        """
+        return self.base + self.output()
+
+    def checkpoint(self):
+        """Put the buffered text on the test run, and report whether it changed
+        since the last checkpoint.
+        """
+        if not self.dirty:
+            return False
+        self.test_run.text = self.value()
+        self.dirty = False
+        return True
+
+    def upload_spill(self, s3_util):
+        """Upload the full output if it was truncated. Call before the last
+        checkpoint, so the marker can say where it went.
+        """
+        if not self.spill_file or not self.truncated:
+            return
+
+        key = TEXT_SPILL_KEY_TEMPLATE.format(test_id=self.test_run.test_id, run_id=self.test_run.id)
+        try:
+            self.spill_file.flush()
+            with open(self.spill_file.name, u'rb') as f:
+                s3_util.save_screenshot(key, f)  # stores any file under the key, screenshots are just its usual use
+            self.spill_key = key
+            self.dirty = True
+            log.debug(u'saved the full output of test run %s to s3 with key "%s"', self.test_run.id, key)
+        except Exception as e:
+            log.error(u'error saving the full output of test run {} to s3: {}'.format(self.test_run.id, unicode(e)))
+
+    def close(self):
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
@@ -0,0 +1,211 @@
+"""Span based tracing of the engine and test runs, and on demand profiling.
+
+Tracing is on when the DJANGO_BDD_ENGINE_TRACE_DIR setting names a folder.
+Each test run then gets a trace of what it spent its time on, written to
+run-<id>.json in that folder, and the engine loop's own spans are written to
+engine-<pid>-<time>.json every ENGINE_TRACE_INTERVAL. The files are in the
+chrome trace event format, open them in chrome://tracing or ui.perfetto.dev.
+
+Profiling is asked for at runtime through the django cache, so it can be
+turned on for a run, a test, or a fraction of all runs from a django shell
+without redeploying:
+
+    cache.set(u'django-bdd-engine-profile-run-123', True)
+    cache.set(u'django-bdd-engine-profile-test-45', True)
+    cache.set(u'django-bdd-engine-profile-rate', 0.01)
+
+Profiled runs leave run-<id>.prof, cProfile stats, in the trace folder or
+the temp folder.
+"""
+import os
+import json
+import time
+import random
+import logging
+import cProfile
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+log = logging.getLogger(u'django-bdd')
+
+ENGINE_TRACE_INTERVAL = 60  # how much of the engine loop goes in each engine trace file (seconds)
+MAX_SPANS = 100000  # most spans kept in one trace, later ones are counted but dropped
+
+PROFILE_RUN_KEY_TEMPLATE = u'django-bdd-engine-profile-run-{test_run_id}'
+PROFILE_TEST_KEY_TEMPLATE = u'django-bdd-engine-profile-test-{test_id}'
+PROFILE_RATE_KEY = u'django-bdd-engine-profile-rate'
+
+_local = threading.local()
+
+
+def trace_dir():
+    return getattr(settings, u'DJANGO_BDD_ENGINE_TRACE_DIR', None)
+
+
+class Trace(object):
+    """The spans recorded for one test run, or one stretch of the engine
+    loop. Spans can be added from any thread.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.spans = []  # (name, start, duration, thread id, attributes)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, start, duration, attributes):
+        with self.lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append((name, start, duration, threading.current_thread().ident, attributes))
+
+    def events(self):
+        """
+        :return: the spans as chrome trace events
+        """
+        pid = os.getpid()
+        events = [{
+            u'name': u'process_name', u'ph': u'M', u'pid': pid,
+            u'args': dict(self.attributes, name=self.name, dropped_spans=self.dropped),
+        }]
+        with self.lock:
+            for name, start, duration, thread_id, attributes in self.spans:
+                events.append({
+                    u'name': name, u'ph': u'X', u'pid': pid, u'tid': thread_id,
+                    u'ts': int(start * 1000000), u'dur': int(duration * 1000000), u'args': attributes,
+                })
+        return events
+
+    def write(self, path):
+        temp_path = path + u'.tmp'
+        with open(temp_path, u'w') as f:
+            json.dump({u'traceEvents': self.events()}, f)
+        os.rename(temp_path, path)
+        log.debug(u'wrote trace %s with %s spans to %s', self.name, len(self.spans), path)
+
+
+def start_trace(name, **attributes):
+    """Start recording this thread's spans into a new trace, until
+    finish_trace. Traces nest, eg. a test run run inline by the engine loop
+    gets its own trace while the engine's waits.
+
+    :return: the Trace, or None if tracing is off
+    """
+    trace = Trace(name, **attributes) if trace_dir() else None
+    _traces().append(trace)
+    return trace
+
+
+def _traces():
+    if not hasattr(_local, u'traces'):
+        _local.traces = []
+    return _local.traces
+
+
+def current_trace():
+    traces = _traces()
+    return traces[-1] if traces else None
+
+
+def finish_trace(file_name):
+    """Stop recording this thread's spans into the trace started last, and
+    write it to file_name in the trace folder.
+    """
+    traces = _traces()
+    trace = traces.pop() if traces else None
+    if trace is None:
+        return
+
+    folder = trace_dir()
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        trace.write(os.path.join(folder, file_name))
+    except Exception as e:
+        log.error(u'error writing trace {}: {}'.format(trace.name, unicode(e)))
+
+
+@contextmanager
+def span(name, trace=None, **attributes):
+    """Time the enclosed block as a span of this thread's trace, or of trace.
+    Does next to nothing when there's no trace.
+    """
+    trace = trace or current_trace()
+    if trace is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.time() - start, attributes)
+
+
+def traced(name, attributes=None):
+    """Decorator recording each call of a method as a span.
+
+    :param attributes: a function taking the method's arguments and
+        returning the span's attributes
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace() is None:
+                return func(*args, **kwargs)
+            with span(name, **(attributes(*args, **kwargs) if attributes else {})):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_requested(test_run_id, test_id=None):
+    """Whether a test run was picked for profiling, see the module docstring.
+    """
+    try:
+        keys = [PROFILE_RUN_KEY_TEMPLATE.format(test_run_id=test_run_id), PROFILE_RATE_KEY]
+        if test_id is not None:
+            keys.append(PROFILE_TEST_KEY_TEMPLATE.format(test_id=test_id))
+        values = cache.get_many(keys)
+    except Exception as e:
+        log.error(u'error checking whether to profile test run {}: {}'.format(test_run_id, unicode(e)))
+        return False
+
+    if values.get(keys[0]) or (test_id is not None and values.get(keys[2])):
+        return True
+    rate = values.get(PROFILE_RATE_KEY)
+    return bool(rate) and random.random() < rate
+
+
+@contextmanager
+def profiled(test_run_id, enabled):
+    """Profile the enclosed block with cProfile if enabled, and save the stats
+    as run-<id>.prof in the trace folder, or the temp folder.
+    """
+    if not enabled:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        path = os.path.join(trace_dir() or tempfile.gettempdir(), u'run-{}.prof'.format(test_run_id))
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            profile.dump_stats(path)
+            log.info(u'saved profile of test run {} to {}'.format(test_run_id, path))
+        except Exception as e:
+            log.error(u'error saving profile of test run {}: {}'.format(test_run_id, unicode(e)))
@@ -0,0 +1,175 @@
+import os
+import logging
+import threading
+import time
+import Queue
+from io import BytesIO
+
+from django_bdd_engine.utility.artifacts import known_screenshots, screenshot_content_key, shrink_png
+from django_bdd_engine.utility.tracing import current_trace, span
+
+
+log = logging.getLogger(u'django-bdd')
+
+UPLOAD_THREADS = 4  # number of screenshots uploaded at the same time
+UPLOAD_QUEUE_SIZE = 64  # screenshots waiting to upload before the test has to wait for the queue
+UPLOAD_RETRIES = 3  # attempts after the first failed one
+UPLOAD_RETRY_BACKOFF = 0.5  # first wait between attempts, doubled each time (seconds)
+
+
+class LocalS3Util(object):
+    """Stand-in for S3Util that saves into a local folder, for running the
+    engine without aws. Keys become paths under the root folder.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def save_screenshot(self, key, f):
+        path = os.path.join(self.root, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, u'wb') as out:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                out.write(chunk)
+
+
+class ScreenshotUploader(object):
+    """Uploads screenshots on background threads so the test doesn't wait for
+    s3. The queue is bounded, if the uploads fall behind that far then upload()
+    blocks until there's room.
+
+    Finished uploads are handed back through completed(), so the caller can
+    point its step results at them from its own thread.
+
+    With dedupe, screenshots are stored under a key made from a hash of their
+    content instead of the key they were queued with, and screenshots that are
+    known to be uploaded already are skipped. Either way they can be shrunk
+    first.
+    """
+
+    def __init__(self, s3_util, threads=UPLOAD_THREADS, queue_size=UPLOAD_QUEUE_SIZE, dedupe=False, shrink=False,
+                 max_width=None):
+        """
+        :param dedupe: store screenshots by content
+        :param shrink: recompress png screenshots before uploading them
+        :param max_width: when shrinking, also scale them down to this width
+        """
+        self.s3_util = s3_util
+        self.dedupe = dedupe
+        self.shrink = shrink
+        self.max_width = max_width
+        self.pending = Queue.Queue(maxsize=queue_size)
+        self.finished = Queue.Queue()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._upload_forever)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def upload(self, key, path, context=None):
+        """Queue the file at path to be saved with the s3 key.
+
+        :param context: anything, handed back with the key once the upload is done
+        """
+        # the upload is recorded in the uploading thread's trace, if there is one
+        self.pending.put((key, path, context, current_trace()))
+
+    def completed(self):
+        """
+        :return: (key, context) for every upload that has finished since the last call
+        :rtype: list
+        """
+        completed = []
+        try:
+            while True:
+                completed.append(self.finished.get_nowait())
+        except Queue.Empty:
+            pass
+        return completed
+
+    def drain(self):
+        """Wait for every queued upload to finish or give up.
+        """
+        self.pending.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _upload_forever(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    return
+
+                key, path, context, trace = item
+                try:
+                    with span(u'upload screenshot', trace=trace, key=key):
+                        if self.dedupe:
+                            key = self._upload_by_content(path)
+                        elif self.shrink:
+                            key = self._upload_shrunk(key, path)
+                        elif not self._upload(key, path):
+                            key = None
+                except Exception as e:
+                    # eg. the screenshot was never written, the thread has to live on for the rest of the queue
+                    log.error(u'error uploading screenshot "{}": {}'.format(path, unicode(e)))
+                    key = None
+
+                if key:
+                    self.finished.put((key, context))
+            finally:
+                self.pending.task_done()
+
+    def _upload_by_content(self, path):
+        """
+        :return: the content addressed key the screenshot is stored under, or None if it couldn't be uploaded
+        """
+        with open(path, u'rb') as f:
+            data = f.read()
+
+        key = screenshot_content_key(data, path)
+        if key in known_screenshots:
+            log.debug(u'screenshot "%s" is already saved to s3 with key "%s"', path, key)
+            return key
+
+        if self.shrink:
+            data = shrink_png(data, max_width=self.max_width)
+
+        if not self._upload(key, path, data=data):
+            return None
+        known_screenshots.add(key)
+        return key
+
+    def _upload_shrunk(self, key, path):
+        """
+        :return: key, or None if the screenshot couldn't be uploaded
+        """
+        with open(path, u'rb') as f:
+            data = shrink_png(f.read(), max_width=self.max_width)
+        return key if self._upload(key, path, data=data) else None
+
+    def _upload(self, key, path, data=None):
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                if data is not None:
+                    self.s3_util.save_screenshot(key, BytesIO(data))
+                else:
+                    # hand over the open file so it's streamed rather than read into memory
+                    with open(path, u'rb') as f:
+                        self.s3_util.save_screenshot(key, f)
+                log.debug(u'saved screenshot "%s" to s3 with key "%s"', path, key)
+                return True
+            except Exception as e:
+                log.warn(u'attempt {} to save screenshot "{}" to s3 failed: {}'.format(attempt + 1, key, unicode(e)))
+                if attempt < UPLOAD_RETRIES:
+                    time.sleep(UPLOAD_RETRY_BACKOFF * 2 ** attempt)
+
+        log.error(u'giving up saving screenshot "{}" to s3'.format(key))
+        return False
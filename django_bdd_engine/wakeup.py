@@ -0,0 +1,146 @@
+import logging
+import select
+import socket
+import time
+
+from django.db import connection
+
+
+log = logging.getLogger(u'django-bdd')
+
+# postgres channel that new test runs are announced on
+DEFAULT_CHANNEL = u'django_bdd_test_run'
+
+# udp port the local socket wakeup listens on
+DEFAULT_WAKEUP_PORT = 47230
+
+
+class Backoff(object):
+    """Exponential backoff for polling the db while the queue stays empty. It
+    starts short so that a run submitted right after the queue empties is picked
+    up quickly, and grows to the maximum so an idle engine polls rarely.
+    """
+
+    def __init__(self, minimum=1, maximum=15, factor=2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.current = minimum
+
+    def reset(self):
+        self.current = self.minimum
+
+    def next(self):
+        """
+        :return: how long to wait this time, and back off for the next time
+        """
+        current = self.current
+        self.current = min(self.current * self.factor, self.maximum)
+        return current
+
+
+class WakeupSource(object):
+    """Something the engine can wait on while the queue is empty, which returns
+    early when a new test run is announced. This one has no way of hearing about
+    new runs and just sleeps.
+    """
+
+    def wait(self, timeout):
+        """
+        :param timeout: the longest to wait, in seconds
+        :return: whether the wait ended because a new test run was announced
+        :rtype: bool
+        """
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class PostgresWakeup(WakeupSource):
+    """Uses postgres LISTEN/NOTIFY. New test runs can be announced with
+    notify_test_run_queued(), or by an insert trigger on the test run table
+    that runs NOTIFY on the channel.
+    """
+
+    def __init__(self, channel=DEFAULT_CHANNEL):
+        self.channel = channel
+        self.listen_connection = None
+
+    def _listen(self):
+        # notifications need a dedicated connection in autocommit mode, outside of django's connection handling
+        self.listen_connection = connection.get_new_connection(connection.get_connection_params())
+        self.listen_connection.autocommit = True
+        self.listen_connection.cursor().execute(u'LISTEN "{}"'.format(self.channel))
+        log.debug(u'listening for new test runs on channel "%s"', self.channel)
+
+    def wait(self, timeout):
+        try:
+            if not self.listen_connection:
+                self._listen()
+
+            readable, _, _ = select.select([self.listen_connection], [], [], timeout)
+            if not readable:
+                return False
+
+            self.listen_connection.poll()
+            notified = bool(self.listen_connection.notifies)
+            del self.listen_connection.notifies[:]
+            return notified
+        except Exception as e:
+            # fall back to plain polling until the next wait reconnects
+            log.error(u'error waiting for test run notifications: {}'.format(unicode(e)))
+            self.close()
+            return super(PostgresWakeup, self).wait(timeout)
+
+    def close(self):
+        if self.listen_connection:
+            try:
+                self.listen_connection.close()
+            except Exception:
+                pass
+            self.listen_connection = None
+
+
+class SocketWakeup(WakeupSource):
+    """Listens on a local udp port, any datagram sent to it wakes the engine.
+    Useful where the db has no notification channel, and for local testing.
+    """
+
+    def __init__(self, port=DEFAULT_WAKEUP_PORT, host=u'127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(0)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+
+        # drain everything that has arrived, one wakeup covers them all
+        try:
+            while True:
+                self.sock.recv(64)
+        except socket.error:
+            pass
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+def notify_test_run_queued(channel=DEFAULT_CHANNEL):
+    """Announce a new test run to engines waiting on a PostgresWakeup.
+    """
+    connection.cursor().execute(u'NOTIFY "{}"'.format(channel))
+
+
+def send_wakeup(port=DEFAULT_WAKEUP_PORT, host=u'127.0.0.1'):
+    """Announce a new test run to an engine waiting on a SocketWakeup.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(b'1', (host, port))
+    finally:
+        sock.close()
@@ -0,0 +1,255 @@
+import logging
+import multiprocessing
+import resource
+import time
+import Queue
+
+from django_bdd_engine.testqueue import held_leases, release_lease
+from django_bdd_engine.utility.forking import start_process, finish_process
+from django_bdd_engine.utility.cloudwatch import set_metric_gauge, METRIC_ENGINE_WORKER_UTILISATION
+
+
+log = logging.getLogger(u'django-bdd')
+
+UTILISATION_REPORT_INTERVAL = 60  # how often to report worker utilisation (seconds)
+WORKER_STOP_TIMEOUT = 60  # how long a stopping worker gets to close its sessions and exit before it's terminated (seconds)
+
+
+def _worker_main(engine, index, jobs, results):
+    """Entry point of a worker process. Runs tests handed over by the pool
+    until it receives None.
+    """
+    log.debug(u'worker %s is now running', index)
+
+    # workers are daemonic so that they don't outlive the engine, but a sharded test run starts processes of its own,
+    # which multiprocessing only allows from non-daemonic ones. the flag is only changed in the worker's own copy.
+    multiprocessing.current_process().daemon = False
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        runner_class, test_run_id, endpoint_lease, duplicate_ids = job
+        try:
+            engine.run_test(runner_class, test_run_id, endpoint_lease, duplicate_ids)
+        except Exception as e:
+            log.error(u'worker {} failed running test run {}: {}'.format(index, test_run_id, unicode(e)))
+
+        # ru_maxrss is in kilobytes on linux
+        max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        results.put((index, test_run_id, max_rss_mb))
+
+    if engine.session_pool:
+        engine.session_pool.close()
+    log.debug(u'worker %s is exiting', index)
+    finish_process()
+
+
+class Worker(object):
+    """The pool's handle on a single worker process.
+    """
+
+    def __init__(self, index, engine, results):
+        self.index = index
+        self.jobs = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_worker_main, args=(engine, index, self.jobs, results))
+        self.process.daemon = True
+        self.test_run_id = None  # the test run the worker is busy with, if any
+        self.endpoint_lease = None  # the endpoint that test run is using, if any
+        self.duplicate_ids = []  # the duplicates coalesced into that test run
+        self.runs = 0  # number of test runs this process has completed
+        self.busy_since = None
+        self.busy_seconds = 0.0  # time spent busy since utilisation was last reported
+        self.stopping_since = None  # when the worker was asked to exit
+
+    @property
+    def busy(self):
+        return self.test_run_id is not None
+
+    def start(self):
+        start_process(self.process)
+
+    def dispatch(self, runner_class, test_run_id, endpoint_lease=None, duplicate_ids=None):
+        self.test_run_id = test_run_id
+        self.endpoint_lease = endpoint_lease
+        self.duplicate_ids = duplicate_ids or []
+        self.busy_since = time.time()
+        self.jobs.put((runner_class, test_run_id, endpoint_lease, self.duplicate_ids))
+
+    def finish(self):
+        self.busy_seconds += time.time() - self.busy_since
+        self.busy_since = None
+        self.test_run_id = None
+        self.duplicate_ids = []
+        self.runs += 1
+
+        # the worker's copy of the lease can't release the endpoint, so do it here
+        if self.endpoint_lease:
+            self.endpoint_lease.release()
+            self.endpoint_lease = None
+
+    def request_stop(self):
+        """Ask the worker to exit once it's done, without waiting for it.
+        """
+        self.stopping_since = time.time()
+        self.jobs.put(None)
+
+    def reap(self, timeout=WORKER_STOP_TIMEOUT):
+        """Terminate a stopping worker that has taken longer than timeout to
+        exit.
+
+        :return: whether the process is gone
+        """
+        if self.process.is_alive():
+            if time.time() - self.stopping_since < timeout:
+                return False
+            log.error(u'worker {} did not exit within {} seconds, terminating it'.format(self.index, timeout))
+            self.process.terminate()
+        self.process.join()
+        return True
+
+    def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        self.request_stop()
+        self.process.join(timeout)
+        self.reap(timeout)
+
+
+class WorkerPool(object):
+    """A fixed number of worker processes, each running one test at a time so
+    that the engine loop is free to keep polling, dispatching and running tasks.
+
+    Workers are replaced after max_runs test runs, or once their peak memory
+    use passes max_memory_mb, so that leaks in behave/webdriver don't grow for
+    the whole life of the engine.
+    """
+
+    def __init__(self, engine, size, max_runs=None, max_memory_mb=None, stop_timeout=WORKER_STOP_TIMEOUT):
+        """
+        :param stop_timeout: how long a stopping worker gets to exit before it's terminated (seconds)
+        """
+        self.engine = engine
+        self.size = size
+        self.max_runs = max_runs
+        self.max_memory_mb = max_memory_mb
+        self.stop_timeout = stop_timeout
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        self.stopping = []  # replaced workers that haven't exited yet
+        self.last_report = time.time()
+
+    def start(self):
+        log.debug(u'starting %s workers', self.size)
+        for index in range(self.size):
+            self.workers.append(self._start_worker(index))
+
+    def stop(self):
+        workers = self.workers + self.stopping
+        for worker in workers:
+            worker.request_stop()
+        for worker in workers:
+            worker.process.join(max(0, worker.stopping_since + self.stop_timeout - time.time()))
+            worker.reap(self.stop_timeout)
+        self.workers = []
+        self.stopping = []
+
+    def _start_worker(self, index):
+        worker = Worker(index, self.engine, self.results)
+        worker.start()
+        return worker
+
+    def _recycle(self, worker):
+        """Replace a worker. The old one is left to exit in its own time, eg.
+        closing its webdriver sessions can take a while, and is reaped by
+        wait().
+        """
+        log.debug(u'recycling worker %s after %s test runs', worker.index, worker.runs)
+        self.workers[worker.index] = self._start_worker(worker.index)
+        worker.request_stop()
+        self.stopping.append(worker)
+
+    def _reap_stopping(self):
+        self.stopping = [worker for worker in self.stopping if not worker.reap(self.stop_timeout)]
+
+    def has_idle_worker(self):
+        return any(not worker.busy for worker in self.workers)
+
+    def dispatch(self, runner_class, test_run_id, endpoint_lease=None, duplicate_ids=None):
+        """Hand a test run to an idle worker.
+        """
+        for worker in self.workers:
+            if not worker.busy:
+                log.debug(u'dispatching test run %s to worker %s', test_run_id, worker.index)
+                worker.dispatch(runner_class, test_run_id, endpoint_lease, duplicate_ids)
+                return
+        raise RuntimeError(u'no idle worker to run test run {}'.format(test_run_id))
+
+    def wait(self, timeout=0):
+        """Wait up to timeout seconds for a worker to finish, then collect every
+        finished test run and replace workers that are spent or have died.
+        """
+        try:
+            result = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            while True:
+                self._handle_result(*result)
+                result = self.results.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                if worker.busy:
+                    log.error(u'worker {} died running test run {}'.format(worker.index, worker.test_run_id))
+                    self._fail_runs(worker)
+                else:
+                    log.error(u'worker {} died'.format(worker.index))
+                self.workers[worker.index] = self._start_worker(worker.index)
+
+        self._reap_stopping()
+
+    def _fail_runs(self, worker):
+        """Put the runs of a worker that died into the ERROR state, and let go
+        of their leases and endpoint.
+        """
+        test_run_ids = [worker.test_run_id] + worker.duplicate_ids
+        if self.engine.lease_seconds:
+            # runs whose lease was lost are another engine's
+            test_run_ids = held_leases(test_run_ids)
+        for test_run_id in test_run_ids:
+            self.engine.mark_test_run_error(test_run_id, u'engine worker process exited unexpectedly')
+            if self.engine.lease_seconds:
+                release_lease(test_run_id)
+        if worker.endpoint_lease:
+            worker.endpoint_lease.release()
+
+    def _handle_result(self, index, test_run_id, max_rss_mb):
+        worker = self.workers[index]
+        log.debug(u'worker %s finished test run %s, peak memory %s MB', index, test_run_id, max_rss_mb)
+        worker.finish()
+
+        if self.max_runs and worker.runs >= self.max_runs:
+            self._recycle(worker)
+        elif self.max_memory_mb and max_rss_mb > self.max_memory_mb:
+            log.debug(u'worker %s is over the %s MB memory ceiling', index, self.max_memory_mb)
+            self._recycle(worker)
+
+    def report_utilisation(self):
+        """Report the fraction of time each worker spent running tests since the
+        last report, as a percentage.
+        """
+        now = time.time()
+        interval = now - self.last_report
+        if interval < UTILISATION_REPORT_INTERVAL:
+            return
+
+        for worker in self.workers:
+            busy_seconds = worker.busy_seconds
+            if worker.busy:
+                # count the in progress test run up to now, and restart its clock
+                busy_seconds += now - worker.busy_since
+                worker.busy_since = now
+            worker.busy_seconds = 0.0
+
+            utilisation = min(100.0, 100.0 * busy_seconds / interval)
+            log.debug(u'worker %s utilisation is %s%%', worker.index, utilisation)
+            set_metric_gauge(METRIC_ENGINE_WORKER_UTILISATION, value=utilisation, dimensions={u'Worker': unicode(worker.index)})
+        self.last_report = now
@@ -0,0 +1,9 @@
+"""Tests of the engine. They run against the benchmark's throwaway sqlite db
+and its stand-ins for django_bdd, goh_behave, s3 and notifications, so Django
+has to be installed, and the python 2 the engine runs on:
+
+    python -m unittest discover -s test -t .
+"""
+from test.base import setup
+
+setup()
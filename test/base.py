@@ -0,0 +1,84 @@
+import atexit
+import logging
+import shutil
+import tempfile
+import unittest
+
+from django_bdd_engine.benchmark import fakes
+from django_bdd_engine.benchmark.environment import setup_environment
+
+
+behave = fakes.FakeBehave(fakes.BenchmarkConfig())
+notifications = fakes.FakeNotifications()
+folder = None
+
+
+def setup():
+    """Configure django on a sqlite db in a temp folder, once per process.
+    """
+    global folder
+    if folder is not None:
+        return
+
+    # errors the tests provoke are logged, there's nowhere for them to go
+    logging.getLogger(u'django-bdd').addHandler(logging.NullHandler())
+
+    folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-test-')
+    atexit.register(shutil.rmtree, folder, True)
+    setup_environment(folder, behave, notifications)
+
+
+def lease(test_run_id):
+    """
+    :return: the engine holding the lease on the test run, if any
+    """
+    from django.core.cache import cache
+    from django_bdd_engine.testqueue import LEASE_KEY_TEMPLATE
+    record = cache.get(LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id))
+    return record[0] if record else None
+
+
+def set_lease(test_run_id, engine_id, lapses_in):
+    """Put a lease record in the cache, eg. another engine's or a lapsed one.
+
+    :param lapses_in: seconds from now, negative for a lease that has lapsed
+    """
+    import time
+    from django.core.cache import cache
+    from django_bdd_engine.testqueue import LEASE_KEY_TEMPLATE
+    cache.set(LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id), (engine_id, time.time() + lapses_in), None)
+
+
+class EngineTestCase(unittest.TestCase):
+    """Starts each test with an empty db, cache and outbox, and a fresh
+    synthetic test.
+    """
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import cache
+        from django_bdd_engine.benchmark.models import Test, TestRun, TestRunStep
+
+        TestRunStep.objects.all().delete()
+        TestRun.objects.all().delete()
+        Test.objects.all().delete()
+        cache.clear()
+        shutil.rmtree(settings.DJANGO_BDD_ENGINE_OUTBOX_DIR, True)
+        del notifications.notified[:]
+        self.set_config(fakes.BenchmarkConfig())
+
+    def set_config(self, config):
+        behave.config = config
+        behave.random.seed(config.seed)
+        self.config = config
+
+    def create_test_runs(self, count=1, **fields):
+        """Queue count test runs of the synthetic test.
+
+        :return: their ids
+        """
+        from django_bdd_engine.benchmark.models import Test, TestRun
+
+        test = Test.objects.create(name=u'test', steps=self.config.test_steps())
+        fields.setdefault(u'example_text', self.config.example_text())
+        return [TestRun.objects.create(test=test, **fields).pk for _ in range(count)]
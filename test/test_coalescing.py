@@ -0,0 +1,42 @@
+from django_bdd_engine.outbox import OutboxSenderTask
+from test.base import EngineTestCase, lease, notifications
+
+
+class FanOutTest(EngineTestCase):
+
+    def run_next(self):
+        """Claim and run the oldest queued run, coalescing its duplicates, and send the notifications."""
+        from django_bdd_engine.engine import DjangoBDDEngine
+        engine = DjangoBDDEngine(endpoint=u'http://test', coalesce=True, lease_seconds=30)
+        test_run = engine.queue.claim_next(lease_seconds=engine.lease_seconds)
+        self.assertTrue(engine.dispatch(test_run, None))
+        OutboxSenderTask(engine.outbox).update()
+
+    def results(self, test_run_id):
+        from django_bdd_engine.benchmark.models import TestRun
+        test_run = TestRun.objects.get(pk=test_run_id)
+        steps = list(test_run.testrunstep_set.order_by(u'example_row_num', u'num').values_list(
+            u'num', u'example_row_num', u'text', u'status'
+        ))
+        return test_run.status, test_run.text, steps
+
+    def test_duplicates_get_the_results(self):
+        self.set_config(type(self.config)(steps=3, rows=2, failure_rate=0.5, seed=1))
+        test_run_ids = self.create_test_runs(3)
+        self.run_next()
+
+        results = [self.results(test_run_id) for test_run_id in test_run_ids]
+        self.assertEqual(len(results[0][2]), 6)
+        self.assertEqual(results[1:], [results[0]] * 2)
+        self.assertEqual(sorted(notifications.notified), test_run_ids)
+        self.assertEqual([lease(test_run_id) for test_run_id in test_run_ids], [None] * 3)
+
+    def test_different_examples_are_not_coalesced(self):
+        from django_bdd_engine.benchmark.models import TestRun
+        first_id, = self.create_test_runs()
+        other_id, = self.create_test_runs(example_text=u'| value |\r\n| other |\r\n')
+        self.run_next()
+
+        self.assertEqual(TestRun.objects.get(pk=first_id).status, u'passed')
+        self.assertEqual(TestRun.objects.get(pk=other_id).status, u'new')
+        self.assertEqual(notifications.notified, [first_id])
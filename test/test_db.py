@@ -0,0 +1,43 @@
+import time
+import threading
+import unittest
+
+from django.db import connection
+
+from django_bdd_engine.utility import db
+
+
+class EnsureConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pinged = []
+        original = connection.is_usable
+
+        def is_usable():
+            self.pinged.append(threading.current_thread().name)
+            return original()
+        connection.is_usable = is_usable
+        self.addCleanup(delattr, connection, u'is_usable')
+
+    def run_in_thread(self, func):
+        thread = threading.Thread(target=func, name=u'other')
+        thread.start()
+        thread.join()
+
+    def test_busy_thread_does_not_hide_idle_connection(self):
+        connection.ensure_connection()
+        db._local.last_used = time.time() - db.IDLE_PING_THRESHOLD - 1
+
+        def query():
+            db.ensure_connection()
+            connection.close()
+        self.run_in_thread(query)
+
+        db.ensure_connection()
+        self.assertEqual(self.pinged, [threading.current_thread().name])
+
+    def test_recently_used_connection_is_trusted(self):
+        connection.ensure_connection()
+        db.ensure_connection()
+        db.ensure_connection()
+        self.assertEqual(self.pinged, [])
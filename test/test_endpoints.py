@@ -0,0 +1,48 @@
+import pickle
+import unittest
+
+from django_bdd_engine.endpoints import Endpoint, EndpointPool
+
+
+class EndpointPoolTest(unittest.TestCase):
+
+    def test_least_loaded_endpoint_is_leased(self):
+        small, big = Endpoint(u'http://small', max_sessions=2), Endpoint(u'http://big', max_sessions=4)
+        pool = EndpointPool([small, big])
+
+        urls = [pool.lease({}).url for _ in range(6)]
+        # ties go to the first endpoint
+        self.assertEqual(urls, [u'http://small', u'http://big', u'http://big', u'http://small', u'http://big', u'http://big'])
+        self.assertEqual((small.active, big.active), (2, 4))
+        self.assertIsNone(pool.lease({}))
+        self.assertFalse(pool.has_capacity({}))
+
+    def test_released_endpoint_is_leased_again(self):
+        first, second = Endpoint(u'http://first'), Endpoint(u'http://second')
+        pool = EndpointPool([first, second])
+        first_lease, second_lease = pool.lease({}), pool.lease({})
+
+        second_lease.release()
+        second_lease.release()
+        self.assertEqual((first.active, second.active), (1, 0))
+        self.assertEqual(pool.lease({}).endpoint, second)
+
+    def test_only_healthy_matching_endpoints(self):
+        android = Endpoint(u'http://android', capabilities={u'os_type': u'android'}, max_sessions=5)
+        ios = Endpoint(u'http://ios', capabilities={u'os_type': u'ios'})
+        down = Endpoint(u'http://down', capabilities={u'os_type': u'ios'})
+        down.healthy = False
+        pool = EndpointPool([android, ios, down])
+
+        self.assertEqual(pool.lease({u'os_type': u'ios'}).endpoint, ios)
+        self.assertIsNone(pool.lease({u'os_type': u'ios', u'device_type': u'tablet'}))
+        self.assertEqual(pool.lease({u'device_type': u'tablet'}).endpoint, android)
+
+    def test_pickled_lease_does_not_release(self):
+        endpoint = Endpoint(u'http://test')
+        pool = EndpointPool([endpoint])
+        copy = pickle.loads(pickle.dumps(pool.lease({})))
+
+        self.assertEqual(copy.url, u'http://test')
+        copy.release()
+        self.assertEqual(endpoint.active, 1)
@@ -0,0 +1,53 @@
+from test.base import EngineTestCase, lease
+
+
+class StopLoop(Exception):
+    pass
+
+
+def run_until_nap(engine):
+    """Run the engine loop until it first naps, ie. finds nothing it can run."""
+    from django_bdd_engine.wakeup import WakeupSource
+
+    class StopWakeup(WakeupSource):
+        def wait(self, timeout):
+            raise StopLoop()
+
+    engine.wakeup = StopWakeup()
+    try:
+        engine.run()
+    except StopLoop:
+        pass
+    finally:
+        engine.tasks.stop()
+
+
+class SaturatedRunnerTest(EngineTestCase):
+
+    def test_saturated_after_claim_is_put_back(self):
+        from django_bdd_engine.benchmark.models import TestRun
+        from django_bdd_engine.engine import DjangoBDDEngine
+
+        class FillsUpRunner(object):
+            """Has room when the queue looks, and none once the run is claimed."""
+            capacity_checks = []
+
+            @classmethod
+            def is_compatible(cls, requirements):
+                return True
+
+            @classmethod
+            def has_capacity(cls):
+                cls.capacity_checks.append(True)
+                return len(cls.capacity_checks) == 1
+
+            def __init__(self, engine, test_run_id):
+                raise AssertionError(u'a saturated runner was started')
+
+        test_run_id, = self.create_test_runs()
+        run_until_nap(DjangoBDDEngine(runners=[FillsUpRunner], lease_seconds=30))
+
+        test_run = TestRun.objects.get(pk=test_run_id)
+        self.assertEqual((test_run.status, test_run.text), (u'new', u''))
+        self.assertEqual(len(FillsUpRunner.capacity_checks), 2)
+        self.assertIsNone(lease(test_run_id))
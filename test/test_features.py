@@ -0,0 +1,71 @@
+import os
+import shutil
+import unittest
+
+from django_bdd_engine.features import FEATURE_FILE_NAME, FeatureCache, build_feature_text
+
+
+STEPS = u'Given I open <page>\r\n'
+EXAMPLE_TEXT = u'| page |\r\n| home |\r\n'
+
+
+class FeatureCacheTest(unittest.TestCase):
+
+    def cache(self, size=10):
+        cache = FeatureCache(size=size)
+        self.addCleanup(cache.clear)
+        return cache
+
+    def read(self, feature_dir):
+        with open(os.path.join(feature_dir, FEATURE_FILE_NAME), u'rb') as f:
+            return f.read().decode(u'utf8')
+
+    def test_feature_is_written_once(self):
+        cache = self.cache()
+        feature_dir, feature_text = cache.get(u'pages', STEPS, EXAMPLE_TEXT)
+        self.assertEqual(feature_text, build_feature_text(u'pages', STEPS, EXAMPLE_TEXT))
+        self.assertEqual(self.read(feature_dir), feature_text)
+        self.assertEqual(os.listdir(feature_dir), [FEATURE_FILE_NAME])
+
+        os.remove(os.path.join(feature_dir, FEATURE_FILE_NAME))
+        self.assertEqual(cache.get(u'pages', STEPS, EXAMPLE_TEXT), (feature_dir, feature_text))
+        self.assertFalse(os.listdir(feature_dir))
+
+    def test_features_differ_by_examples(self):
+        cache = self.cache()
+        home_dir, _ = cache.get(u'pages', STEPS, EXAMPLE_TEXT)
+        help_dir, _ = cache.get(u'pages', STEPS, u'| page |\r\n| help |\r\n')
+        self.assertNotEqual(home_dir, help_dir)
+        self.assertIn(u'| help |', self.read(help_dir))
+
+    def test_least_recently_used_features_are_removed(self):
+        cache = self.cache(size=2)
+        first_dir, _ = cache.get(u'first', STEPS, EXAMPLE_TEXT)
+        second_dir, _ = cache.get(u'second', STEPS, EXAMPLE_TEXT)
+        cache.get(u'first', STEPS, EXAMPLE_TEXT)
+        third_dir, _ = cache.get(u'third', STEPS, EXAMPLE_TEXT)
+
+        self.assertEqual([os.path.isdir(d) for d in (first_dir, second_dir, third_dir)], [True, False, True])
+
+    def test_clear_removes_the_folder(self):
+        cache = self.cache()
+        cache.get(u'pages', STEPS, EXAMPLE_TEXT)
+        root = cache.root
+        cache.clear()
+        self.assertFalse(os.path.exists(root))
+
+    def test_forked_process_starts_its_own_cache(self):
+        cache = self.cache()
+        feature_dir, _ = cache.get(u'pages', STEPS, EXAMPLE_TEXT)
+        parent_root = cache.root
+        # as a forked child sees it
+        cache.pid = -1
+        self.addCleanup(shutil.rmtree, parent_root, True)
+
+        child_dir, _ = cache.get(u'pages', STEPS, EXAMPLE_TEXT)
+        self.assertNotEqual(cache.root, parent_root)
+        self.assertTrue(child_dir.startswith(cache.root))
+        # the parent's folder is left for the parent to remove
+        cache.clear()
+        self.assertTrue(os.path.isdir(feature_dir))
+
@@ -0,0 +1,211 @@
+import time
+
+from django.core.cache import cache
+
+from test.base import EngineTestCase, lease, set_lease
+
+
+def lapses_at(test_run_id):
+    from django_bdd_engine.testqueue import LEASE_KEY_TEMPLATE
+    return cache.get(LEASE_KEY_TEMPLATE.format(test_run_id=test_run_id))[1]
+
+
+class LeaseRenewalTest(EngineTestCase):
+
+    def create_engine(self, **kwargs):
+        from django_bdd_engine.engine import DjangoBDDEngine
+        return DjangoBDDEngine(endpoint=u'http://test', lease_seconds=30, **kwargs)
+
+    def renewal_task(self, engine):
+        from django_bdd_engine.testqueue import LeaseRenewalTask
+        tasks = [task for _, _, task in engine.tasks.heap if isinstance(task, LeaseRenewalTask)]
+        self.assertEqual(len(tasks), 1)
+        return tasks[0]
+
+    def test_no_task_without_leases(self):
+        from django_bdd_engine.engine import DjangoBDDEngine
+        from django_bdd_engine.testqueue import LeaseRenewalTask
+        engine = DjangoBDDEngine(endpoint=u'http://test')
+        self.assertFalse([task for _, _, task in engine.tasks.heap if isinstance(task, LeaseRenewalTask)])
+
+    def test_renews_inline_run_on_custom_runner(self):
+        from django_bdd_engine.testqueue import ENGINE_ID
+        test_run_id, duplicate_id = self.create_test_runs(2)
+        engine = self.create_engine()
+        task = self.renewal_task(engine)
+        lapses_while_running = []
+
+        class QuietRunner(object):
+            """Never calls a behave hook, like runners that don't use behave."""
+
+            def __init__(self, engine, test_run_id):
+                pass
+
+            def start(self):
+                for i in (test_run_id, duplicate_id):
+                    set_lease(i, ENGINE_ID, 1)
+                task.update()
+                lapses_while_running.extend([lapses_at(test_run_id), lapses_at(duplicate_id)])
+
+        engine.run_test(QuietRunner, test_run_id, duplicate_ids=[duplicate_id])
+
+        self.assertTrue(all(lapses > time.time() + 20 for lapses in lapses_while_running))
+        self.assertIsNone(lease(test_run_id))
+        self.assertIsNone(lease(duplicate_id))
+        self.assertEqual(engine.running_test_run_ids(), [])
+
+    def test_renews_worker_runs(self):
+        from django_bdd_engine.testqueue import ENGINE_ID
+        from django_bdd_engine.workers import Worker
+
+        engine = self.create_engine()
+        busy, idle = Worker(0, engine, None), Worker(1, engine, None)
+        busy.test_run_id, busy.duplicate_ids = 5, [6, 7]
+        for test_run_id in (5, 6, 7):
+            set_lease(test_run_id, ENGINE_ID, 1)
+
+        class Pool(object):
+            workers = [busy, idle]
+        engine.pool = Pool()
+
+        self.renewal_task(engine).update()
+        self.assertEqual([lease(i) for i in (5, 6, 7)], [ENGINE_ID] * 3)
+        self.assertTrue(all(lapses_at(i) > time.time() + 20 for i in (5, 6, 7)))
+
+    def test_lost_leases_are_not_renewed(self):
+        from django_bdd_engine.testqueue import ENGINE_ID, renew_leases
+        set_lease(1, ENGINE_ID, 1)
+        set_lease(2, u'other-engine', 30)
+        set_lease(3, ENGINE_ID, -1)
+
+        self.assertEqual(renew_leases([1, 2, 3, 4], 30), [2, 3, 4])
+        self.assertEqual([lease(i) for i in (1, 2, 3, 4)], [ENGINE_ID, u'other-engine', ENGINE_ID, None])
+        self.assertLess(lapses_at(3), time.time())
+
+    def test_release_leaves_another_engines_lease(self):
+        from django_bdd_engine.testqueue import ENGINE_ID, release_lease
+        set_lease(1, ENGINE_ID, 30)
+        set_lease(2, u'other-engine', 30)
+        release_lease(1)
+        release_lease(2)
+        self.assertEqual([lease(1), lease(2)], [None, u'other-engine'])
+
+
+class ClaimTest(EngineTestCase):
+
+    def status(self, test_run_id):
+        from django_bdd_engine.benchmark.models import TestRun
+        return TestRun.objects.get(pk=test_run_id).status
+
+    def test_claim_takes_lease(self):
+        from django_bdd_engine.testqueue import ENGINE_ID, claim_test_run
+        test_run_id, = self.create_test_runs()
+        self.assertTrue(claim_test_run(test_run_id, lease_seconds=30))
+        self.assertEqual(lease(test_run_id), ENGINE_ID)
+        self.assertEqual(self.status(test_run_id), u'running')
+
+    def test_lost_claim_leaves_the_winners_lease(self):
+        from django_bdd_engine.testqueue import claim_test_run
+        test_run_id, = self.create_test_runs()
+        self.assertTrue(claim_test_run(test_run_id))
+        set_lease(test_run_id, u'other-engine', 30)
+
+        self.assertFalse(claim_test_run(test_run_id, lease_seconds=30))
+        self.assertEqual(lease(test_run_id), u'other-engine')
+
+    def test_failed_claim_drops_its_lease(self):
+        from django_bdd_engine.testqueue import claim_test_run
+        test_run_id, = self.create_test_runs(status=u'passed')
+        self.assertFalse(claim_test_run(test_run_id, lease_seconds=30))
+        self.assertIsNone(lease(test_run_id))
+
+    def test_claimed_run_is_not_reclaimed(self):
+        from django_bdd_engine.testqueue import TestRunQueue, reclaim_expired_test_runs
+        test_run_ids = self.create_test_runs(3)
+        queue = TestRunQueue()
+        claimed = [queue.claim_next(lease_seconds=30).id for _ in test_run_ids]
+        self.assertEqual(claimed, test_run_ids)
+        self.assertEqual(reclaim_expired_test_runs(), [])
+
+    def test_reclaim_resets_output(self):
+        from django_bdd_engine.benchmark.models import TestRun, TestRunStep
+        from django_bdd_engine.testqueue import claim_test_run, reclaim_expired_test_runs
+        expired_id, leased_id = self.create_test_runs(2)
+        self.assertTrue(claim_test_run(expired_id, lease_seconds=30))
+        self.assertTrue(claim_test_run(leased_id, lease_seconds=30))
+        set_lease(expired_id, u'crashed-engine', -60)
+        for test_run_id in (expired_id, leased_id):
+            TestRun.objects.filter(pk=test_run_id).update(text=u'half a run')
+            TestRunStep.objects.create(test_run_id=test_run_id, num=1, example_row_num=0, text=u'Given a step')
+
+        self.assertEqual(reclaim_expired_test_runs(), [expired_id])
+        expired = TestRun.objects.get(pk=expired_id)
+        self.assertEqual((expired.status, expired.text), (u'new', u''))
+        self.assertFalse(TestRunStep.objects.filter(test_run_id=expired_id).exists())
+        leased = TestRun.objects.get(pk=leased_id)
+        self.assertEqual((leased.status, leased.text), (u'running', u'half a run'))
+        self.assertTrue(TestRunStep.objects.filter(test_run_id=leased_id).exists())
+        self.assertIsNone(lease(expired_id))
+
+    def test_runs_without_a_lapsed_lease_are_not_reclaimed(self):
+        from django_bdd_engine.testqueue import claim_test_run, reclaim_expired_test_runs
+        unleased_id, just_lapsed_id, lapsed_id = self.create_test_runs(3)
+        for test_run_id in (unleased_id, just_lapsed_id, lapsed_id):
+            self.assertTrue(claim_test_run(test_run_id))
+        set_lease(just_lapsed_id, u'slow-engine', -1)
+        set_lease(lapsed_id, u'crashed-engine', -60)
+
+        self.assertEqual(reclaim_expired_test_runs(), [lapsed_id])
+        self.assertEqual([self.status(i) for i in (unleased_id, just_lapsed_id, lapsed_id)], [u'running', u'running', u'new'])
+
+    def test_run_stops_once_its_lease_is_lost(self):
+        from django_bdd_engine.benchmark.models import TestRun, TestRunStep
+        from django_bdd_engine.engine import DjangoBDDEngine
+        from django_bdd_engine.outbox import OutboxSenderTask
+        from test.base import notifications
+
+        test_run_id, duplicate_id = self.create_test_runs(2)
+        engine = DjangoBDDEngine(endpoint=u'http://test', lease_seconds=30)
+        self.assertTrue(engine.queue.claim_next(lease_seconds=30))
+        self.assertTrue(engine.queue.claim_next(lease_seconds=30))
+        # reclaimed and claimed by another engine
+        set_lease(test_run_id, u'other-engine', 30)
+
+        engine.run_test(None, test_run_id, duplicate_ids=[duplicate_id])
+        OutboxSenderTask(engine.outbox).update()
+
+        test_run = TestRun.objects.get(pk=test_run_id)
+        self.assertEqual((test_run.status, test_run.text), (u'running', u''))
+        self.assertFalse(TestRunStep.objects.filter(test_run_id=test_run_id).exists())
+        self.assertEqual(lease(test_run_id), u'other-engine')
+        self.assertEqual(notifications.notified, [])
+        self.assertEqual((self.status(duplicate_id), lease(duplicate_id)), (u'new', None))
+
+    def test_racing_engines_claim_each_run_once(self):
+        import threading
+        from django.db import connection
+        from django_bdd_engine.testqueue import TestRunQueue, reclaim_expired_test_runs
+
+        test_run_ids = self.create_test_runs(20)
+        claims = []
+
+        def engine():
+            queue = TestRunQueue(batch_size=5)
+            try:
+                while True:
+                    reclaim_expired_test_runs()
+                    test_run = queue.claim_next(lease_seconds=30)
+                    if test_run is None:
+                        return
+                    claims.append(test_run.id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=engine) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claims), test_run_ids)
+        self.assertEqual([self.status(test_run_id) for test_run_id in test_run_ids], [u'running'] * 20)
@@ -0,0 +1,71 @@
+import logging
+import unittest
+
+from django_bdd_engine.utility.logs import LOGGER_NAME, RunLogCapture, start_async_logging, stop_async_logging
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RunLogCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger(LOGGER_NAME)
+        state = list(self.logger.handlers), self.logger.level, self.logger.propagate
+        self.addCleanup(self.restore, *state)
+
+        self.handler = RecordingHandler()
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def restore(self, handlers, level, propagate):
+        stop_async_logging()
+        self.logger.handlers = handlers
+        self.logger.setLevel(level)
+        self.logger.propagate = propagate
+
+    def log_run(self):
+        capture = RunLogCapture()
+        capture.start()
+        self.logger.debug(u'debug %s', 1)
+        self.logger.info(u'info %s', 2)
+        capture.stop()
+        return capture
+
+    def check_capture(self):
+        capture = self.log_run()
+        self.assertEqual([record[3] for record in capture.records], [u'debug 1', u'info 2'])
+        self.assertEqual(self.logger.level, logging.INFO)
+        self.logger.debug(u'debug %s', 3)
+
+    def test_captures_debug(self):
+        self.check_capture()
+        self.assertEqual(self.handler.messages, [u'info 2'])
+
+    def test_captures_debug_with_async_logging(self):
+        start_async_logging()
+        self.check_capture()
+        stop_async_logging()
+        self.assertEqual(self.handler.messages, [u'info 2'])
+
+    def test_async_logging_keeps_the_level(self):
+        start_async_logging()
+        self.assertEqual(self.logger.getEffectiveLevel(), logging.INFO)
+        self.assertFalse(self.logger.isEnabledFor(logging.DEBUG))
+
+    def test_capture_level(self):
+        capture = RunLogCapture(level=logging.INFO)
+        capture.start()
+        self.assertEqual(self.logger.level, logging.INFO)
+        self.logger.debug(u'debug')
+        self.logger.warn(u'warn')
+        capture.stop()
+        self.assertEqual([record[3] for record in capture.records], [u'warn'])
@@ -0,0 +1,58 @@
+import datetime
+import unittest
+
+try:
+    from boto.ec2.cloudwatch import CloudWatchConnection
+except ImportError:
+    CloudWatchConnection = None
+
+from django.conf import settings
+
+from django_bdd_engine.utility.metrics import CloudWatchBackend, COUNTER, GAUGE, STATISTICS
+
+
+class RecordingConnection(object):
+    """Builds the PutMetricData params with boto, without sending them.
+    """
+
+    def __init__(self):
+        self.connection = CloudWatchConnection(aws_access_key_id=u'test', aws_secret_access_key=u'test')
+        self.calls = []
+
+    def put_metric_data(self, namespace, name, **kwargs):
+        params = {u'Namespace': namespace}
+        self.connection.build_put_params(params, name, **kwargs)
+        self.calls.append(params)
+
+
+@unittest.skipIf(CloudWatchConnection is None, u'boto is not installed')
+class CloudWatchBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        settings.CLOUDWATCH_NAMESPACE = u'test'
+        self.backend = CloudWatchBackend()
+        self.backend.connection = RecordingConnection()
+
+    def test_mixed_batch(self):
+        self.backend.send([
+            (COUNTER, u'Heartbeat', None, 1),
+            (GAUGE, u'Utilisation', {u'Worker': 0}, 0.5),
+            (STATISTICS, u'Duration', None, [1.0, 3.0, 4.0, 2]),
+            (STATISTICS, u'TaskDuration', {u'Task': u'Outbox'}, [0.1, 0.1, 0.1, 1]),
+        ], datetime.datetime(2020, 1, 1))
+
+        values, statistics = self.backend.connection.calls
+        self.assertEqual(values[u'MetricData.member.1.MetricName'], u'Heartbeat')
+        self.assertEqual(values[u'MetricData.member.1.Value'], 1)
+        self.assertNotIn(u'MetricData.member.1.Dimensions.member.1.Name', values)
+        self.assertEqual(values[u'MetricData.member.2.Dimensions.member.1.Name'], u'Worker')
+        self.assertEqual(values[u'MetricData.member.2.Dimensions.member.1.Value'], u'0')
+
+        self.assertEqual(statistics[u'MetricData.member.1.StatisticValues.Maximum'], 3.0)
+        self.assertEqual(statistics[u'MetricData.member.1.StatisticValues.SampleCount'], 2)
+        self.assertNotIn(u'MetricData.member.1.Value', statistics)
+        self.assertEqual(statistics[u'MetricData.member.2.Dimensions.member.1.Value'], u'Outbox')
+
+    def test_values_only(self):
+        self.backend.send([(COUNTER, u'Heartbeat', None, 1)], datetime.datetime(2020, 1, 1))
+        self.assertEqual(len(self.backend.connection.calls), 1)
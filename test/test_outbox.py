@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+
+from django.test.utils import override_settings
+
+from django_bdd_engine.outbox import Outbox, OutboxSenderTask
+from test.base import EngineTestCase, notifications
+
+
+class OutboxSenderTaskTest(EngineTestCase):
+
+    def setUp(self):
+        super(OutboxSenderTaskTest, self).setUp()
+        folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-outbox-')
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.outbox = Outbox(folder)
+
+    def test_sends_notifications(self):
+        test_run_ids = self.create_test_runs(2)
+        for test_run_id in test_run_ids:
+            self.outbox.put(test_run_id)
+        OutboxSenderTask(self.outbox).update()
+        self.assertEqual(notifications.notified, test_run_ids)
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_errors_do_not_escape_update(self):
+        class BrokenOutbox(Outbox):
+            def pending(self, limit=None):
+                raise OSError(u'disk gone')
+        OutboxSenderTask(BrokenOutbox(self.outbox.path)).update()
+
+    def test_entry_error_does_not_stop_the_batch(self):
+        first_id, second_id = self.create_test_runs(2)
+        self.outbox.put(first_id)
+        self.outbox.put(second_id)
+
+        sent = []
+        original = self.outbox.sent
+
+        def sent_once(name):
+            if not sent:
+                sent.append(name)
+                raise OSError(u'permission denied')
+            original(name)
+        self.outbox.sent = sent_once
+
+        OutboxSenderTask(self.outbox).update()
+        self.assertEqual(notifications.notified, [first_id, second_id])
+        self.assertEqual([entry[u'test_run_id'] for _, entry in self.outbox.pending()], [first_id])
+
+    def test_default_folder_is_not_temporary(self):
+        with override_settings(DJANGO_BDD_ENGINE_OUTBOX_DIR=None):
+            path = Outbox().path
+        self.assertFalse(path.startswith(tempfile.gettempdir()))
+        self.assertTrue(os.path.isabs(path))
+
+    def test_entry_is_claimed_once(self):
+        test_run_id, = self.create_test_runs()
+        self.outbox.put(test_run_id)
+        (name, entry), = self.outbox.pending()
+
+        claimed, claimed_entry = Outbox(self.outbox.path).claim(name)
+        self.assertEqual(claimed_entry, entry)
+        self.assertIsNone(self.outbox.claim(name))
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_engines_sharing_an_outbox_send_each_notification_once(self):
+        import threading
+        from django.db import connection
+
+        test_run_ids = self.create_test_runs(20)
+        for test_run_id in test_run_ids:
+            self.outbox.put(test_run_id)
+
+        def engine():
+            try:
+                OutboxSenderTask(Outbox(self.outbox.path)).update()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=engine) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(notifications.notified), test_run_ids)
+
+    def test_claims_of_exited_processes_are_recovered(self):
+        import subprocess
+        test_run_id, = self.create_test_runs()
+        self.outbox.put(test_run_id)
+        (name, _), = self.outbox.pending()
+
+        exited = subprocess.Popen([u'true'])
+        exited.wait()
+        os.rename(os.path.join(self.outbox.path, name), os.path.join(self.outbox.path, u'{}.sending.{}'.format(name, exited.pid)))
+
+        OutboxSenderTask(self.outbox).update()
+        self.assertEqual(notifications.notified, [test_run_id])
+        self.assertEqual(os.listdir(self.outbox.path), [u'failed'])
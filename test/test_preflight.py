@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from django_bdd_engine.preflight import Preflight, check_example_text
+from django_bdd_engine.sharding import count_example_rows
+
+
+STEPS = u'Given I open <page>\r\nThen I see <title>\r\n'
+
+STEP_DEFINITIONS = u'''from behave import given, then
+
+
+@given(u'I open {page}')
+def step_open(context, page):
+    pass
+
+
+@then(u'I see {title}')
+def step_see(context, title):
+    pass
+'''
+
+
+class CheckExampleTextTest(unittest.TestCase):
+
+    def test_well_formed_table(self):
+        self.assertEqual(check_example_text(STEPS, u'# pages\r\n| page | title |\r\n| home | Home |\r\n'), [])
+
+    def test_several_tables(self):
+        example_text = (u'| page | title |\r\n| home | Home |\r\n\r\n'
+                        u'@slow\r\nExamples: more pages\r\n| page | title |\r\n| help | Help |\r\n')
+        self.assertEqual(check_example_text(STEPS, example_text), [])
+        # several tables are run whole
+        self.assertEqual(count_example_rows(example_text), 0)
+
+    def test_not_a_table(self):
+        self.assertEqual(len(check_example_text(STEPS, u'page, title\r\nhome, Home\r\n')), 1)
+        self.assertEqual(len(check_example_text(STEPS, u'| page | title |\r\nExamples:\r\n| page | title |\r\n| help | Help |\r\n')), 1)
+
+    def test_malformed_row(self):
+        self.assertEqual(check_example_text(STEPS, u'| page | title |\r\n| home |\r\n'),
+                         [u'the examples table row 1 has 1 cells, the header has 2: | home |'])
+
+    def test_missing_placeholder_column(self):
+        example_text = u'| page | title |\r\n| home | Home |\r\nExamples:\r\n| page |\r\n| help |\r\n'
+        self.assertEqual(check_example_text(STEPS, example_text),
+                         [u'the steps use <title>, which examples table 2 has no column for'])
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        step_dir = tempfile.mkdtemp(prefix=u'django-bdd-engine-steps-')
+        self.addCleanup(shutil.rmtree, step_dir, True)
+        with open(os.path.join(step_dir, u'steps.py'), u'w') as f:
+            f.write(STEP_DEFINITIONS)
+        self.preflight = Preflight(step_dirs=[step_dir])
+
+    def test_runnable(self):
+        self.assertEqual(self.preflight.check_feature(u'pages', STEPS, u'| page | title |\r\n| home | Home |\r\n'), [])
+
+    def test_undefined_steps(self):
+        steps = u'Given I open the home page\r\nWhen I log in\r\nWhen I log in\r\n'
+        self.assertEqual(self.preflight.check_feature(u'log in', steps, u''),
+                         [u'no step definition matches the step "When I log in"'])
+
+    def test_steps_that_do_not_parse(self):
+        problems = self.preflight.check_feature(u'broken', u'Given I open home\r\nsome notes\r\n', u'')
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith(u'the steps could not be parsed'))
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from django_bdd_engine.utility.runtext import RunText
+from django_bdd_engine.utility.uploads import LocalS3Util
+
+
+class FakeTestRun(object):
+
+    def __init__(self, text=u''):
+        self.id = 7
+        self.test_id = 3
+        self.text = text
+
+
+class BrokenS3Util(object):
+
+    def save_screenshot(self, key, f):
+        raise IOError(u's3 is down')
+
+
+class RunTextTest(unittest.TestCase):
+
+    def run_text(self, text=u'', **kwargs):
+        run_text = RunText(FakeTestRun(text), **kwargs)
+        self.addCleanup(run_text.close)
+        return run_text
+
+    def test_short_output_is_kept_whole(self):
+        run_text = self.run_text(u'before\n', max_length=10, spill=False)
+        run_text.append(u'abc')
+        run_text.append(u'')
+        run_text.append(u'def')
+        self.assertFalse(run_text.truncated)
+        self.assertEqual(run_text.value(), u'before\nabcdef')
+
+    def test_long_output_keeps_its_head_and_tail(self):
+        run_text = self.run_text(max_length=10, spill=False)
+        for chunk in (u'abc', u'defgh', u'ijklmnop', u'qrstuvwxyz'):
+            run_text.append(chunk)
+        self.assertTrue(run_text.truncated)
+        self.assertEqual(run_text.output(), u'abcde\n\n... 16 characters truncated ...\n\nvwxyz')
+
+    def test_checkpoint_only_when_changed(self):
+        run_text = self.run_text(u'before\n', spill=False)
+        self.assertFalse(run_text.checkpoint())
+        run_text.append(u'step 1\n')
+        self.assertTrue(run_text.checkpoint())
+        self.assertEqual(run_text.test_run.text, u'before\nstep 1\n')
+        self.assertFalse(run_text.checkpoint())
+
+    def test_truncated_output_is_spilled_to_s3(self):
+        folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-runtext-')
+        self.addCleanup(shutil.rmtree, folder, True)
+        run_text = self.run_text(max_length=4, spill=True)
+        run_text.append(u'abcdef\xe9')
+        run_text.checkpoint()
+
+        run_text.upload_spill(LocalS3Util(folder))
+        self.assertTrue(run_text.checkpoint())
+        key = u'bdd/results/3/7/output.txt'
+        self.assertEqual(run_text.test_run.text, u'ab\n\n... 3 characters truncated, the full output is in s3 at "{}" ...\n\nf\xe9'.format(key))
+        with open(os.path.join(folder, key), u'rb') as f:
+            self.assertEqual(f.read().decode(u'utf8'), u'abcdef\xe9')
+
+    def test_nothing_spilled_unless_truncated(self):
+        run_text = self.run_text(max_length=10, spill=True)
+        run_text.append(u'abc')
+        run_text.upload_spill(BrokenS3Util())
+        self.assertIsNone(run_text.spill_key)
+
+    def test_failed_spill_keeps_the_plain_marker(self):
+        run_text = self.run_text(max_length=4, spill=True)
+        run_text.append(u'abcdef')
+        run_text.upload_spill(BrokenS3Util())
+        self.assertIsNone(run_text.spill_key)
+        self.assertEqual(run_text.output(), u'ab\n\n... 2 characters truncated ...\n\nef')
@@ -0,0 +1,113 @@
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from test.base import EngineTestCase
+
+
+class SchedulingTestCase(EngineTestCase):
+
+    def create_test(self, durations=(), queued=1, **fields):
+        """Create a test with finished runs of the given durations, and queue
+        runs of it.
+
+        :return: the queued runs, as the queue fetches them
+        """
+        from django_bdd_engine.benchmark.models import TestRun
+        from django_bdd_engine.testqueue import TestRunQueue
+
+        test_run_ids = self.create_test_runs(len(durations) + queued, **fields)
+        for test_run_id, duration in zip(test_run_ids, durations):
+            TestRun.objects.filter(pk=test_run_id).update(status=u'passed', duration=duration)
+        queued_ids = test_run_ids[len(durations):]
+        return [test_run for test_run in TestRunQueue().fetch_batch(limit=1000) if test_run.pk in queued_ids]
+
+
+class DurationHistoryTest(SchedulingTestCase):
+
+    def test_mean_of_finished_runs(self):
+        from django_bdd_engine.scheduling import DurationHistory
+        timed, = self.create_test(durations=(10, 20))
+        untimed, = self.create_test()
+
+        history = DurationHistory(default=99)
+        self.assertEqual(history.expected_durations([timed.test_id, untimed.test_id]), {timed.test_id: 15, untimed.test_id: 99})
+
+    def test_kept_for_max_age(self):
+        from django_bdd_engine.scheduling import DurationHistory
+        test_run, = self.create_test(durations=(10,))
+        history = DurationHistory()
+        history.expected_durations([test_run.test_id])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(history.expected_durations([test_run.test_id]), {test_run.test_id: 10})
+        self.assertEqual(len(queries), 0)
+
+        history.max_age = 0
+        with CaptureQueriesContext(connection) as queries:
+            history.expected_durations([test_run.test_id])
+        self.assertEqual(len(queries), 1)
+
+
+class ShortestJobFirstTest(SchedulingTestCase):
+
+    def test_short_runs_first_until_a_long_one_has_waited(self):
+        from django_bdd_engine.scheduling import ShortestJobFirstScheduler
+        long_run, = self.create_test(durations=(300,))
+        short_runs = self.create_test(durations=(10,), queued=2)
+        scheduler = ShortestJobFirstScheduler()
+
+        ordered = scheduler.order([long_run] + short_runs)
+        self.assertEqual(ordered, short_runs + [long_run])
+
+        # 300s expected, less 400s waited, beats 10s expected
+        scheduler.first_seen.set(long_run.id, time.time() - 400)
+        ordered = scheduler.order([long_run] + short_runs)
+        self.assertEqual(ordered, [long_run] + short_runs)
+
+
+class FairShareTest(SchedulingTestCase):
+
+    def test_users_take_turns(self):
+        from django_bdd_engine.scheduling import FairShareScheduler
+        a1, a2, a3 = self.create_test(queued=3, user=u'a')
+        b1, = self.create_test(queued=1, user=u'b')
+        self.assertEqual(FairShareScheduler().order([a1, a2, a3, b1]), [a1, b1, a2, a3])
+
+    def test_users_with_running_runs_wait(self):
+        from django_bdd_engine.scheduling import FairShareScheduler
+        self.create_test_runs(2, user=u'a', status=u'running')
+        a1, a2 = self.create_test(queued=2, user=u'a')
+        b1, b2 = self.create_test(queued=2, user=u'b')
+        self.assertEqual(FairShareScheduler().order([a1, a2, b1, b2]), [b1, b2, a1, a2])
+
+
+class PriorityTest(SchedulingTestCase):
+
+    def test_higher_priority_first_then_oldest(self):
+        from django_bdd_engine.scheduling import PriorityScheduler
+        low, high, other_high, unset = self.create_test(queued=4)
+        low.priority, high.priority, other_high.priority = 1, 5, 5
+        self.assertEqual(PriorityScheduler(field=u'priority').order([low, high, other_high, unset]), [high, other_high, low, unset])
+
+
+class EtaTest(SchedulingTestCase):
+
+    def test_etas_are_published(self):
+        from django_bdd_engine.scheduling import DurationHistory, Scheduler, get_eta
+        first, second, third = self.create_test(durations=(60,), queued=3)
+
+        before = time.time()
+        Scheduler(DurationHistory()).order([first, second, third], parallelism=2)
+        etas = [get_eta(test_run.id) for test_run in (first, second, third)]
+
+        starts = [eta[u'expected_start'] - before for eta in etas]
+        self.assertEqual([int(round(start)) for start in starts], [0, 30, 60])
+        self.assertEqual([int(round(eta[u'eta'] - eta[u'expected_start'])) for eta in etas], [60, 60, 60])
+
+    def test_no_etas_without_history(self):
+        from django_bdd_engine.scheduling import Scheduler, get_eta
+        test_run, = self.create_test()
+        Scheduler().order([test_run])
+        self.assertIsNone(get_eta(test_run.id))
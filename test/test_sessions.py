@@ -0,0 +1,155 @@
+import json
+import httplib
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+
+from django_bdd_engine.sessions import SessionPool
+
+
+class FakeWebDriverHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        length = int(self.headers.get(u'Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = self.path[len(server.prefix):]
+        with server.lock:
+            server.requests.append((self.command, path, body))
+
+        parts = path.strip(u'/').split(u'/')
+        status, response = 200, {u'value': None}
+        if self.command == u'POST' and path == u'/session':
+            with server.lock:
+                server.created += 1
+                session_id = u'session-{}'.format(server.created)
+                server.sessions.add(session_id)
+            response = {u'sessionId': session_id, u'value': json.loads(body)}
+        elif parts[0] == u'session' and parts[1] not in server.sessions:
+            status, response = 404, {u'value': {u'error': u'invalid session id'}}
+        elif self.command == u'DELETE' and len(parts) == 2:
+            server.sessions.discard(parts[1])
+        elif self.command == u'POST' and parts[2:] == [u'url']:
+            response = {u'value': json.loads(body)[u'url']}
+
+        data = json.dumps(response)
+        self.send_response(status)
+        self.send_header(u'Content-Type', u'application/json')
+        self.send_header(u'Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_POST = do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWebDriver(BaseHTTPServer.HTTPServer):
+    """A webdriver server that records its requests, and whose sessions do
+    nothing but exist.
+    """
+
+    def __init__(self, prefix=u'/wd/hub'):
+        BaseHTTPServer.HTTPServer.__init__(self, (u'127.0.0.1', 0), FakeWebDriverHandler)
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = []  # (method, path after the prefix, body)
+        self.sessions = set()
+        self.created = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return u'http://127.0.0.1:{}{}'.format(self.server_address[1], self.prefix)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def requested(self, method, path=None):
+        return [request for request in self.requests if request[0] == method and path in (None, request[1])]
+
+
+def request(url, method, path, body=None):
+    """
+    :return: (status, decoded json response)
+    """
+    parts = urlparse.urlsplit(url)
+    connection = httplib.HTTPConnection(parts.hostname, parts.port, timeout=10)
+    try:
+        connection.request(method, parts.path + path, json.dumps(body) if body is not None else None)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+class SessionProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeWebDriver()
+        self.addCleanup(self.server.stop)
+        self.pool = SessionPool(max_reuse=3, keepalive_interval=3600)
+        self.addCleanup(self.pool.close)
+        self.proxy_url = self.pool.proxy_url(self.server.url)
+
+    def new_session(self, platform=u'android'):
+        status, response = request(self.proxy_url, u'POST', u'/session', {u'desiredCapabilities': {u'platformName': platform}})
+        self.assertEqual(status, 200)
+        return response[u'sessionId']
+
+    def quit(self, session_id):
+        status, response = request(self.proxy_url, u'DELETE', u'/session/{}'.format(session_id))
+        self.assertEqual(status, 200)
+
+    def test_session_is_reused_after_a_reset(self):
+        session_id = self.new_session()
+        self.quit(session_id)
+        self.assertEqual(self.new_session(), session_id)
+
+        self.assertEqual(len(self.server.requested(u'POST', u'/session')), 1)
+        self.assertEqual(len(self.server.requested(u'POST', u'/session/{}/appium/app/reset'.format(session_id))), 1)
+        self.assertEqual(self.server.requested(u'DELETE'), [])
+
+    def test_other_capabilities_get_a_new_session(self):
+        android = self.new_session(u'android')
+        self.quit(android)
+        ios = self.new_session(u'ios')
+
+        self.assertNotEqual(ios, android)
+        self.assertEqual(self.server.sessions, set([ios]))
+
+    def test_commands_are_forwarded(self):
+        session_id = self.new_session()
+        status, response = request(self.proxy_url, u'POST', u'/session/{}/url'.format(session_id), {u'url': u'about:blank'})
+        self.assertEqual((status, response[u'value']), (200, u'about:blank'))
+
+        status, response = request(self.proxy_url, u'GET', u'/session/unknown/url')
+        self.assertEqual((status, response[u'value'][u'error']), (404, u'invalid session id'))
+
+    def test_session_is_replaced_after_max_reuse(self):
+        first = self.new_session()
+        self.quit(first)
+        for _ in range(2):
+            self.assertEqual(self.new_session(), first)
+            self.quit(first)
+        second = self.new_session()
+
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.server.sessions, set([second]))
+
+    def test_unreachable_upstream_is_a_bad_gateway(self):
+        self.server.stop()
+        status, response = request(self.proxy_url, u'GET', u'/status')
+        self.assertEqual(status, 502)
+
+    def test_close_quits_every_session(self):
+        idle = self.new_session(u'android')
+        self.quit(idle)
+        self.new_session(u'android')
+        self.pool.close()
+        self.assertEqual(self.server.sessions, set())
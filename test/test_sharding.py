@@ -0,0 +1,58 @@
+import unittest
+
+from django_bdd_engine.endpoints import Endpoint
+from django_bdd_engine.sharding import count_example_rows, shard_example_text
+from test.base import EngineTestCase, notifications
+
+
+class ShardExampleTextTest(unittest.TestCase):
+
+    def test_contiguous_slices_with_the_header(self):
+        example_text = u'| value |\r\n| 1 |\r\n| 2 |\r\n| 3 |\r\n| 4 |\r\n| 5 |\r\n'
+        self.assertEqual(shard_example_text(example_text, 2), [
+            (0, u'| value |\r\n| 1 |\r\n| 2 |\r\n| 3 |\r\n'),
+            (3, u'| value |\r\n| 4 |\r\n| 5 |\r\n'),
+        ])
+
+    def test_no_more_shards_than_rows(self):
+        example_text = u'| value |\r\n| 1 |\r\n| 2 |\r\n'
+        self.assertEqual([offset for offset, _ in shard_example_text(example_text, 5)], [0, 1])
+
+    def test_count_example_rows(self):
+        self.assertEqual(count_example_rows(u'# comment\r\n| value |\r\n\r\n| 1 |\r\n'), 1)
+        self.assertEqual(count_example_rows(u'not a table'), 0)
+
+
+class ShardedTestDriverTest(EngineTestCase):
+
+    def run_sharded(self, endpoints):
+        from django_bdd_engine.benchmark.models import TestRun
+        from django_bdd_engine.engine import DjangoBDDEngine
+        from django_bdd_engine.outbox import OutboxSenderTask
+
+        engine = DjangoBDDEngine(endpoints=[Endpoint(url) for url in endpoints], max_shards=len(endpoints))
+        test_run = engine.queue.claim_next()
+        self.assertTrue(engine.dispatch(test_run, None))
+        OutboxSenderTask(engine.outbox).update()
+        self.assertEqual([endpoint.active for endpoint in engine.endpoint_pool.endpoints], [0] * len(endpoints))
+        return TestRun.objects.get(pk=test_run.id)
+
+    def test_rows_run_across_endpoints(self):
+        self.set_config(type(self.config)(steps=3, rows=5))
+        test_run_id, = self.create_test_runs()
+        test_run = self.run_sharded([u'http://shard-1', u'http://shard-2'])
+
+        self.assertEqual(test_run.status, u'passed')
+        self.assertIsNotNone(test_run.duration)
+        rows = sorted(test_run.testrunstep_set.values_list(u'example_row_num', u'num', u'status'))
+        self.assertEqual(rows, [(row, num, u'passed') for row in range(1, 6) for num in range(1, 4)])
+        self.assertEqual(notifications.notified, [test_run_id])
+
+    def test_a_failed_shard_fails_the_run(self):
+        self.set_config(type(self.config)(steps=2, rows=4, failure_rate=1.0))
+        self.create_test_runs()
+        test_run = self.run_sharded([u'http://shard-1', u'http://shard-2'])
+
+        self.assertEqual(test_run.status, u'failed')
+        statuses = dict(test_run.testrunstep_set.values_list(u'example_row_num', u'status').filter(num=1))
+        self.assertEqual(statuses, dict((row, u'failed') for row in range(1, 5)))
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from django_bdd_engine.tasks.scheduler import TaskScheduler
+from django_bdd_engine.tasks.task import Task
+
+
+class RecordingTask(Task):
+    """Notes down each of its updates."""
+
+    def __init__(self, name, updates, runs=None, **kwargs):
+        super(RecordingTask, self).__init__(**kwargs)
+        self.name = name
+        self.updates = updates
+        self.runs = runs
+
+    def update(self):
+        self.updates.append(self.name)
+        if self.runs is not None and self.updates.count(self.name) >= self.runs:
+            self.done = True
+
+
+class BlockedTask(Task):
+    """Blocks in its update until it's let go, like a task waiting on a host that doesn't answer."""
+
+    def __init__(self, **kwargs):
+        super(BlockedTask, self).__init__(**kwargs)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+        self.started.set()
+        self.release.wait(30)
+
+
+class TaskSchedulerTest(unittest.TestCase):
+
+    def start(self, threads):
+        scheduler = TaskScheduler(threads=threads)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def wait_for(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_tasks_run_when_due(self):
+        updates = []
+        scheduler = self.start(threads=1)
+        scheduler.add(RecordingTask(u'late', updates, runs=1), delay=0.2)
+        scheduler.add(RecordingTask(u'soon', updates, runs=1), delay=0.1)
+        scheduler.add(RecordingTask(u'now', updates, runs=1))
+
+        self.wait_for(lambda: len(updates) == 3)
+        self.assertEqual(updates, [u'now', u'soon', u'late'])
+        self.wait_for(lambda: len(scheduler) == 0)
+
+    def test_shorter_intervals_run_more_often(self):
+        updates = []
+        scheduler = self.start(threads=1)
+        scheduler.add(RecordingTask(u'slow', updates, interval=0.5))
+        scheduler.add(RecordingTask(u'fast', updates, interval=0.05))
+
+        time.sleep(0.4)
+        self.assertEqual(updates[:2], [u'slow', u'fast'])
+        self.assertEqual(updates.count(u'slow'), 1)
+        self.assertGreater(updates.count(u'fast'), 3)
+
+    def test_blocked_task_does_not_hold_up_the_others(self):
+        updates = []
+        blocked = BlockedTask(interval=0.01, timeout=0.1)
+        scheduler = self.start(threads=2)
+        self.addCleanup(blocked.release.set)
+        scheduler.add(blocked)
+        self.assertTrue(blocked.started.wait(10))
+
+        scheduler.add(RecordingTask(u'other', updates, interval=0.01, runs=5))
+        self.wait_for(lambda: len(updates) == 5)
+        self.wait_for(lambda: blocked in scheduler.timed_out)
+        # a hung task isn't run again until it returns
+        self.assertEqual(blocked.updates, 1)
+
+        blocked.release.set()
+        self.wait_for(lambda: blocked.updates > 1)
+
+    def test_failing_task_is_dropped(self):
+        class FailingTask(Task):
+            def update(self):
+                raise ValueError(u'broken')
+
+        scheduler = self.start(threads=1)
+        scheduler.add(FailingTask(interval=0.01))
+        self.wait_for(lambda: len(scheduler) == 0)
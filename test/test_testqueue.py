@@ -0,0 +1,142 @@
+from test.base import EngineTestCase
+
+
+class ClaimNextTest(EngineTestCase):
+
+    def test_runnable_run_behind_a_long_queue_is_claimed(self):
+        from django_bdd_engine.testqueue import QUEUE_SCAN_LIMIT, TestRunQueue
+        blocked_ids = set(self.create_test_runs(QUEUE_SCAN_LIMIT + 20))
+        runnable_id, = self.create_test_runs()
+        queue = TestRunQueue()
+
+        def can_run(test_run):
+            return test_run.pk not in blocked_ids
+
+        claims = [queue.claim_next(can_run=can_run) for _ in range(3)]
+        self.assertEqual([test_run.pk for test_run in claims if test_run], [runnable_id])
+        self.assertIsNone(claims[0])
+
+    def test_passed_over_runs_are_looked_at_first_once_they_can_run(self):
+        from django_bdd_engine.testqueue import TestRunQueue
+        blocked_id, first_id, second_id = self.create_test_runs(3)
+        queue = TestRunQueue()
+        blocked = set([blocked_id])
+
+        def can_run(test_run):
+            return test_run.pk not in blocked
+
+        self.assertEqual(queue.claim_next(can_run=can_run).pk, first_id)
+        blocked.clear()
+        self.assertEqual(queue.claim_next(can_run=can_run).pk, blocked_id)
+        self.assertEqual(queue.claim_next(can_run=can_run).pk, second_id)
+
+    def test_requeued_run_is_claimed_again(self):
+        from django_bdd_engine.testqueue import TestRunQueue, unclaim_test_run
+        test_run_ids = self.create_test_runs(25)
+        queue = TestRunQueue(batch_size=10)
+
+        def can_run(test_run):
+            return test_run.pk != test_run_ids[1]
+
+        first = queue.claim_next(can_run=can_run)
+        self.assertEqual(first.pk, test_run_ids[0])
+        self.assertEqual(queue.claim_next(can_run=can_run).pk, test_run_ids[2])
+        self.assertTrue(unclaim_test_run(first.pk))
+
+        self.assertEqual(queue.claim_next(can_run=can_run).pk, first.pk)
+
+    def test_nothing_runnable(self):
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.create_test_runs(15)
+        queue = TestRunQueue(batch_size=10)
+        for _ in range(3):
+            self.assertIsNone(queue.claim_next(can_run=lambda test_run: False))
+
+
+class PrefetchTest(EngineTestCase):
+
+    def count_fetches(self, queue):
+        fetches = []
+        fetch_batch = queue.fetch_batch
+
+        def counted(*args, **kwargs):
+            batch = fetch_batch(*args, **kwargs)
+            fetches.append(len(batch))
+            return batch
+        queue.fetch_batch = counted
+        return fetches
+
+    def test_runs_are_claimed_from_batches(self):
+        from django_bdd_engine.testqueue import TestRunQueue
+        test_run_ids = self.create_test_runs(25)
+        queue = TestRunQueue(batch_size=10)
+        fetches = self.count_fetches(queue)
+
+        self.assertEqual([queue.claim_next().pk for _ in test_run_ids], test_run_ids)
+        self.assertEqual(fetches, [10, 10, 5])
+        self.assertIsNone(queue.claim_next())
+        self.assertEqual(fetches, [10, 10, 5, 0])
+
+    def test_batches_leave_out_the_big_fields(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.create_test_runs(2)
+
+        test_run = TestRunQueue().claim_next()
+        self.assertEqual(test_run.get_deferred_fields(), set([u'text', u'example_text']))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(test_run.test.steps)
+        self.assertEqual(len(queries), 0)
+
+
+class StatsTest(EngineTestCase):
+
+    def queue_since(self, *minutes_ago):
+        import datetime
+        import pytz
+        now = datetime.datetime.now(pytz.utc)
+        for minutes in minutes_ago:
+            self.create_test_runs(queued_at=now - datetime.timedelta(minutes=minutes))
+
+    def test_depth_by_runner(self):
+        from django_bdd_engine.benchmark.models import Test
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.create_test_runs(3)
+        self.create_test_runs(2)
+        self.create_test_runs(1, status=u'running')
+        Test.objects.filter(pk=Test.objects.order_by(u'pk')[0].pk).update(steps=u'Given a device')
+
+        stats = TestRunQueue().stats(classify=lambda steps: u'device' if u'device' in steps else u'web')
+        self.assertEqual(stats, {u'depth': 5, u'depth_by_runner': {u'device': 3, u'web': 2}})
+
+    def test_waits(self):
+        from django.test.utils import override_settings
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.queue_since(30, 20, 10)
+        self.create_test_runs()
+
+        with override_settings(DJANGO_BDD_ENGINE_QUEUED_AT_FIELD=u'queued_at'):
+            stats = TestRunQueue().stats()
+        self.assertEqual(stats[u'depth'], 4)
+        self.assertEqual([int(round(stats[key] / 60)) for key in (u'oldest_wait', u'wait_p50', u'wait_p90')], [30, 20, 30])
+
+    def test_percentiles_of_a_deep_queue_are_sampled(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext, override_settings
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.queue_since(*range(1, 11))
+        queue = TestRunQueue()
+        queue.stats_sample_size = 3
+
+        with override_settings(DJANGO_BDD_ENGINE_QUEUED_AT_FIELD=u'queued_at'), CaptureQueriesContext(connection) as queries:
+            stats = queue.stats()
+        self.assertEqual(int(round(stats[u'oldest_wait'] / 60)), 10)
+        sampled = [query[u'sql'] for query in queries if u'RANDOM()' in query[u'sql']]
+        self.assertEqual(len(sampled), 1)
+        self.assertTrue(sampled[0].endswith(u'LIMIT 3'))
+
+    def test_no_waits_without_a_queued_at_field(self):
+        from django_bdd_engine.testqueue import TestRunQueue
+        self.create_test_runs(2)
+        self.assertEqual(TestRunQueue().stats(), {u'depth': 2})
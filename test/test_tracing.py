@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+from django_bdd_engine.utility import tracing
+from django_bdd_engine.utility.tracing import (
+    current_trace,
+    finish_trace,
+    profile_requested,
+    profiled,
+    span,
+    start_trace,
+    traced,
+)
+
+
+class Uploader(object):
+
+    @traced(u'upload', attributes=lambda self, key: {u'key': key})
+    def upload(self, key):
+        return key
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-traces-')
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        settings = override_settings(DJANGO_BDD_ENGINE_TRACE_DIR=self.folder)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def read(self, file_name):
+        with open(os.path.join(self.folder, file_name)) as f:
+            return json.load(f)[u'traceEvents']
+
+    def test_spans_are_written_as_trace_events(self):
+        trace = start_trace(u'run 1', test_run_id=1)
+        self.assertIs(current_trace(), trace)
+        with span(u'step', num=1):
+            self.assertEqual(Uploader().upload(u'a.png'), u'a.png')
+        finish_trace(u'run-1.json')
+        self.assertIsNone(current_trace())
+
+        metadata, upload, step = self.read(u'run-1.json')
+        self.assertEqual(metadata[u'args'], {u'name': u'run 1', u'test_run_id': 1, u'dropped_spans': 0})
+        self.assertEqual((upload[u'name'], upload[u'args']), (u'upload', {u'key': u'a.png'}))
+        self.assertEqual((step[u'name'], step[u'args']), (u'step', {u'num': 1}))
+        self.assertLessEqual(step[u'ts'], upload[u'ts'])
+        self.assertGreaterEqual(step[u'dur'], upload[u'dur'])
+
+    def test_traces_nest(self):
+        engine = start_trace(u'engine')
+        run = start_trace(u'run 2')
+        with span(u'in the run'):
+            pass
+        with span(u'in the engine', trace=engine):
+            pass
+        finish_trace(u'run-2.json')
+        self.assertIs(current_trace(), engine)
+        finish_trace(u'engine.json')
+
+        self.assertEqual([event[u'name'] for event in self.read(u'run-2.json')[1:]], [u'in the run'])
+        self.assertEqual([event[u'name'] for event in self.read(u'engine.json')[1:]], [u'in the engine'])
+
+    def test_spans_past_the_limit_are_dropped(self):
+        self.addCleanup(setattr, tracing, u'MAX_SPANS', tracing.MAX_SPANS)
+        tracing.MAX_SPANS = 2
+        start_trace(u'run 3')
+        for num in range(5):
+            with span(u'step', num=num):
+                pass
+        finish_trace(u'run-3.json')
+
+        events = self.read(u'run-3.json')
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[0][u'args'][u'dropped_spans'], 3)
+
+    def test_nothing_recorded_when_tracing_is_off(self):
+        with override_settings(DJANGO_BDD_ENGINE_TRACE_DIR=None):
+            self.assertIsNone(start_trace(u'run 4'))
+            with span(u'step'):
+                self.assertEqual(Uploader().upload(u'a.png'), u'a.png')
+            finish_trace(u'run-4.json')
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_profile_requested_by_run_test_or_rate(self):
+        self.assertFalse(profile_requested(1, test_id=2))
+        cache.set(u'django-bdd-engine-profile-run-1', True)
+        self.assertTrue(profile_requested(1))
+        cache.clear()
+        cache.set(u'django-bdd-engine-profile-test-2', True)
+        self.assertTrue(profile_requested(1, test_id=2))
+        self.assertFalse(profile_requested(1))
+        cache.clear()
+        cache.set(u'django-bdd-engine-profile-rate', 1)
+        self.assertTrue(profile_requested(1))
+
+    def test_profiled_run_saves_its_stats(self):
+        folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-traces-')
+        self.addCleanup(shutil.rmtree, folder, True)
+        with override_settings(DJANGO_BDD_ENGINE_TRACE_DIR=folder):
+            with profiled(5, enabled=False):
+                pass
+            self.assertEqual(os.listdir(folder), [])
+            with profiled(5, enabled=True):
+                sum(range(1000))
+        self.assertEqual(os.listdir(folder), [u'run-5.prof'])
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from django_bdd_engine.utility import uploads
+from django_bdd_engine.utility.uploads import LocalS3Util, ScreenshotUploader
+
+
+class ScreenshotUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix=u'django-bdd-engine-uploads-')
+        self.addCleanup(shutil.rmtree, self.folder, True)
+        self.s3_folder = os.path.join(self.folder, u's3')
+        self.addCleanup(setattr, uploads, u'UPLOAD_RETRY_BACKOFF', uploads.UPLOAD_RETRY_BACKOFF)
+        uploads.UPLOAD_RETRY_BACKOFF = 0
+
+    def screenshot(self, name, data=b'png data'):
+        path = os.path.join(self.folder, name)
+        with open(path, u'wb') as f:
+            f.write(data)
+        return path
+
+    def drain(self, uploader):
+        """Drain the uploader, failing instead of hanging if it doesn't."""
+        thread = threading.Thread(target=uploader.drain)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), u'drain() did not return')
+
+    def saved(self, key):
+        with open(os.path.join(self.s3_folder, key), u'rb') as f:
+            return f.read()
+
+    def check_bad_path(self, **kwargs):
+        uploader = ScreenshotUploader(LocalS3Util(self.s3_folder), threads=1, **kwargs)
+        self.addCleanup(uploader.close)
+        uploader.upload(u'missing.png', os.path.join(self.folder, u'missing.png'), context=u'missing')
+        uploader.upload(u'present.png', self.screenshot(u'present.png'), context=u'present')
+        self.drain(uploader)
+        return uploader.completed()
+
+    def test_bad_path_does_not_stop_uploads(self):
+        self.assertEqual(self.check_bad_path(), [(u'present.png', u'present')])
+        self.assertEqual(self.saved(u'present.png'), b'png data')
+
+    def test_bad_path_does_not_stop_deduped_uploads(self):
+        completed = self.check_bad_path(dedupe=True)
+        self.assertEqual([context for _, context in completed], [u'present'])
+
+    def test_bad_path_does_not_stop_shrunk_uploads(self):
+        self.assertEqual(self.check_bad_path(shrink=True), [(u'present.png', u'present')])
+
+    def test_shrink_without_dedupe(self):
+        shrunk = []
+
+        def shrink_png(data, max_width=None):
+            shrunk.append(max_width)
+            return b'small'
+        original, uploads.shrink_png = uploads.shrink_png, shrink_png
+        self.addCleanup(setattr, uploads, u'shrink_png', original)
+
+        uploader = ScreenshotUploader(LocalS3Util(self.s3_folder), threads=1, shrink=True, max_width=320)
+        self.addCleanup(uploader.close)
+        uploader.upload(u'step.png', self.screenshot(u'step.png'))
+        self.drain(uploader)
+
+        self.assertEqual(shrunk, [320])
+        self.assertEqual(self.saved(u'step.png'), b'small')
@@ -0,0 +1,49 @@
+import time
+import unittest
+
+from django_bdd_engine.wakeup import Backoff, PostgresWakeup, SocketWakeup, WakeupSource, send_wakeup
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_grows_to_the_maximum(self):
+        backoff = Backoff(minimum=1, maximum=15, factor=2)
+        self.assertEqual([backoff.next() for _ in range(6)], [1, 2, 4, 8, 15, 15])
+
+    def test_reset(self):
+        backoff = Backoff(minimum=0.5, maximum=4)
+        backoff.next()
+        backoff.next()
+        backoff.reset()
+        self.assertEqual(backoff.next(), 0.5)
+
+
+class WakeupSourceTest(unittest.TestCase):
+
+    def test_plain_source_sleeps(self):
+        start = time.time()
+        self.assertFalse(WakeupSource().wait(0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_socket_wakeup(self):
+        wakeup = SocketWakeup(port=0)
+        self.addCleanup(wakeup.close)
+        port = wakeup.sock.getsockname()[1]
+        self.assertFalse(wakeup.wait(0.01))
+
+        send_wakeup(port=port)
+        send_wakeup(port=port)
+        start = time.time()
+        self.assertTrue(wakeup.wait(5))
+        self.assertLess(time.time() - start, 1)
+        # both announcements are covered by the one wakeup
+        self.assertFalse(wakeup.wait(0.01))
+
+    def test_postgres_wakeup_falls_back_to_sleeping(self):
+        # the tests' sqlite db can't LISTEN
+        wakeup = PostgresWakeup()
+        self.addCleanup(wakeup.close)
+        start = time.time()
+        self.assertFalse(wakeup.wait(0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertIsNone(wakeup.listen_connection)
@@ -0,0 +1,151 @@
+import logging
+import os
+import time
+
+from django_bdd_engine.tasks.scheduler import TaskScheduler
+from django_bdd_engine.tasks.task import Task
+from django_bdd_engine.utility.logs import LOGGER_NAME
+from test.base import EngineTestCase, lease
+
+
+class SlowHandler(logging.Handler):
+    """Holds its lock a while for each record, like a handler writing to a slow disk or socket."""
+
+    def emit(self, record):
+        time.sleep(0.001)
+
+
+class ChattyTask(Task):
+    """Logs and leases endpoints from a task thread all the time."""
+
+    def __init__(self, endpoint_pool):
+        super(ChattyTask, self).__init__(interval=0)
+        self.endpoint_pool = endpoint_pool
+
+    def update(self):
+        logger = logging.getLogger(LOGGER_NAME)
+        for _ in range(50):
+            logger.debug(u'busy')
+            lease = self.endpoint_pool.lease(None)
+            if lease:
+                lease.release()
+
+
+class WorkerRecycleTest(EngineTestCase):
+
+    def setUp(self):
+        super(WorkerRecycleTest, self).setUp()
+        logger = logging.getLogger(LOGGER_NAME)
+        self.addCleanup(self.restore, list(logger.handlers), logger.level)
+        logger.addHandler(SlowHandler())
+        logger.setLevel(logging.DEBUG)
+
+    def restore(self, handlers, level):
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.handlers = handlers
+        logger.setLevel(level)
+
+    def terminate(self, pool):
+        # a hung worker would never take the stop job
+        for worker in pool.workers:
+            worker.process.terminate()
+
+    def test_workers_recycle_while_tasks_run(self):
+        from django_bdd_engine.benchmark.models import TestRun
+        from django_bdd_engine.endpoints import Endpoint
+        from django_bdd_engine.engine import DjangoBDDEngine
+
+        test_run_ids = self.create_test_runs(4)
+        engine = DjangoBDDEngine(endpoints=[Endpoint(u'http://test', max_sessions=2)], workers=1, max_runs_per_worker=1)
+        # the engine's own tasks would health check the endpoint
+        tasks = TaskScheduler()
+        tasks.add(ChattyTask(engine.endpoint_pool))
+        tasks.start()
+        self.addCleanup(tasks.stop)
+        engine.pool.start()
+        self.addCleanup(self.terminate, engine.pool)
+
+        deadline = time.time() + 30
+        processes = set()
+        for _ in test_run_ids:
+            test_run = engine.queue.claim_next()
+            processes.add(engine.pool.workers[0].process.pid)
+            self.assertTrue(engine.dispatch(test_run, None))
+            while engine.pool.workers[0].busy:
+                self.assertLess(time.time(), deadline, u'a recycled worker hung')
+                engine.pool.wait(timeout=1)
+
+        self.assertEqual(len(processes), len(test_run_ids))
+        self.assertEqual([TestRun.objects.get(pk=i).status for i in test_run_ids], [u'passed'] * len(test_run_ids))
+
+
+class DyingRunner(object):
+    """Takes its worker down with it."""
+
+    def __init__(self, engine, test_run_id):
+        pass
+
+    def start(self):
+        os._exit(1)
+
+
+class SlowClosingSessionPool(object):
+    """A session pool that takes a while to quit its sessions when the worker exits."""
+
+    def proxy_url(self, url):
+        return url
+
+    def finish(self, url):
+        pass
+
+    def close(self):
+        time.sleep(30)
+
+
+class WorkerStopTest(EngineTestCase):
+
+    def start_pool(self, **kwargs):
+        from django_bdd_engine.engine import DjangoBDDEngine
+        engine = DjangoBDDEngine(endpoint=u'http://test', workers=1, **kwargs)
+        engine.pool.start()
+        self.addCleanup(engine.pool.stop)
+        return engine
+
+    def run_one(self, engine, runner_class=None):
+        test_run = engine.queue.claim_next(lease_seconds=engine.lease_seconds)
+        self.assertTrue(engine.dispatch(test_run, runner_class))
+        deadline = time.time() + 30
+        while engine.pool.workers[0].busy:
+            self.assertLess(time.time(), deadline)
+            engine.pool.wait(timeout=1)
+        return test_run.id
+
+    def test_recycle_does_not_wait_for_the_old_worker(self):
+        engine = self.start_pool(max_runs_per_worker=1)
+        engine.session_pool = SlowClosingSessionPool()
+        engine.pool.stop_timeout = 1
+        self.create_test_runs()
+        old = engine.pool.workers[0]
+
+        start = time.time()
+        self.run_one(engine)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(engine.pool.stopping, [old])
+        self.assertNotEqual(engine.pool.workers[0], old)
+
+        # it's terminated once it's had stop_timeout to exit
+        time.sleep(1)
+        engine.pool.wait()
+        self.assertEqual(engine.pool.stopping, [])
+        self.assertFalse(old.process.is_alive())
+
+    def test_dead_worker_releases_its_runs(self):
+        from django_bdd_engine.benchmark.models import TestRun
+        test_run_id, = self.create_test_runs()
+        engine = self.start_pool(lease_seconds=30)
+        old = engine.pool.workers[0]
+
+        self.assertEqual(self.run_one(engine, DyingRunner), test_run_id)
+        self.assertEqual(TestRun.objects.get(pk=test_run_id).status, u'error')
+        self.assertIsNone(lease(test_run_id))
+        self.assertNotEqual(engine.pool.workers[0], old)